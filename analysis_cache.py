@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import shared_state
+
+# Tăng số này khi logic xử lý kết quả thay đổi để bỏ qua các kết quả cũ trong cache
+CACHE_VERSION = 1
+
+
+class AnalysisCache:
+    """Two-tier (memory + shared SQLite file) LRU/TTL cache for skin analysis results"""
+
+    def __init__(self, memory_entries=256, disk_entries=10000, ttl=7 * 24 * 3600,
+                 filename='analysis_cache.sqlite3', enabled=True):
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.ttl = ttl
+        self.filename = filename
+        self.enabled = enabled
+        self._memory = OrderedDict()  # key -> (stored_at, json payload)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(image_bytes, namespace='facepp'):
+        """Content address of a normalized image, per analyzer backend"""
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        return f"v{CACHE_VERSION}:{namespace}:{digest}"
+
+    def get(self, key):
+        """Return a fresh copy of the cached result for key, or None"""
+        if not self.enabled:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored_at, payload = entry
+                if now - stored_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    logging.info(f"Analysis cache hit (memory): {key[:26]}")
+                    return json.loads(payload)
+                del self._memory[key]
+
+        row = self._disk_get(key, now)
+        if row is not None:
+            stored_at, payload = row
+            self._memory_put(key, stored_at, payload)
+            logging.info(f"Analysis cache hit (disk): {key[:26]}")
+            return json.loads(payload)
+
+        logging.info(f"Analysis cache miss: {key[:26]}")
+        return None
+
+    def set(self, key, result):
+        """Store a result under key in both tiers"""
+        if not self.enabled:
+            return
+
+        try:
+            payload = json.dumps(result, ensure_ascii=False)
+        except (TypeError, ValueError) as e:
+            logging.warning(f"Analysis cache: result is not serializable, skipping ({e})")
+            return
+
+        now = time.time()
+        self._memory_put(key, now, payload)
+        self._disk_set(key, now, payload)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        try:
+            self._conn().execute('DELETE FROM analysis_cache')
+        except sqlite3.Error as e:
+            logging.warning(f"Analysis cache: could not clear disk tier ({e})")
+
+    def _memory_put(self, key, stored_at, payload):
+        with self._lock:
+            self._memory[key] = (stored_at, payload)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def _conn(self):
+        return shared_state.local_connection(self.filename, (
+            'CREATE TABLE IF NOT EXISTS analysis_cache ('
+            ' key TEXT PRIMARY KEY,'
+            ' stored_at REAL NOT NULL,'
+            ' accessed_at REAL NOT NULL,'
+            ' payload TEXT NOT NULL)',
+            'CREATE INDEX IF NOT EXISTS ix_analysis_cache_accessed ON analysis_cache (accessed_at)',
+        ))
+
+    def _disk_get(self, key, now):
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                'SELECT stored_at, payload FROM analysis_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[0] > self.ttl:
+                conn.execute('DELETE FROM analysis_cache WHERE key = ?', (key,))
+                return None
+            conn.execute('UPDATE analysis_cache SET accessed_at = ? WHERE key = ?', (now, key))
+            return row
+        except sqlite3.Error as e:
+            logging.warning(f"Analysis cache: disk read failed ({e})")
+            return None
+
+    def _disk_set(self, key, now, payload):
+        try:
+            with shared_state.immediate_transaction(self._conn()) as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO analysis_cache (key, stored_at, accessed_at, payload) VALUES (?, ?, ?, ?)',
+                    (key, now, now, payload)
+                )
+                conn.execute('DELETE FROM analysis_cache WHERE stored_at < ?', (now - self.ttl,))
+                conn.execute(
+                    'DELETE FROM analysis_cache WHERE key IN ('
+                    ' SELECT key FROM analysis_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                    (self.disk_entries,)
+                )
+        except sqlite3.Error as e:
+            logging.warning(f"Analysis cache: disk write failed ({e})")
+
+
+analysis_cache = AnalysisCache(
+    memory_entries=int(os.environ.get('ANALYSIS_CACHE_MEMORY_ENTRIES', 256)),
+    disk_entries=int(os.environ.get('ANALYSIS_CACHE_DISK_ENTRIES', 10000)),
+    ttl=int(os.environ.get('ANALYSIS_CACHE_TTL', 7 * 24 * 3600)),
+    enabled=os.environ.get('ANALYSIS_CACHE_ENABLED', 'true').lower() not in ('0', 'false', 'no'),
+)
@@ -0,0 +1,118 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import cloudinary.uploader
+from extensions import db
+from face_analysis import face_analyzer
+from metrics import stage_timer, timed, skin_analysis_stages
+
+# Job chỉ nằm trong executor của worker đã nhận nó: worker bị restart/kill thì dòng SkinAnalysis
+# nằm ở pending/processing mãi. Quá thời gian này thì coi job là đã mất và trả kết quả dự phòng
+STALE_MINUTES = float(os.environ.get('ANALYSIS_STALE_MINUTES', 10))
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """Lazily create the worker pool (once per gunicorn worker process, after fork)"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            max_workers = int(os.environ.get('ANALYSIS_WORKERS', 4))
+            _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='skin-analysis')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def submit_analysis(app, analysis_id, image_bytes, folder="beauty_ai"):
+    """Queue a pending SkinAnalysis row for background processing"""
+    return _get_executor().submit(_run_analysis, app, analysis_id, image_bytes, folder, time.perf_counter())
+
+
+def is_stale(analysis):
+    """Whether a pending/processing row is older than ANALYSIS_STALE_MINUTES"""
+    return (analysis.is_pending and analysis.date_analyzed is not None
+            and analysis.date_analyzed < datetime.utcnow() - timedelta(minutes=STALE_MINUTES))
+
+
+def fail_stale_analyses(analysis_id=None):
+    """Mark analyses stuck in pending/processing for more than ANALYSIS_STALE_MINUTES as failed
+    with the fallback result, all of them or only analysis_id; returns how many rows were failed"""
+    from sqlalchemy import null
+    from models import SkinAnalysis, summarize_analysis_result
+    fallback = face_analyzer._get_fallback_analysis()
+    query = SkinAnalysis.query.filter(
+        SkinAnalysis.status.in_(SkinAnalysis.PENDING_STATUSES),
+        SkinAnalysis.date_analyzed < datetime.utcnow() - timedelta(minutes=STALE_MINUTES),
+    )
+    if analysis_id is not None:
+        query = query.filter(SkinAnalysis.id == analysis_id)
+    # Một UPDATE có điều kiện: job vừa xong ở worker khác trong lúc này thì không bị ghi đè
+    failed = query.update({
+        SkinAnalysis.summary: summarize_analysis_result(fallback),
+        SkinAnalysis.skin_type: fallback['skin_type'],
+        SkinAnalysis.skin_concerns: fallback['concerns'],
+        SkinAnalysis.recommended_routine: fallback['recommended_routine'],
+        SkinAnalysis.analysis_result: null(),
+        SkinAnalysis.status: 'failed',
+    }, synchronize_session=False)
+    db.session.commit()
+    if failed:
+        logging.warning(f"Marked {failed} skin analysis job(s) pending for over {STALE_MINUTES:g} minutes as failed")
+    return failed
+
+
+def _run_analysis(app, analysis_id, image_bytes, folder, submitted_at):
+    from models import SkinAnalysis
+
+    with app.app_context(), stage_timer() as timer:
+        timer.add('queue_wait', time.perf_counter() - submitted_at)
+        analysis = db.session.get(SkinAnalysis, analysis_id)
+        if analysis is None:
+            logging.warning(f"Skin analysis job {analysis_id}: row not found")
+            return
+        if not analysis.is_pending:
+            # Đã bị đánh dấu failed vì nằm trong hàng đợi quá lâu
+            logging.warning(f"Skin analysis job {analysis_id}: already {analysis.status}, skipped")
+            return
+
+        try:
+            analysis.status = 'processing'
+            with timed('db_commit'):
+                db.session.commit()
+
+            with timed('upload'):
+                upload_result = cloudinary.uploader.upload(image_bytes, folder=folder, resource_type="auto")
+            image_url = upload_result.get('secure_url')
+            if not image_url:
+                raise RuntimeError("Cloudinary upload returned no URL")
+
+            analysis.image_url = image_url
+            with timed('db_commit'):
+                db.session.commit()
+
+            # Phân tích trực tiếp trên bytes đã có, không tải lại ảnh từ Cloudinary
+            with timed('analyze'):
+                analysis_result = face_analyzer.analyze_skin(image_bytes)
+
+            analysis_result['timings'] = timer.as_dict()
+            analysis.apply_result(analysis_result)
+            with timed('db_commit'):
+                db.session.commit()
+            logging.info(f"Skin analysis job {analysis_id} completed: {timer.as_dict()}")
+        except Exception as e:
+            logging.error(f"Skin analysis job {analysis_id} failed: {str(e)}")
+            db.session.rollback()
+            fallback = face_analyzer._get_fallback_analysis()
+            fallback['timings'] = timer.as_dict()
+            analysis.apply_result(fallback, status='failed')
+            db.session.commit()
+        finally:
+            timer.add('total', time.perf_counter() - submitted_at)
+            skin_analysis_stages.observe(timer.timings)
+            db.session.remove()
@@ -3,6 +3,7 @@ import logging
 import cloudinary
 import cloudinary.uploader
 from flask import Flask
+from markupsafe import Markup, escape
 from flask_login import LoginManager
 from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
@@ -20,8 +21,15 @@ cloudinary.config(
     secure=True
 )
 
-def create_app():
-    logging.basicConfig(level=logging.DEBUG)
+# Upload Cloudinary dùng chung pool kết nối keep-alive với các HTTP call khác
+from http_client import install_cloudinary_pool
+install_cloudinary_pool()
+
+def create_app(startup_tasks=True):
+    """Application factory; startup_tasks=False only creates missing tables, for migrations.py,
+    which migrates itself and must not run start-up work that needs the migrated schema"""
+    # Mức log lấy từ LOG_LEVEL (DEBUG, INFO, WARNING...); DEBUG in cả payload của Face++ nên chỉ bật khi cần
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
     app = Flask(__name__)
     app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-change-in-production")
     app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
@@ -66,6 +74,11 @@ def create_app():
     login_manager.login_view = 'auth.login'
     login_manager.login_message = 'Vui lòng đăng nhập để truy cập trang này.'
 
+    @app.template_filter('nl2br')
+    def nl2br(value):
+        # Giữ xuống dòng của tin nhắn chat, phần còn lại vẫn được escape
+        return Markup('<br>').join(escape(value or '').split('\n'))
+
     @login_manager.user_loader
     def load_user(user_id):
         from models import User
@@ -74,6 +87,22 @@ def create_app():
     with app.app_context():
         from models import User, Product, Category, BlogPost, SkinAnalysis, Order, Review, ChatMessage, OrderItem, BlogComment
         db.create_all()
+        # Cột mới và index trên bảng đã có (xem migrations.py). Trên PostgreSQL mặc định chạy
+        # `python migrations.py` lúc deploy: CREATE INDEX CONCURRENTLY không được chạy khi các worker đang khởi động
+        auto_migrate = os.environ.get('AUTO_MIGRATE', '').lower()
+        if startup_tasks and (auto_migrate == 'true' or (auto_migrate != 'false' and db.engine.dialect.name != 'postgresql')):
+            from migrations import upgrade
+            upgrade()
+            # Job phân tích của worker cũ không còn chạy nữa: đưa các dòng quá hạn về trạng thái failed.
+            # Chỉ chạy sau upgrade() vì cần các cột mới của skin_analysis; không migrate lúc khởi động
+            # (PostgreSQL) thì analysis_status/analysis_results xử lý từng dòng khi được mở
+            from analysis_jobs import fail_stale_analyses
+            fail_stale_analyses()
+        # Index tìm kiếm toàn văn (FTS5 trên SQLite, tsvector/GIN trên PostgreSQL)
+        if startup_tasks:
+            from search_index import product_search, blog_search
+            product_search.ensure(db.engine, Product)
+            blog_search.ensure(db.engine, BlogPost)
         from routes import main_bp, auth_bp, products_bp, chat_bp, blog_bp
         app.register_blueprint(main_bp)
         app.register_blueprint(auth_bp, url_prefix='/auth')
@@ -0,0 +1,72 @@
+"""
+Move SkinAnalysis rows created before the compact summary to the new layout.
+
+    python backfill_analysis_summary.py [--batch-size 200] [--keep-legacy]
+
+For each row that still only has the full analysis_result JSON, this writes
+the versioned summary, moves the raw Face++ skin_analysis into a compressed
+skin_analysis_payload row and (unless --keep-legacy) clears analysis_result.
+Safe to re-run: rows that already have a summary are skipped. The summary
+column and payload table themselves are created at app start-up.
+"""
+
+import sys
+import logging
+import argparse
+
+from sqlalchemy import null
+from sqlalchemy.orm import undefer, selectinload
+
+
+def backfill(batch_size=200, keep_legacy=False):
+    from app import create_app
+    from extensions import db
+    from models import SkinAnalysis, SkinAnalysisPayload, summarize_analysis_result
+
+    app = create_app()
+    migrated = 0
+    with app.app_context():
+        last_id = 0
+        while True:
+            rows = SkinAnalysis.query.filter(
+                SkinAnalysis.id > last_id,
+                SkinAnalysis.summary.is_(None),
+                SkinAnalysis.analysis_result.isnot(None)
+            ).options(
+                undefer(SkinAnalysis.analysis_result),
+                selectinload(SkinAnalysis.payload)
+            ).order_by(SkinAnalysis.id).limit(batch_size).all()
+            if not rows:
+                break
+
+            for row in rows:
+                last_id = row.id
+                result = row.analysis_result or {}
+                row.summary = summarize_analysis_result(result)
+                raw = result.get('skin_analysis')
+                if raw is not None and row.payload is None:
+                    row.payload = SkinAnalysisPayload(data=SkinAnalysisPayload.compress(raw))
+                if not keep_legacy:
+                    row.analysis_result = null()
+
+            db.session.commit()
+            migrated += len(rows)
+            logging.info(f"Backfilled {migrated} analyses (last id {last_id})")
+
+    return migrated
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Backfill SkinAnalysis.summary and skin_analysis_payload')
+    parser.add_argument('--batch-size', type=int, default=200, help='Rows per transaction')
+    parser.add_argument('--keep-legacy', action='store_true', help='Keep the old analysis_result JSON on each row')
+    args = parser.parse_args(argv)
+
+    migrated = backfill(args.batch_size, args.keep_legacy)
+    print(f"✅ Backfilled {migrated} skin analyses")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
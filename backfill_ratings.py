@@ -0,0 +1,53 @@
+"""
+Recompute the rating aggregates on every product from the review table.
+
+    python backfill_ratings.py
+
+Run once after deploying the rating_count / rating_sum / rating_1..rating_5
+columns (they are added at app start-up with a default of 0), and again
+whenever reviews were changed outside add_review. It is a single UPDATE with
+correlated subqueries, so it is safe to re-run and runs inside one transaction.
+"""
+
+import sys
+import logging
+
+from sqlalchemy import func, select
+
+
+def backfill():
+    from app import create_app
+    from extensions import db
+    from models import Product, Review
+
+    app = create_app()
+    with app.app_context():
+        product = Product.__table__
+        review = Review.__table__
+
+        def count_where(*conditions):
+            return (select(func.count()).select_from(review)
+                    .where(review.c.product_id == product.c.id, *conditions).scalar_subquery())
+
+        values = {
+            product.c.rating_count: count_where(),
+            product.c.rating_sum: (select(func.coalesce(func.sum(review.c.rating), 0))
+                                   .where(review.c.product_id == product.c.id).scalar_subquery()),
+        }
+        for stars in range(1, 6):
+            values[product.c[f'rating_{stars}']] = count_where(review.c.rating == stars)
+
+        result = db.session.execute(product.update().values(values))
+        db.session.commit()
+        return result.rowcount
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    updated = backfill()
+    print(f"✅ Recomputed rating aggregates for {updated} products")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+"""
+Batch skin analysis: re-analyze a directory of images or a JSONL manifest of image URLs.
+
+    python batch_analyze.py photos/ -o results.jsonl
+    python batch_analyze.py --manifest images.jsonl -o results.jsonl --resume --write-db
+
+Manifest lines look like {"id": "...", "url": "https://...", "analysis_id": 12};
+only "url" (an http(s) URL or a local path) is required. Images are loaded and
+normalized in a process pool, analyzed through the shared Face++ rate limiter
+and streamed to the output JSONL. The output file doubles as the checkpoint:
+with --resume, ids already written without an error are skipped (fallback
+results are written with an error, so they are analyzed again). With
+--write-db, successful results for entries with an analysis_id are written
+back to their SkinAnalysis rows in batches, and their output lines are only
+written once that batch has been committed, so --resume never skips an id
+whose row was not updated.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from image_utils import load_image_bytes, normalize_image
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+
+def iter_directory(path):
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                full_path = os.path.join(root, name)
+                yield {'id': os.path.relpath(full_path, path), 'url': full_path}
+
+
+def iter_manifest(path):
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if not entry.get('url'):
+                logging.warning(f"Manifest line {line_number} has no url, skipping")
+                continue
+            entry.setdefault('id', entry['url'])
+            yield entry
+
+
+def load_checkpoint(output_path):
+    """Ids already written to the output without an error"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # dòng cuối có thể bị ghi dở khi process bị dừng
+            if 'error' not in record:
+                done.add(record['id'])
+    return done
+
+
+def load_and_normalize(entry):
+    """Process-pool worker: fetch and normalize one image"""
+    try:
+        image_bytes = load_image_bytes(entry['url'])
+        if image_bytes is None:
+            return entry, None, 'download failed'
+        return entry, normalize_image(image_bytes), None
+    except Exception as e:
+        return entry, None, str(e)
+
+
+class DatabaseWriter:
+    """Write successful results back to SkinAnalysis rows, batch_size rows per transaction;
+    on_commit(records) receives the checkpoint records of each batch once it is committed"""
+
+    def __init__(self, batch_size, on_commit=None):
+        from app import create_app
+        self.app = create_app()
+        self.batch_size = batch_size
+        self.on_commit = on_commit
+        self.pending = {}
+        self.records = []
+        self.written = 0
+
+    def add(self, analysis_id, result, record=None):
+        self.pending[int(analysis_id)] = result
+        if record is not None:
+            self.records.append(record)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        from extensions import db
+        from sqlalchemy.orm import selectinload
+        from models import SkinAnalysis
+        with self.app.app_context():
+            rows = SkinAnalysis.query.filter(SkinAnalysis.id.in_(list(self.pending))).options(
+                selectinload(SkinAnalysis.payload)
+            ).all()
+            for row in rows:
+                row.apply_result(self.pending[row.id])
+            db.session.commit()
+            self.written += len(rows)
+            missing = len(self.pending) - len(rows)
+            if missing:
+                logging.warning(f"{missing} analysis_id(s) in this batch have no SkinAnalysis row")
+        self.pending.clear()
+        records, self.records = self.records, []
+        if self.on_commit is not None:
+            self.on_commit(records)
+
+
+def run(entries, args):
+    from face_analysis import face_analyzer
+
+    if args.backend:
+        from skin_backends import get_backend
+        face_analyzer.backend = get_backend(args.backend, face_analyzer)
+    if args.no_fallback:
+        face_analyzer.fallback_backend = None
+    # Chạy batch thì chờ rate limiter bao lâu cũng được, không rơi về fallback
+    face_analyzer.client.rate_limit_timeout = None
+
+    db_writer = DatabaseWriter(args.db_batch_size) if args.write_db else None
+
+    def analyze(entry, normalized):
+        started = time.time()
+        image_bytes, width, height = normalized
+        result = face_analyzer.analyze_normalized(image_bytes, width, height)
+        return entry, result, time.time() - started
+
+    stats = {'processed': 0, 'succeeded': 0, 'errors': 0}
+    started = time.time()
+    last_report = started
+    max_in_flight = max(args.processes, args.concurrency) * 4
+    entries = iter(entries)
+    normalizing, analyzing = set(), set()
+
+    with open(args.output, 'a', encoding='utf-8') as out, \
+            ProcessPoolExecutor(max_workers=args.processes) as process_pool, \
+            ThreadPoolExecutor(max_workers=args.concurrency) as analyzer_pool:
+
+        def write(record):
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            out.flush()
+            stats['processed'] += 1
+            if 'error' in record:
+                stats['errors'] += 1
+
+        def write_committed(records):
+            for record in records:
+                write(record)
+
+        if db_writer:
+            # Checkpoint chỉ ghi sau khi batch đã commit: bị dừng giữa chừng thì --resume chạy lại các dòng chưa vào CSDL
+            db_writer.on_commit = write_committed
+
+        def refill():
+            # Giới hạn số ảnh đang xử lý để bộ nhớ không tăng theo kích thước kho ảnh
+            while len(normalizing) + len(analyzing) < max_in_flight:
+                entry = next(entries, None)
+                if entry is None:
+                    return
+                normalizing.add(process_pool.submit(load_and_normalize, entry))
+
+        refill()
+        while normalizing or analyzing:
+            done, _ = wait(normalizing | analyzing, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in normalizing:
+                    normalizing.discard(future)
+                    entry, normalized, error = future.result()
+                    if error:
+                        write({'id': entry['id'], 'url': entry['url'], 'error': error})
+                    else:
+                        analyzing.add(analyzer_pool.submit(analyze, entry, normalized))
+                    continue
+
+                analyzing.discard(future)
+                try:
+                    entry, result, elapsed = future.result()
+                except Exception as e:
+                    logging.error(f"Analysis failed: {e}")
+                    stats['processed'] += 1
+                    stats['errors'] += 1
+                    continue
+
+                record = {
+                    'id': entry['id'],
+                    'url': entry['url'],
+                    'analysis_id': entry.get('analysis_id'),
+                    'elapsed_ms': round(elapsed * 1000, 1),
+                    'result': result,
+                }
+                if not result.get('success'):
+                    # Kết quả dự phòng (Face++ lỗi...): ghi error để --resume phân tích lại
+                    record['error'] = result.get('error') or 'analysis failed'
+                if result.get('success'):
+                    stats['succeeded'] += 1
+                if db_writer and result.get('success') and entry.get('analysis_id') is not None:
+                    db_writer.add(entry['analysis_id'], result, record)
+                else:
+                    write(record)
+
+            refill()
+
+            now = time.time()
+            if now - last_report >= args.report_every:
+                rate = stats['processed'] / (now - started)
+                logging.info(f"Processed {stats['processed']} images ({rate:.2f} images/s), "
+                             f"{stats['succeeded']} succeeded, {stats['errors']} errors")
+                last_report = now
+
+        if db_writer:
+            db_writer.flush()
+            stats['db_rows_written'] = db_writer.written
+
+    elapsed = time.time() - started
+    stats['seconds'] = round(elapsed, 2)
+    stats['images_per_second'] = round(stats['processed'] / elapsed, 3) if elapsed > 0 else 0.0
+    return stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Batch skin analysis to JSONL')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('directory', nargs='?', help='Directory of images to analyze (walked recursively)')
+    source.add_argument('--manifest', help='JSONL manifest of {"id", "url", "analysis_id"} entries')
+    parser.add_argument('-o', '--output', required=True, help='JSONL file results are appended to')
+    parser.add_argument('--resume', action='store_true', help='Skip ids already written to the output without an error')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 2, help='Image normalization processes')
+    parser.add_argument('--concurrency', type=int, default=2, help='Concurrent analyzer calls')
+    parser.add_argument('--backend', help='Override SKIN_ANALYZER_BACKEND (facepp or local)')
+    parser.add_argument('--no-fallback', action='store_true', help='Do not fall back to the secondary backend')
+    parser.add_argument('--write-db', action='store_true', help='Write successful results back to SkinAnalysis rows')
+    parser.add_argument('--db-batch-size', type=int, default=50, help='Rows per database transaction')
+    parser.add_argument('--limit', type=int, help='Stop after this many images')
+    parser.add_argument('--report-every', type=float, default=10.0, help='Seconds between progress reports')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(argv)
+
+    entries = iter_manifest(args.manifest) if args.manifest else iter_directory(args.directory)
+
+    if args.resume:
+        done = load_checkpoint(args.output)
+        logging.info(f"Resuming: {len(done)} images already processed")
+        entries = (entry for entry in entries if entry['id'] not in done)
+    elif os.path.exists(args.output) and os.path.getsize(args.output) > 0:
+        logging.error(f"{args.output} already exists; use --resume to continue or choose another output file")
+        return 1
+
+    if args.limit:
+        entries = (entry for _, entry in zip(range(args.limit), entries))
+
+    stats = run(entries, args)
+    print(json.dumps(stats, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
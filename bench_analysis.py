@@ -0,0 +1,312 @@
+"""
+Latency/throughput benchmark for the skin analysis path.
+
+    # In-process FaceAnalyzer.analyze_skin against a local Face++ stub
+    python bench_analysis.py analyzer --stub --images photos/ --concurrency 1,4,8 --requests 40 -o before.json
+
+    # End-to-end through a running app: POST /skin-analysis, then long-poll /analysis-status
+    python bench_analysis.py route --base-url http://127.0.0.1:5000 --email a@b.c --password secret \
+        --images photos/ --concurrency 1,4 --requests 20 -o after.json
+
+    # Compare two runs (e.g. before and after a commit)
+    python bench_analysis.py compare before.json after.json
+
+Each concurrency level reports p50/p95/p99/mean latency, throughput and the
+success rate. Results are written as JSON together with the git commit, so
+runs from different commits can be compared. In analyzer mode the analysis
+cache, rate limiter and circuit breaker are off unless --with-cache /
+--with-rate-limit / --with-breaker is given, so the numbers measure the
+analysis path itself.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+
+def load_images(directory, limit=50):
+    """Raw bytes of up to limit images, or one synthetic 1200x900 JPEG if no directory is given"""
+    if not directory:
+        import io
+        from PIL import Image
+        rng = np.random.default_rng(0)
+        pixels = np.clip(rng.normal((200, 160, 140), 25, (900, 1200, 3)), 0, 255).astype('uint8')
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format='JPEG', quality=92)
+        return [('synthetic.jpg', buffer.getvalue())]
+
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+            with open(os.path.join(directory, name), 'rb') as f:
+                images.append((name, f.read()))
+        if len(images) >= limit:
+            break
+    if not images:
+        raise SystemExit(f"No images found in {directory}")
+    return images
+
+
+def summarize(latencies, failures, wall_seconds, outcomes):
+    """Latency percentiles are over successful requests only (None if there were none)"""
+    total = len(latencies) + failures
+    stats = {
+        'requests': total,
+        'succeeded': total - failures,
+        'success_rate': round((total - failures) / total, 4) if total else 0.0,
+        'throughput_rps': round(total / wall_seconds, 3) if wall_seconds > 0 else 0.0,
+        'outcomes': dict(outcomes),
+    }
+    values = np.array(latencies) * 1000
+    for key, value in (
+        ('p50_ms', lambda: np.percentile(values, 50)),
+        ('p95_ms', lambda: np.percentile(values, 95)),
+        ('p99_ms', lambda: np.percentile(values, 99)),
+        ('mean_ms', values.mean),
+        ('max_ms', values.max),
+    ):
+        stats[key] = round(float(value()), 1) if latencies else None
+    return stats
+
+
+def run_level(task, images, concurrency, requests_count):
+    """Run requests_count calls of task(image_bytes) with concurrency threads"""
+    latencies, outcomes = [], Counter()
+    failures = 0
+
+    def one(i):
+        name, image_bytes = images[i % len(images)]
+        started = time.perf_counter()
+        try:
+            ok, outcome = task(image_bytes)
+        except Exception as e:
+            logging.warning(f"Request for {name} raised: {e}")
+            ok, outcome = False, 'exception'
+        return ok, outcome, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for ok, outcome, elapsed in pool.map(one, range(requests_count)):
+            outcomes[outcome] += 1
+            if ok:
+                latencies.append(elapsed)
+            else:
+                failures += 1
+    return summarize(latencies, failures, time.perf_counter() - started, outcomes)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def analyzer_task(args):
+    """analyze_skin() in this process, optionally against a local stub"""
+    if args.stub:
+        import facepp_stub
+        port = free_port()
+        behaviour = facepp_stub.ReplayBehaviour(
+            facepp_stub.load_recordings(args.stub_recordings),
+            latency_ms={'detect': args.stub_detect_latency, 'skinanalyze': args.stub_skin_latency},
+            jitter_ms=args.stub_jitter,
+            error_rate=args.stub_error_rate,
+            error_status=503,
+            seed=0,
+        )
+        facepp_stub.start_server(port=port, behaviour=behaviour)
+        # FaceAnalyzer đọc cấu hình lúc import nên phải đặt biến môi trường trước
+        os.environ['FACEPP_BASE_URL'] = f'http://127.0.0.1:{port}'
+        os.environ.setdefault('FACEPP_API_KEY', 'stub')
+        os.environ.setdefault('FACEPP_API_SECRET', 'stub')
+
+    from face_analysis import face_analyzer
+    from analysis_cache import analysis_cache
+
+    if not args.with_cache:
+        analysis_cache.enabled = False
+    if not args.with_rate_limit:
+        face_analyzer.client.rate_limiter = None
+    if not args.with_breaker:
+        face_analyzer.circuit_breaker = None
+        face_analyzer.client.circuit_breaker = None
+
+    def task(image_bytes):
+        result = face_analyzer.analyze_skin(image_bytes)
+        return bool(result.get('success')), result.get('backend') or 'fallback'
+
+    return task
+
+
+def route_task(args):
+    """POST /skin-analysis on a running app and wait until the background job finishes"""
+    import threading
+    import requests
+
+    base_url = args.base_url.rstrip('/')
+    local = threading.local()
+    csrf_pattern = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+    def csrf_token(session, path):
+        match = csrf_pattern.search(session.get(base_url + path, timeout=30).text)
+        return match.group(1) if match else ''
+
+    def get_session():
+        # Mỗi thread đăng nhập bằng session riêng
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            response = session.post(base_url + '/auth/login', data={
+                'csrf_token': csrf_token(session, '/auth/login'),
+                'email': args.email,
+                'password': args.password,
+            }, timeout=30)
+            if '/auth/login' in response.url:
+                raise SystemExit("Login failed; check --email/--password")
+            local.session = session
+        return session
+
+    def task(image_bytes):
+        session = get_session()
+        response = session.post(base_url + '/skin-analysis', data={
+            'csrf_token': csrf_token(session, '/skin-analysis'),
+        }, files={'skin_image': ('bench.jpg', image_bytes, 'image/jpeg')}, allow_redirects=False, timeout=60)
+        match = re.search(r'/analysis-results/(\d+)', response.headers.get('Location', ''))
+        if not match:
+            return False, f'http_{response.status_code}'
+
+        deadline = time.time() + args.route_timeout
+        while time.time() < deadline:
+            status = session.get(f"{base_url}/analysis-status/{match.group(1)}",
+                                 params={'wait': 20}, timeout=30).json()
+            if status['ready']:
+                return status['status'] == 'completed', status['status']
+        return False, 'timeout'
+
+    return task
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    images = load_images(args.images)
+    task = analyzer_task(args) if args.mode == 'analyzer' else route_task(args)
+
+    if args.warmup:
+        run_level(task, images, 1, args.warmup)
+
+    levels = []
+    for concurrency in args.concurrency:
+        stats = run_level(task, images, concurrency, args.requests)
+        stats['concurrency'] = concurrency
+        levels.append(stats)
+        print(f"c={concurrency:<3} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms "
+              f"p99={stats['p99_ms']}ms {stats['throughput_rps']:.2f} req/s "
+              f"ok={stats['success_rate']:.0%} {stats['outcomes']}")
+
+    return {
+        'mode': args.mode,
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'images': len(images),
+        'requests_per_level': args.requests,
+        'stub': bool(args.stub) if args.mode == 'analyzer' else None,
+        'levels': levels,
+    }
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{before.get('commit')} -> {after.get('commit')} ({after['mode']})")
+    before_levels = {level['concurrency']: level for level in before['levels']}
+    for level in after['levels']:
+        old = before_levels.get(level['concurrency'])
+        if old is None:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps'):
+            if old[key] is None or level[key] is None:
+                changes.append(f"{key} {old[key]} -> {level[key]}")
+                continue
+            delta = (level[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            changes.append(f"{key} {old[key]} -> {level[key]} ({delta:+.1f}%)")
+        print(f"c={level['concurrency']}: " + ', '.join(changes))
+
+
+def parse_concurrency(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Skin analysis latency benchmark')
+    parser.add_argument('mode', choices=('analyzer', 'route', 'compare'))
+    parser.add_argument('files', nargs='*', help='compare: before.json after.json')
+    parser.add_argument('--images', help='Directory of test images (default: one synthetic image)')
+    parser.add_argument('--concurrency', type=parse_concurrency, default=[1, 4, 8], help='Comma-separated levels')
+    parser.add_argument('--requests', type=int, default=40, help='Requests per concurrency level')
+    parser.add_argument('--warmup', type=int, default=2, help='Sequential warm-up requests (not measured)')
+    parser.add_argument('-o', '--output', help='Write results JSON here')
+    analyzer = parser.add_argument_group('analyzer mode')
+    analyzer.add_argument('--stub', action='store_true', help='Start a facepp_stub server and point Face++ calls at it')
+    analyzer.add_argument('--stub-recordings', help='Recordings JSONL for the stub')
+    analyzer.add_argument('--stub-detect-latency', type=float, default=300)
+    analyzer.add_argument('--stub-skin-latency', type=float, default=900)
+    analyzer.add_argument('--stub-jitter', type=float, default=100)
+    analyzer.add_argument('--stub-error-rate', type=float, default=0.0)
+    analyzer.add_argument('--with-cache', action='store_true', help='Keep the analysis cache enabled')
+    analyzer.add_argument('--with-rate-limit', action='store_true', help='Keep the Face++ rate limiter')
+    analyzer.add_argument('--with-breaker', action='store_true', help='Keep the circuit breaker')
+    route = parser.add_argument_group('route mode')
+    route.add_argument('--base-url', default='http://127.0.0.1:5000')
+    route.add_argument('--email')
+    route.add_argument('--password')
+    route.add_argument('--route-timeout', type=float, default=120, help='Seconds to wait for one analysis')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.WARNING)
+    args = parse_args(argv)
+
+    if args.mode == 'compare':
+        if len(args.files) != 2:
+            print("compare needs two result files")
+            return 2
+        compare(*args.files)
+        return 0
+
+    if args.mode == 'route' and not (args.email and args.password):
+        print("route mode needs --email and --password of an existing user")
+        return 2
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Benchmark product recommendation on a synthetic catalog.
+
+    python bench_recommender.py                       # 50k products, 2000 analyses
+    python bench_recommender.py --products 200000 --queries 5000
+
+Builds the product x feature matrix from random products (skin type,
+ingredient list drawn from common actives and fillers, category, rating),
+then times recommend-equivalent scoring (analysis vector + one matrix-vector
+product + top-k) for random analyses, and a 100-row incremental refresh.
+Exits with status 1 if p99 of the top-k step is above --budget-ms.
+"""
+
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from recommender import ProductRecommender, analysis_vector, SKIN_TYPES, CONCERN_PREFERENCES
+
+FILLERS = ('Aqua', 'Glycerin', 'Butylene Glycol', 'Dimethicone', 'Phenoxyethanol', 'Fragrance', 'Xanthan Gum',
+           'Cetearyl Alcohol', 'Caprylic Triglyceride', 'Tocopherol')
+ACTIVES = ('Salicylic Acid', 'Niacinamide', 'Zinc PCA', 'Retinol', 'Ascorbic Acid', 'Hyaluronic Acid',
+           'Ceramide NP', 'Centella Asiatica', 'Caffeine', 'Glycolic Acid', 'Arbutin', 'Peptide Complex',
+           'Kaolin', 'Tea Tree Oil', 'Titanium Dioxide', 'Panthenol')
+CATEGORIES = ('Sữa rửa mặt', 'Kem dưỡng ẩm', 'Serum', 'Kem chống nắng', 'Mặt nạ', 'Tẩy trang')
+
+
+def synthetic_rows(count, seed=0, start_id=1):
+    rng = np.random.default_rng(seed)
+    skin_types = SKIN_TYPES + ('all', 'all')
+    rows = []
+    for product_id in range(start_id, start_id + count):
+        ingredients = list(rng.choice(FILLERS, 5, replace=False)) + list(rng.choice(ACTIVES, rng.integers(0, 4),
+                                                                                   replace=False))
+        rating_count = int(rng.integers(0, 50))
+        rows.append((
+            product_id,
+            skin_types[rng.integers(len(skin_types))],
+            ', '.join(ingredients),
+            CATEGORIES[rng.integers(len(CATEGORIES))],
+            rating_count * float(rng.uniform(3, 5)),
+            rating_count,
+            bool(rng.random() > 0.05),
+        ))
+    return rows
+
+
+def random_analysis(rng):
+    concerns = list(rng.choice(list(CONCERN_PREFERENCES), rng.integers(0, 4), replace=False))
+    severities = {concern: float(rng.uniform(0.3, 1.0)) for concern in concerns}
+    return SKIN_TYPES[rng.integers(len(SKIN_TYPES))], concerns, int(rng.integers(16, 60)), severities
+
+
+def percentile_ms(samples, q):
+    return float(np.percentile(np.array(samples) * 1000, q))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Recommendation scoring benchmark')
+    parser.add_argument('--products', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('-k', type=int, default=6)
+    parser.add_argument('--budget-ms', type=float, default=5.0, help='Maximum p99 of one recommendation')
+    args = parser.parse_args(argv)
+
+    rows = synthetic_rows(args.products)
+    recommender = ProductRecommender()
+    started = time.perf_counter()
+    recommender.load(rows)
+    print(f"Built {args.products}x{recommender._state[1].shape[0]} matrix in "
+          f"{(time.perf_counter() - started) * 1000:.0f} ms")
+
+    rng = np.random.default_rng(1)
+    analyses = [random_analysis(rng) for _ in range(args.queries)]
+    timings = []
+    for skin_type, concerns, age, severities in analyses:
+        started = time.perf_counter()
+        vector = analysis_vector(skin_type, concerns, age, severities)
+        recommender.top_k(vector, k=args.k, skin_type=skin_type)
+        timings.append(time.perf_counter() - started)
+
+    p50, p99 = percentile_ms(timings, 50), percentile_ms(timings, 99)
+    print(f"recommend: p50={p50:.2f} ms p99={p99:.2f} ms max={max(timings) * 1000:.2f} ms "
+          f"({args.queries} analyses, k={args.k})")
+
+    # Làm mới 100 dòng: 50 sản phẩm sửa, 50 sản phẩm mới
+    changed = synthetic_rows(50, seed=2, start_id=1) + synthetic_rows(50, seed=3, start_id=args.products + 1)
+
+    class Rows:
+        def __init__(self, rows):
+            self.rows = rows
+
+        def all(self):
+            return self.rows
+
+    recommender._rows_query = lambda session, ids=None: Rows(changed)
+    started = time.perf_counter()
+    recommender.refresh(None, [row[0] for row in changed])
+    print(f"refresh of 100 products: {(time.perf_counter() - started) * 1000:.1f} ms "
+          f"(matrix now {recommender._state[1].shape[1]} products)")
+
+    if p99 > args.budget_ms:
+        print(f"❌ p99 {p99:.2f} ms is over the {args.budget_ms} ms budget")
+        return 1
+    print(f"✅ p99 within {args.budget_ms} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
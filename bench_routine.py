@@ -0,0 +1,131 @@
+"""
+Compare the precompiled routine table with the old imperative _generate_routine.
+
+    python bench_routine.py              # equivalence check + benchmark
+    python bench_routine.py --check-only
+
+The equivalence check runs every skin type (plus unknown ones), every subset of
+the concerns the analyzer can report and ages around the 30 boundary, and
+exits with status 1 on the first mismatch.
+"""
+
+import sys
+import json
+import timeit
+import argparse
+from itertools import chain, combinations
+
+from routine_rules import get_routine, FrozenRoutine
+
+SKIN_TYPES = ('oily', 'dry', 'sensitive', 'normal', 'combination', 'unknown')
+CONCERNS = ('acne', 'blackheads', 'dark_circles', 'dark_spots', 'wrinkles',
+            'large_pores', 'healthy_skin', 'dryness')
+AGES = (0, 18, 25, 29, 30, 30.5, 31, 45, 80)
+
+
+def legacy_generate_routine(skin_type, concerns, age):
+    """_generate_routine as it was before the rule table"""
+    routine = {
+        'morning': [],
+        'evening': [],
+        'weekly': []
+    }
+
+    routine['morning'].extend([
+        'Sữa rửa mặt nhẹ nhàng',
+        'Toner cân bằng da',
+        'Serum vitamin C',
+        'Kem dưỡng ẩm',
+        'Kem chống nắng SPF 30+'
+    ])
+
+    routine['evening'].extend([
+        'Tẩy trang (nếu có makeup)',
+        'Sữa rửa mặt',
+        'Toner',
+        'Serum phục hồi da',
+        'Kem dưỡng ẩm ban đêm'
+    ])
+
+    if skin_type == 'oily':
+        routine['morning'][1] = 'Toner kiểm soát dầu'
+        routine['evening'].insert(3, 'BHA/Salicylic Acid (2-3 lần/tuần)')
+
+    elif skin_type == 'dry':
+        routine['morning'].insert(3, 'Serum hyaluronic acid')
+        routine['evening'].insert(3, 'Dầu dưỡng da')
+
+    elif skin_type == 'sensitive':
+        routine['morning'][2] = 'Serum niacinamide'
+        routine['evening'][3] = 'Serum làm dịu da'
+
+    if 'acne' in concerns:
+        routine['evening'].append('Sản phẩm chấm mụn đặc trị')
+
+    if 'dark_spots' in concerns:
+        routine['evening'].insert(3, 'Serum làm sáng da')
+
+    if age > 30:
+        routine['evening'].insert(3, 'Serum chống lão hóa/retinol')
+        routine['weekly'].append('Mặt nạ chống lão hóa')
+
+    return routine
+
+
+def all_cases():
+    concern_sets = chain.from_iterable(combinations(CONCERNS, n) for n in range(len(CONCERNS) + 1))
+    concern_sets = [list(c) for c in concern_sets]
+    for skin_type in SKIN_TYPES:
+        for concerns in concern_sets:
+            for age in AGES:
+                yield skin_type, concerns, age
+
+
+def check_equivalence():
+    checked = 0
+    for skin_type, concerns, age in all_cases():
+        expected = legacy_generate_routine(skin_type, concerns, age)
+        actual = get_routine(skin_type, concerns, age)
+        # So sánh sau khi serialize JSON: tuple và list phải cho ra cùng một kết quả lưu DB
+        if not isinstance(actual, FrozenRoutine) or json.dumps(actual) != json.dumps(expected):
+            print(f"Mismatch for skin_type={skin_type!r} concerns={concerns} age={age}")
+            print(f"  legacy:   {expected}")
+            print(f"  compiled: {dict(actual)}")
+            return False, checked
+        checked += 1
+    return True, checked
+
+
+def benchmark(number):
+    cases = [
+        ('oily', ['acne', 'large_pores'], 24),
+        ('dry', ['wrinkles', 'dark_spots'], 42),
+        ('sensitive', ['healthy_skin'], 31),
+        ('normal', ['dark_circles'], 27),
+    ]
+    results = {}
+    for name, fn in (('legacy', legacy_generate_routine), ('compiled', get_routine)):
+        seconds = timeit.timeit(lambda: [fn(*case) for case in cases], number=number)
+        results[name] = seconds / (number * len(cases)) * 1e6
+        print(f"{name:>9}: {results[name]:.3f} µs/call")
+    print(f"  speedup: {results['legacy'] / results['compiled']:.1f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Routine table equivalence check and benchmark')
+    parser.add_argument('--check-only', action='store_true', help='Skip the benchmark')
+    parser.add_argument('--number', type=int, default=100000, help='Benchmark iterations')
+    args = parser.parse_args(argv)
+
+    ok, checked = check_equivalence()
+    if not ok:
+        return 1
+    print(f"Equivalent on {checked} combinations")
+
+    if not args.check_only:
+        benchmark(args.number)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+Normalized blog post tags.
+
+BlogPost.tags stays the comma-separated string the form edits and the
+templates show; on every flush the post's rows in post_tag (post -> Tag) are
+brought in line with it, so tag pages are an indexed join instead of a LIKE
+over every post. Migration 2 backfills post_tag from the existing strings.
+
+Related posts come from TagIndex, an inverted index (tag -> published posts)
+held in memory by each worker: it ranks posts by the tags they share with a
+post without a query. It is refreshed from blog_post_changes when posts are
+tagged, published or deleted, and rebuilt in full every
+BLOG_TAG_INDEX_REBUILD_SECONDS.
+"""
+
+import os
+import math
+import time
+import heapq
+import logging
+import threading
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from change_log import blog_post_changes
+
+REBUILD_SECONDS = int(os.environ.get('BLOG_TAG_INDEX_REBUILD_SECONDS', 3600))
+MAX_TAG_LENGTH = 50
+
+
+def normalize_tags(raw):
+    """Unique tag names of a comma-separated string, trimmed and lower-cased, in their original order"""
+    names = []
+    for part in (raw or '').split(','):
+        name = ' '.join(part.split()).lower()[:MAX_TAG_LENGTH]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def tags_by_name(session, names):
+    """{name: Tag} for these names, adding the tags that do not exist yet to the session"""
+    from models import Tag
+    names = set(names)
+    tags = {tag.name: tag for tag in session.query(Tag).filter(Tag.name.in_(names))} if names else {}
+    for name in names - tags.keys():
+        tags[name] = Tag(name=name)
+        session.add(tags[name])
+    return tags
+
+
+def sync_tags(model):
+    """Keep model.tag_list (its post_tag rows) in step with the model.tags string on every flush"""
+
+    def before_flush(session, flush_context, instances):
+        posts = [obj for obj in session.new if isinstance(obj, model)]
+        posts += [obj for obj in session.dirty
+                  if isinstance(obj, model) and inspect(obj).attrs.tags.history.has_changes()]
+        if not posts:
+            return
+        with session.no_autoflush:
+            tags = tags_by_name(session, {name for post in posts for name in normalize_tags(post.tags)})
+            for post in posts:
+                post.tag_list = [tags[name] for name in normalize_tags(post.tags)]
+
+    event.listen(Session, 'before_flush', before_flush)
+
+
+def backfill_tags(engine):
+    """Create the tag and post_tag rows of every post from its tags string; returns the post_tag rows added"""
+    from models import BlogPost, Tag, post_tag
+    tag = Tag.__table__
+    with engine.begin() as conn:
+        wanted = {post_id: normalize_tags(raw) for post_id, raw in conn.execute(
+            select(BlogPost.id, BlogPost.tags).where(BlogPost.tags.isnot(None))
+        )}
+        names = {name for post_names in wanted.values() for name in post_names}
+        ids = dict(conn.execute(select(tag.c.name, tag.c.id)).all())
+        missing = names - ids.keys()
+        if missing:
+            conn.execute(tag.insert(), [{'name': name} for name in sorted(missing)])
+            ids = dict(conn.execute(select(tag.c.name, tag.c.id)).all())
+
+        existing = set(conn.execute(select(post_tag.c.post_id, post_tag.c.tag_id)).all())
+        rows = [{'post_id': post_id, 'tag_id': ids[name]}
+                for post_id, post_names in wanted.items() for name in post_names
+                if (post_id, ids[name]) not in existing]
+        if rows:
+            conn.execute(post_tag.insert(), rows)
+    logging.info(f"Tags: backfilled {len(rows)} post tags ({len(missing)} new tags) from {len(wanted)} posts")
+    return len(rows)
+
+
+class TagIndex:
+    """Published posts of every tag, to rank related posts and list popular tags without a query"""
+
+    def __init__(self, change_log=blog_post_changes, rebuild_seconds=REBUILD_SECONDS):
+        self.change_log = change_log
+        self.rebuild_seconds = rebuild_seconds
+        self._lock = threading.Lock()
+        # (tag id -> id các bài, id bài -> tag id, tên -> tag id) được thay cả khối để luồng đọc không cần khóa
+        self._state = None
+        self._seq = 0
+        self._built_at = 0.0
+
+    # --- Building ---------------------------------------------------------------------
+
+    @staticmethod
+    def _rows_query(session, ids=None):
+        from models import BlogPost, Tag, post_tag
+        query = session.query(post_tag.c.post_id, Tag.id, Tag.name).join(
+            Tag, Tag.id == post_tag.c.tag_id
+        ).join(BlogPost, BlogPost.id == post_tag.c.post_id).filter(BlogPost.is_published == True)
+        if ids is not None:
+            query = query.filter(post_tag.c.post_id.in_(ids))
+        return query
+
+    def load(self, rows):
+        """Replace the index with these (post id, tag id, tag name) rows of published posts"""
+        posts_of_tag, tags_of_post, tag_of_name = {}, {}, {}
+        for post_id, tag_id, name in rows:
+            posts_of_tag.setdefault(tag_id, set()).add(post_id)
+            tags_of_post[post_id] = tags_of_post.get(post_id, ()) + (tag_id,)
+            tag_of_name[name] = tag_id
+        posts_of_tag = {tag_id: frozenset(posts) for tag_id, posts in posts_of_tag.items()}
+        self._state = (posts_of_tag, tags_of_post, tag_of_name)
+        self._built_at = time.monotonic()
+
+    def rebuild(self, session):
+        seq = self.change_log.latest()
+        started = time.perf_counter()
+        rows = self._rows_query(session).all()
+        self.load(rows)
+        self._seq = seq
+        logging.info(f"Tag index: loaded {len(rows)} post tags in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def refresh(self, session, changed_ids):
+        """Reload the tags of these posts (unpublished and deleted posts drop out)"""
+        posts_of_tag, tags_of_post, tag_of_name = (dict(part) for part in self._state)
+        for post_id in changed_ids:
+            for tag_id in tags_of_post.pop(post_id, ()):
+                posts_of_tag[tag_id] = posts_of_tag[tag_id] - {post_id}
+        for post_id, tag_id, name in self._rows_query(session, changed_ids).all():
+            posts_of_tag[tag_id] = posts_of_tag.get(tag_id, frozenset()) | {post_id}
+            tags_of_post[post_id] = tags_of_post.get(post_id, ()) + (tag_id,)
+            tag_of_name[name] = tag_id
+        self._state = (posts_of_tag, tags_of_post, tag_of_name)
+
+    def ensure_fresh(self, session):
+        with self._lock:
+            if self._state is None or time.monotonic() - self._built_at > self.rebuild_seconds:
+                self.rebuild(session)
+                return
+            seq, changed = self.change_log.since(self._seq)
+            if changed is None:
+                self.rebuild(session)
+            elif changed:
+                self.refresh(session, changed)
+                self._seq = seq
+
+    # --- Queries ----------------------------------------------------------------------
+
+    def related(self, tag_names, exclude=None, k=3):
+        """Ids of the k published posts sharing the most of these tags, best first.
+
+        Each shared tag counts log(1 + posts / posts with the tag), so sharing
+        a rare tag weighs more than sharing one every post has; ties go to the
+        newer post.
+        """
+        posts_of_tag, tags_of_post, tag_of_name = self._state
+        total = max(len(tags_of_post), 1)
+        scores = {}
+        for name in tag_names:
+            posts = posts_of_tag.get(tag_of_name.get(name), ())
+            if not posts:
+                continue
+            weight = math.log(1 + total / len(posts))
+            for post_id in posts:
+                scores[post_id] = scores.get(post_id, 0.0) + weight
+        scores.pop(exclude, None)
+        return [post_id for post_id, _ in heapq.nlargest(k, scores.items(), key=lambda item: (item[1], item[0]))]
+
+    def popular(self, k=8):
+        """Names of the k tags with the most published posts"""
+        posts_of_tag, _, tag_of_name = self._state
+        counts = [(len(posts_of_tag.get(tag_id, ())), name) for name, tag_id in tag_of_name.items()]
+        return [name for count, name in heapq.nlargest(k, counts) if count]
+
+
+# Mỗi worker giữ một chỉ mục
+tag_index = TagIndex()
@@ -0,0 +1,66 @@
+"""
+Pricing of the session cart.
+
+The cart in the session is {product id (string): quantity}. price_cart()
+loads every product of it with one `id IN (...)` query and computes the line
+totals and the order total once, so the cart page, checkout and the JSON
+cart endpoints no longer load the products one query per line (checkout used
+to do it three times per line).
+"""
+
+from sqlalchemy.orm import raiseload
+
+
+class CartLine:
+    """One product of the cart with its quantity and line total"""
+
+    def __init__(self, product, quantity):
+        self.product = product
+        self.quantity = quantity
+        self.total = product.price * quantity
+
+
+class CartPricing:
+    """Lines of a cart, in the order they were added, and their totals"""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.total = sum(line.total for line in lines)
+        self.item_count = sum(line.quantity for line in lines)
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def to_dict(self):
+        """Totals for the JSON cart endpoints, so the cart page can update without a reload"""
+        return {
+            'total': self.total,
+            'item_count': self.item_count,
+            'lines': {str(line.product.id): {'quantity': line.quantity, 'total': line.total} for line in self.lines},
+        }
+
+
+def cart_quantities(cart):
+    """{product id: quantity} of a session cart, skipping malformed keys and empty lines"""
+    quantities = {}
+    for key, quantity in (cart or {}).items():
+        try:
+            product_id, quantity = int(key), int(quantity)
+        except (TypeError, ValueError):
+            continue
+        if quantity > 0:
+            quantities[product_id] = quantity
+    return quantities
+
+
+def price_cart(cart):
+    """Price a session cart with one query for all of its products; products that no longer exist are left out"""
+    from models import Product
+    quantities = cart_quantities(cart)
+    if not quantities:
+        return CartPricing([])
+    products = {product.id: product for product in Product.query.filter(
+        Product.id.in_(quantities)
+    ).options(raiseload('*')).all()}
+    return CartPricing([CartLine(products[product_id], quantity)
+                        for product_id, quantity in quantities.items() if product_id in products])
@@ -0,0 +1,128 @@
+import logging
+import sqlite3
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+import shared_state
+
+
+class ChangeLog:
+    """Ids of model rows changed by committed transactions, readable by every worker process.
+
+    In-memory structures built from the database (recommendation matrices,
+    similarity indexes) call since() to learn which rows to reload instead of
+    rebuilding everything. Ids are collected during flush and only written
+    when the transaction commits, so a reader never reloads a row before the
+    change is visible to it. The log lives in a shared state file, so it
+    covers the workers of one host; rows changed by raw SQL or on another host
+    are picked up by the periodic full rebuild of the reader.
+    """
+
+    def __init__(self, name, filename='changes.sqlite3', keep=10000):
+        self.name = name
+        self.filename = filename
+        self.keep = keep
+        self._session_key = f'change_log:{name}'
+        self._listening = False
+
+    def watch(self, model, columns=None):
+        """Log inserts and deletes of model rows, and updates touching `columns` (all columns if None)"""
+        columns = tuple(columns) if columns else None
+
+        def changed(mapper, conn, target):
+            session = object_session(target)
+            if session is not None:
+                self.mark(session, target.id)
+
+        def updated(mapper, conn, target):
+            state = inspect(target)
+            names = columns or [attr.key for attr in mapper.column_attrs]
+            if any(state.attrs[name].history.has_changes() for name in names):
+                changed(mapper, conn, target)
+
+        event.listen(model, 'after_insert', changed)
+        event.listen(model, 'after_update', updated)
+        event.listen(model, 'after_delete', changed)
+
+        if not self._listening:
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_rollback', self._after_rollback)
+            self._listening = True
+
+    def mark(self, session, row_id):
+        """Log row_id when session commits; for changes made with Core statements, which mapper events don't see"""
+        session.info.setdefault(self._session_key, set()).add(row_id)
+
+    def _after_commit(self, session):
+        ids = session.info.pop(self._session_key, None)
+        if ids:
+            self.record(ids)
+
+    def _after_rollback(self, session):
+        session.info.pop(self._session_key, None)
+
+    def record(self, ids):
+        try:
+            with shared_state.immediate_transaction(self._conn()) as conn:
+                conn.executemany('INSERT INTO changes (log, row_id) VALUES (?, ?)',
+                                 [(self.name, row_id) for row_id in ids])
+                cutoff = conn.execute('SELECT MAX(seq) FROM changes').fetchone()[0] - self.keep
+                if conn.execute('DELETE FROM changes WHERE log = ? AND seq <= ?', (self.name, cutoff)).rowcount:
+                    conn.execute('INSERT OR REPLACE INTO trimmed (log, seq) VALUES (?, ?)', (self.name, cutoff))
+        except sqlite3.Error as e:
+            logging.warning(f"Change log {self.name}: could not record {len(ids)} ids ({e})")
+
+    def latest(self):
+        """Sequence number to pass to the first since() call"""
+        try:
+            return self._conn().execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+    def since(self, seq):
+        """(new seq, changed ids) after seq; ids is None if the log no longer goes back that far"""
+        try:
+            conn = self._conn()
+            rows = conn.execute('SELECT seq, row_id FROM changes WHERE log = ? AND seq > ? ORDER BY seq',
+                                (self.name, seq)).fetchall()
+            trimmed = conn.execute('SELECT seq FROM trimmed WHERE log = ?', (self.name,)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Change log {self.name}: could not read ({e})")
+            return seq, set()
+        if trimmed and trimmed[0] > seq:
+            # Các thay đổi ngay sau seq đã bị xóa khỏi log: người đọc phải build lại toàn bộ
+            return (rows[-1][0] if rows else trimmed[0]), None
+        if not rows:
+            return seq, set()
+        return rows[-1][0], {row_id for _, row_id in rows}
+
+    def position(self, reader):
+        """Last seq processed by a named reader that runs as a separate process (e.g. a cron job), or None"""
+        try:
+            row = self._conn().execute('SELECT seq FROM readers WHERE log = ? AND reader = ?',
+                                       (self.name, reader)).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def set_position(self, reader, seq):
+        self._conn().execute('INSERT OR REPLACE INTO readers (log, reader, seq) VALUES (?, ?, ?)',
+                             (self.name, reader, seq))
+
+    def _conn(self):
+        return shared_state.local_connection(self.filename, (
+            'CREATE TABLE IF NOT EXISTS changes ('
+            ' seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' log TEXT NOT NULL,'
+            ' row_id INTEGER NOT NULL)',
+            'CREATE INDEX IF NOT EXISTS idx_changes_log_seq ON changes (log, seq)',
+            'CREATE TABLE IF NOT EXISTS trimmed (log TEXT PRIMARY KEY, seq INTEGER NOT NULL)',
+            'CREATE TABLE IF NOT EXISTS readers (log TEXT NOT NULL, reader TEXT NOT NULL, seq INTEGER NOT NULL,'
+            ' PRIMARY KEY (log, reader))',
+        ))
+
+
+# Sản phẩm thêm/sửa/xóa qua ORM; các chỉ mục trong bộ nhớ (gợi ý sản phẩm...) đọc log này
+product_changes = ChangeLog('product')
+# Bài viết đổi tags/trạng thái xuất bản; chỉ mục tag trong bộ nhớ đọc log này
+blog_post_changes = ChangeLog('blog_post')
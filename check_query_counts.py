@@ -0,0 +1,162 @@
+"""
+Render the main pages against a throw-away SQLite database and fail if any of
+them issues more SQL statements than its budget.
+
+    python check_query_counts.py            # exit code 1 if a page is over budget
+    python check_query_counts.py -v         # also print every statement of each page
+
+The fixtures put enough rows on every page (reviews by different users, orders
+with several items, comments by different users...) that a lazy load inside a
+template loop blows the budget, so an N+1 regression fails CI instead of
+showing up as production latency. Budgets include the Flask-Login user lookup.
+"""
+
+import os
+import sys
+import tempfile
+import argparse
+from datetime import datetime, timedelta
+
+_tmp_dir = tempfile.mkdtemp(prefix='beautyai-querycount-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'app.db')}"
+os.environ.setdefault('BEAUTYAI_STATE_DIR', _tmp_dir)
+
+from sqlalchemy import event
+
+import similar_products
+from blog_tags import tag_index
+
+ROWS = 10
+
+# (tên trang, URL, cần đăng nhập, số câu lệnh SQL tối đa)
+PAGE_BUDGETS = [
+    ('products.index', '/products/', False, 3),
+    ('products.index (search)', '/products/?search=serum', False, 3),
+    ('products.detail', '/products/1', False, 3),
+    ('main.profile', '/profile', True, 5),
+    ('blog.index', '/blog/', False, 3),
+    ('blog.post_detail', '/blog/1', False, 3),
+    ('blog.tag', '/blog/tag/serum', False, 4),
+    ('chat.index', '/chat/', True, 2),
+    ('main.cart', '/cart', True, 2),
+    ('main.checkout', '/checkout', True, 2),
+]
+
+
+def seed():
+    from extensions import db
+    from models import User, Category, Product, Review, Order, OrderItem, BlogPost, BlogComment, ChatMessage
+
+    now = datetime.utcnow()
+    users = []
+    for i in range(ROWS + 1):
+        user = User(username=f'user{i}', email=f'user{i}@example.com', full_name=f'User {i}')
+        user.set_password('secret')
+        users.append(user)
+    db.session.add_all(users)
+
+    category = Category(name='Serum')
+    db.session.add(category)
+    db.session.flush()
+
+    products = [
+        Product(name=f'Serum {i}', brand=f'Brand {i}', price=100000 + i,
+                description='Hydrating serum' if i % 2 else 'Brightening serum with vitamin C',
+                category_id=category.id, skin_type='all', stock_quantity=10,
+                date_added=now - timedelta(days=i))
+        for i in range(ROWS + 2)
+    ]
+    db.session.add_all(products)
+    db.session.flush()
+
+    # Sản phẩm 1 có nhiều đánh giá từ nhiều người dùng khác nhau
+    for user in users[1:]:
+        db.session.add(Review(product_id=products[0].id, user_id=user.id, rating=4, content='Good'))
+        Product.add_rating(products[0].id, 4)
+    # Người dùng 0 có nhiều đơn hàng, mỗi đơn nhiều sản phẩm, và đánh giá nhiều sản phẩm
+    for i in range(ROWS // 2):
+        order = Order(user_id=users[0].id, total_amount=300000, shipping_address='HN', phone_number='0900000000',
+                      date_created=now - timedelta(days=i))
+        db.session.add(order)
+        db.session.flush()
+        for product in products[i:i + 3]:
+            db.session.add(OrderItem(order_id=order.id, product_id=product.id, quantity=1, price=product.price))
+    for product in products[1:ROWS // 2 + 1]:
+        db.session.add(Review(product_id=product.id, user_id=users[0].id, rating=5, content='Great'))
+        Product.add_rating(product.id, 5)
+
+    posts = [
+        BlogPost(title=f'Post {i}', content='Skin care tips ' * 20, excerpt='Tips', tags='skincare,serum' if i % 2 else 'skincare,sunscreen',
+                 author_id=users[i % len(users)].id, is_published=True, date_created=now - timedelta(days=i))
+        for i in range(ROWS)
+    ]
+    db.session.add_all(posts)
+    db.session.flush()
+    for user in users[1:]:
+        db.session.add(BlogComment(post_id=posts[0].id, user_id=user.id, content='Thanks'))
+
+    for i in range(ROWS):
+        db.session.add(ChatMessage(user_id=users[0].id, message=f'Message {i}', is_from_user=i % 2 == 0,
+                                   date_created=now + timedelta(minutes=i)))
+    db.session.commit()
+    # Các trang được đo khi chỉ mục trong bộ nhớ đã được tạo (một lần mỗi worker)
+    similar_products.rebuild_all(db.session)
+    tag_index.rebuild(db.session)
+    return users[0].id
+
+
+def log_in(client, user_id):
+    """Log the test client in as user_id, with a cart of several lines"""
+    with client.session_transaction() as sess:
+        sess['_user_id'] = str(user_id)
+        sess['_fresh'] = True
+        # Giỏ hàng nhiều dòng: mỗi dòng một truy vấn sẽ vượt ngân sách
+        sess['cart'] = {str(product_id): 2 for product_id in range(1, ROWS + 1)}
+
+
+def run(verbose=False):
+    from app import create_app
+    from extensions import db
+
+    app = create_app()
+    with app.app_context():
+        user_id = seed()
+        statements = []
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+    failures = 0
+    for name, url, login, budget in PAGE_BUDGETS:
+        client = app.test_client()
+        if login:
+            log_in(client, user_id)
+
+        statements.clear()
+        response = client.get(url)
+        count = len(statements)
+        ok = response.status_code == 200 and count <= budget
+        failures += not ok
+        print(f"{'✅' if ok else '❌'} {name:<26} {count:>3} / {budget} statements (HTTP {response.status_code})")
+        if verbose or not ok:
+            for statement in statements:
+                print('      ' + ' '.join(statement.split())[:160])
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check SQL statement budgets of the main pages')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every statement')
+    args = parser.parse_args(argv)
+
+    failures = run(args.verbose)
+    if failures:
+        print(f"❌ {failures} page(s) over their query budget")
+        return 1
+    print("✅ All pages within their query budget")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
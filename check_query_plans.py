@@ -0,0 +1,145 @@
+"""
+Render the main pages, EXPLAIN every SELECT they run and fail if one of them
+reads a whole table or sorts rows that an index could have returned in order.
+
+    python check_query_plans.py             # throw-away SQLite database
+    python check_query_plans.py -v          # print every plan
+    python check_query_plans.py --database-url postgresql://.../scratch_db
+
+The PostgreSQL run needs an EMPTY scratch database: fixture rows are inserted
+into it. Sequential scans are disabled for the EXPLAIN there, because with a
+few fixture rows the planner would rightly prefer them; what is checked is
+that an index exists that the query can use.
+
+The pages and fixtures are the ones of check_query_counts.py, plus a second
+page of the product and blog listings (keyset cursor).
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+
+import check_query_counts  # đặt DATABASE_URL tạm, phải nhập trước app
+from sqlalchemy import event
+
+# Bảng danh mục nhỏ, quét toàn bảng là bình thường
+LOOKUP_TABLES = {'category'}
+
+_SQLITE_SCAN = re.compile(r'^SCAN (\w+)(?! USING)')
+_SQLITE_TEMP_SORT = 'USE TEMP B-TREE FOR ORDER BY'
+
+
+def sqlite_problems(conn, statement, parameters):
+    problems = []
+    for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all():
+        detail = row[-1]
+        match = _SQLITE_SCAN.match(detail)
+        if match and 'VIRTUAL TABLE' not in detail and match.group(1) not in LOOKUP_TABLES:
+            problems.append(detail)
+        # Tìm kiếm toàn văn sắp xếp theo rank, không index nào cho thứ tự đó được
+        elif detail == _SQLITE_TEMP_SORT and ' MATCH ' not in statement:
+            problems.append(detail)
+    return problems
+
+
+def postgresql_problems(conn, statement, parameters):
+    conn.exec_driver_sql('SET enable_seqscan = off')
+    plan = conn.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+    plan = plan if isinstance(plan, list) else json.loads(plan)
+
+    problems = []
+
+    def walk(node):
+        if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') not in LOOKUP_TABLES:
+            problems.append(f"Seq Scan on {node.get('Relation Name')}")
+        for child in node.get('Plans', []):
+            walk(child)
+
+    walk(plan[0]['Plan'])
+    return problems
+
+
+def page_urls(app, db):
+    """The pages of check_query_counts.py plus page 2 of the cursor-paginated listings"""
+    from models import Product, BlogPost
+    from pagination import encode_cursor
+
+    urls = [(name, url, login) for name, url, login, _ in check_query_counts.PAGE_BUDGETS]
+    with app.test_request_context():
+        product = Product.query.filter_by(is_active=True).order_by(Product.date_added.desc()).first()
+        post = BlogPost.query.filter_by(is_published=True).order_by(BlogPost.date_created.desc()).first()
+        urls.append(('products.index (cursor)', '/products/?cursor=' +
+                     encode_cursor([product.date_added, product.id], 'next', 2), False))
+        urls.append(('blog.index (cursor)', '/blog/?cursor=' +
+                     encode_cursor([post.date_created, post.id], 'next', 2), False))
+    return urls
+
+
+def run(verbose=False):
+    from app import create_app
+    from extensions import db
+
+    app = create_app()
+    with app.app_context():
+        user_id = check_query_counts.seed()
+        urls = page_urls(app, db)
+        engine = db.engine
+    explain = postgresql_problems if engine.dialect.name == 'postgresql' else sqlite_problems
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and not executemany:
+            statements.append((statement, parameters))
+
+    failures = 0
+    for name, url, login in urls:
+        client = app.test_client()
+        if login:
+            check_query_counts.log_in(client, user_id)
+
+        statements.clear()
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            response = client.get(url)
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+
+        page_problems = []
+        with engine.connect() as conn:
+            for statement, parameters in statements:
+                problems = explain(conn, statement, parameters)
+                if problems or verbose:
+                    page_problems.append((statement, problems))
+            conn.rollback()
+
+        ok = response.status_code == 200 and not any(problems for _, problems in page_problems)
+        failures += not ok
+        print(f"{'✅' if ok else '❌'} {name:<26} {len(statements):>3} SELECTs (HTTP {response.status_code})")
+        for statement, problems in page_problems:
+            print('      ' + ' '.join(statement.split())[:160])
+            for problem in problems:
+                print(f"        ⚠️  {problem}")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that the main pages only run indexed queries')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print every statement')
+    parser.add_argument('--database-url', help='Empty scratch database to run against instead of SQLite')
+    args = parser.parse_args(argv)
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+
+    failures = run(args.verbose)
+    if failures:
+        print(f"❌ {failures} page(s) run queries that no index covers")
+        return 1
+    print("✅ Every page query uses an index")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Check that reading blog posts never writes to (or waits on) the database.
+
+    python check_view_counter.py                      # 8 threads x 50 views of one post
+    python check_view_counter.py --threads 32 --views 200
+
+Seeds a throw-away SQLite database (the check_query_counts fixtures), then
+takes the database write lock from another connection, as a long write
+transaction would, and has several threads read the same post concurrently.
+With a write per view every reader would queue behind that lock until the
+busy timeout; with the buffered counter the readers issue no write statement
+and finish while the lock is still held. The lock is then released, the
+buffer flushed, and the post must have gained exactly one view per read.
+"""
+
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+
+import check_query_counts  # đặt DATABASE_URL tạm, phải nhập trước app
+from sqlalchemy import event
+
+POST_URL = '/blog/1'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Concurrent blog readers with the buffered view counter')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--views', type=int, default=50, help='Views per thread')
+    parser.add_argument('--budget-ms', type=float, default=2000.0, help='Maximum time of one read (SQLite waits 5 s for a lock)')
+    args = parser.parse_args(argv)
+
+    from app import create_app
+    from extensions import db
+    from models import BlogPost
+    from view_counter import view_counter
+
+    app = create_app()
+    with app.app_context():
+        check_query_counts.seed()
+        views_before = db.session.get(BlogPost, 1).views
+        database = db.engine.url.database
+        writes = []
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def record_write(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().split(' ', 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE'):
+                writes.append(statement)
+
+    # Giữ khóa ghi của CSDL trong suốt lúc đọc, như một giao dịch ghi dài
+    view_counter.flush_seconds = 3600
+    lock = sqlite3.connect(database, isolation_level=None)
+    lock.execute('BEGIN IMMEDIATE')
+
+    timings, failures = [], []
+
+    def reader():
+        client = app.test_client()
+        for _ in range(args.views):
+            started = time.perf_counter()
+            response = client.get(POST_URL)
+            timings.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                failures.append(response.status_code)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=reader) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    lock.execute('ROLLBACK')
+    lock.close()
+
+    reads = args.threads * args.views
+    read_writes, writes[:] = list(writes), []
+    timings.sort()
+    p99 = timings[int(len(timings) * 0.99) - 1] * 1000
+    print(f"{reads} reads by {args.threads} threads in {elapsed:.2f}s while the write lock was held: "
+          f"p99={p99:.1f} ms max={timings[-1] * 1000:.1f} ms, {len(read_writes)} write statements")
+
+    written = view_counter.flush()
+    with app.app_context():
+        views_after = db.session.get(BlogPost, 1).views
+    print(f"flush wrote {written} views in {len(writes)} statement(s): post views {views_before} -> {views_after}")
+
+    problems = []
+    if failures:
+        problems.append(f"{len(failures)} reads failed (HTTP {sorted(set(failures))})")
+    if read_writes:
+        problems.append(f"reads wrote to the database: {read_writes[0]}")
+    if len(writes) != 1:
+        problems.append(f"expected one batched UPDATE, got {len(writes)} statements")
+    if p99 > args.budget_ms:
+        problems.append(f"p99 {p99:.0f} ms is over {args.budget_ms:.0f} ms: readers waited on the write lock")
+    if views_after - views_before != reads:
+        problems.append(f"expected {reads} new views, got {views_after - views_before}")
+    for problem in problems:
+        print(f"❌ {problem}")
+    if problems:
+        return 1
+    print("✅ Readers never wrote or waited; every view was counted")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+import os
+import time
+import logging
+import sqlite3
+
+import shared_state
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """Circuit breaker whose state and rolling call window live in a SQLite file shared by all worker processes.
+
+    closed:    calls go through; once the window holds min_calls calls and the
+               error rate or slow-call rate reaches its threshold, the circuit opens.
+    open:      calls are rejected immediately for open_seconds.
+    half_open: up to half_open_calls probe calls go through; if all succeed the
+               circuit closes, any failure opens it again.
+    """
+
+    def __init__(self, name, failure_rate=0.5, slow_call_seconds=8.0, slow_call_rate=0.8,
+                 window_seconds=60.0, min_calls=6, open_seconds=30.0, half_open_calls=2,
+                 filename='circuit_breaker.sqlite3'):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.filename = filename
+
+    def allow_request(self):
+        """Reserve a call; return False if the circuit is rejecting calls right now"""
+        try:
+            with shared_state.immediate_transaction(self._conn()) as conn:
+                now = time.time()
+                state, changed_at, probes, _ = self._load(conn)
+
+                if state == OPEN:
+                    if now - changed_at < self.open_seconds:
+                        return False
+                    self._set_state(conn, state, HALF_OPEN, now)
+                    state, changed_at, probes = HALF_OPEN, now, 0
+
+                if state == HALF_OPEN:
+                    # Probe bị mất (worker chết giữa chừng) thì sau open_seconds cho probe mới
+                    if probes >= self.half_open_calls and now - changed_at < self.open_seconds:
+                        return False
+                    if probes >= self.half_open_calls:
+                        self._set_state(conn, HALF_OPEN, HALF_OPEN, now)
+                        probes = 0
+                    conn.execute('UPDATE breakers SET probes = ? WHERE name = ?', (probes + 1, self.name))
+                return True
+        except sqlite3.Error as e:
+            # Không chặn request khi file trạng thái lỗi
+            logging.warning(f"Circuit breaker '{self.name}': state unavailable, allowing request ({e})")
+            return True
+
+    def is_available(self):
+        """Whether a call would currently be allowed, without reserving one"""
+        try:
+            state, changed_at, probes, _ = self._load(self._conn())
+        except sqlite3.Error:
+            return True
+        expired = time.time() - changed_at >= self.open_seconds
+        if state == OPEN:
+            return expired
+        if state == HALF_OPEN:
+            return probes < self.half_open_calls or expired
+        return True
+
+    def record(self, success, duration):
+        """Record the outcome of an allowed call and move between states if needed"""
+        slow = duration >= self.slow_call_seconds
+        try:
+            with shared_state.immediate_transaction(self._conn()) as conn:
+                now = time.time()
+                state, _, _, successes = self._load(conn)
+
+                if state == HALF_OPEN:
+                    if not success or slow:
+                        self._set_state(conn, HALF_OPEN, OPEN, now)
+                    elif successes + 1 >= self.half_open_calls:
+                        self._set_state(conn, HALF_OPEN, CLOSED, now)
+                    else:
+                        conn.execute('UPDATE breakers SET successes = ? WHERE name = ?',
+                                     (successes + 1, self.name))
+                    return
+
+                if state == OPEN:
+                    # Call bắt đầu trước khi circuit mở: không tính vào cửa sổ mới
+                    return
+
+                conn.execute(
+                    'INSERT INTO calls (name, at, success, duration) VALUES (?, ?, ?, ?)',
+                    (self.name, now, 1 if success else 0, duration)
+                )
+                total, failures, slow_calls = self._window(conn, now)
+                if total < self.min_calls:
+                    return
+                if failures / total >= self.failure_rate or slow_calls / total >= self.slow_call_rate:
+                    logging.warning(f"Circuit breaker '{self.name}': {failures}/{total} failed, "
+                                    f"{slow_calls}/{total} slower than {self.slow_call_seconds}s "
+                                    f"in the last {self.window_seconds:.0f}s")
+                    self._set_state(conn, CLOSED, OPEN, now)
+        except sqlite3.Error as e:
+            logging.warning(f"Circuit breaker '{self.name}': could not record call ({e})")
+
+    def snapshot(self):
+        """Current state and rolling-window counts, for monitoring"""
+        conn = self._conn()
+        now = time.time()
+        state, changed_at, probes, _ = self._load(conn)
+        total, failures, slow_calls = self._window(conn, now)
+        retry_in = max(0.0, self.open_seconds - (now - changed_at)) if state == OPEN else 0.0
+        return {
+            'name': self.name,
+            'state': state,
+            'since': changed_at,
+            'retry_in': round(retry_in, 1),
+            'half_open_probes': probes if state == HALF_OPEN else 0,
+            'window_seconds': self.window_seconds,
+            'calls': total,
+            'failures': failures,
+            'slow_calls': slow_calls,
+        }
+
+    def _load(self, conn):
+        row = conn.execute(
+            'SELECT state, changed_at, probes, successes FROM breakers WHERE name = ?', (self.name,)
+        ).fetchone()
+        return row if row is not None else (CLOSED, 0.0, 0, 0)
+
+    def _window(self, conn, now):
+        conn.execute('DELETE FROM calls WHERE name = ? AND at < ?', (self.name, now - self.window_seconds))
+        total, failures, slow_calls = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(1 - success), 0), COALESCE(SUM(duration >= ?), 0)'
+            ' FROM calls WHERE name = ?',
+            (self.slow_call_seconds, self.name)
+        ).fetchone()
+        return total, failures, slow_calls
+
+    def _set_state(self, conn, old_state, new_state, now):
+        conn.execute(
+            'INSERT OR REPLACE INTO breakers (name, state, changed_at, probes, successes) VALUES (?, ?, ?, 0, 0)',
+            (self.name, new_state, now)
+        )
+        if new_state == CLOSED:
+            # Bắt đầu cửa sổ mới, không để lỗi cũ mở lại circuit ngay lập tức
+            conn.execute('DELETE FROM calls WHERE name = ?', (self.name,))
+        if old_state != new_state:
+            log = logging.info if new_state == CLOSED else logging.warning
+            log(f"Circuit breaker '{self.name}': {old_state} -> {new_state}")
+
+    def _conn(self):
+        return shared_state.local_connection(self.filename, (
+            'CREATE TABLE IF NOT EXISTS breakers ('
+            ' name TEXT PRIMARY KEY,'
+            ' state TEXT NOT NULL,'
+            ' changed_at REAL NOT NULL,'
+            ' probes INTEGER NOT NULL DEFAULT 0,'
+            ' successes INTEGER NOT NULL DEFAULT 0)',
+            'CREATE TABLE IF NOT EXISTS calls ('
+            ' name TEXT NOT NULL,'
+            ' at REAL NOT NULL,'
+            ' success INTEGER NOT NULL,'
+            ' duration REAL NOT NULL)',
+            'CREATE INDEX IF NOT EXISTS idx_calls_name_at ON calls (name, at)',
+        ))
+
+
+facepp_breaker = CircuitBreaker(
+    'facepp',
+    failure_rate=float(os.environ.get('FACEPP_BREAKER_FAILURE_RATE', 0.5)),
+    slow_call_seconds=float(os.environ.get('FACEPP_BREAKER_SLOW_SECONDS', 8)),
+    slow_call_rate=float(os.environ.get('FACEPP_BREAKER_SLOW_RATE', 0.8)),
+    window_seconds=float(os.environ.get('FACEPP_BREAKER_WINDOW', 60)),
+    min_calls=int(os.environ.get('FACEPP_BREAKER_MIN_CALLS', 6)),
+    open_seconds=float(os.environ.get('FACEPP_BREAKER_OPEN_SECONDS', 30)),
+    half_open_calls=int(os.environ.get('FACEPP_BREAKER_HALF_OPEN_CALLS', 2)),
+)
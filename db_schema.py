@@ -0,0 +1,27 @@
+import logging
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateColumn
+from extensions import db
+
+
+def ensure_columns():
+    """Add columns declared on the models but missing from existing tables.
+
+    db.create_all() only creates missing tables, so new nullable columns on
+    existing tables are added here with a plain ALTER TABLE.
+    """
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                table_name = db.engine.dialect.identifier_preparer.quote(table.name)
+                logging.info(f"Adding missing column {table.name}.{column.name}")
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_ddl}"))
@@ -1,172 +1,97 @@
-import requests
 import os
 import logging
 import time
 from datetime import datetime, timedelta
+from analysis_cache import analysis_cache
+from rate_limiter import facepp_limiter
+from circuit_breaker import facepp_breaker
+from facepp_client import FacePPClient
+from image_utils import normalize_image, load_image_bytes
+from http_client import get_session
+from skin_backends import get_backend
+from routine_rules import get_routine
+from metrics import timed
+
+logger = logging.getLogger(__name__)
 
 class FaceAnalyzer:
     def __init__(self):
         self.api_key = os.environ.get('FACEPP_API_KEY')
         self.api_secret = os.environ.get('FACEPP_API_SECRET')
-        self.detect_url = 'https://api-us.faceplusplus.com/facepp/v3/detect'
-        self.skin_analyze_url = 'https://api-us.faceplusplus.com/facepp/v1/skinanalyze'
-        self.last_request_time = None
-        self.min_request_interval = 2  # 2 seconds between requests
-        
-    def analyze_skin(self, image_path_or_url):
+        # Có thể trỏ sang facepp_stub.py khi benchmark
+        base_url = os.environ.get('FACEPP_BASE_URL', 'https://api-us.faceplusplus.com').rstrip('/')
+        self.detect_url = f'{base_url}/facepp/v3/detect'
+        self.skin_analyze_url = f'{base_url}/facepp/v1/skinanalyze'
+        self.rate_limiter = facepp_limiter
+        self.rate_limit_timeout = float(os.environ.get('FACEPP_RATE_LIMIT_TIMEOUT', 10))
+        self.circuit_breaker = facepp_breaker
+        self.client = FacePPClient(
+            self.api_key, self.api_secret, self.detect_url, self.skin_analyze_url,
+            rate_limiter=self.rate_limiter, rate_limit_timeout=self.rate_limit_timeout,
+            circuit_breaker=self.circuit_breaker
+        )
+        # Cắt ảnh theo khuôn mặt (Detect trước, rồi Skin Analyze trên ảnh cắt) để giảm dung lượng upload
+        self.face_crop = os.environ.get('FACEPP_FACE_CROP', 'false').lower() in ('1', 'true', 'yes')
+        self.face_crop_margin = float(os.environ.get('FACEPP_FACE_CROP_MARGIN', 0.5))
+        self.face_crop_quality = int(os.environ.get('FACEPP_FACE_CROP_QUALITY', 85))
+        # Backend chính và backend dự phòng khi backend chính lỗi (để trống để tắt)
+        self.backend = get_backend(os.environ.get('SKIN_ANALYZER_BACKEND', 'facepp'), self)
+        fallback_name = os.environ.get('SKIN_ANALYZER_FALLBACK', 'local')
+        self.fallback_backend = get_backend(fallback_name, self) if fallback_name and fallback_name != self.backend.name else None
+        
+    def analyze_skin(self, image):
         """
-        Analyze skin using a combination of Face++ Detect and Skin Analyze APIs
+        Analyze skin with the configured backend (Face++ by default), falling back
+        to the secondary backend when it is unavailable or fails.
+        `image` may be the raw bytes of an upload, a local file path or an image URL.
         """
-        if not self.api_key or not self.api_secret:
-            logging.error("Face++ API credentials not found")
-            return self._get_fallback_analysis()
-            
-        # Tối ưu hóa kích thước ảnh nếu là link Cloudinary để tránh lỗi quá 2MB của Face++
-        if isinstance(image_path_or_url, str) and 'res.cloudinary.com' in image_path_or_url and '/upload/' in image_path_or_url:
-            if '/upload/w_' not in image_path_or_url: # Tránh transform 2 lần
-                image_path_or_url = image_path_or_url.replace('/upload/', '/upload/w_800,c_limit,q_auto/')
-                
         try:
-            self._handle_rate_limiting()
-            
-            # Tải ảnh từ URL về file tạm để gửi dạng image_file (Face++ đôi khi chặn hoặc lỗi khi dùng image_url)
-            temp_file_path = None
-            is_temp = False
-            
-            if image_path_or_url.startswith('http'):
-                import tempfile
-                import uuid
-                
-                temp_dir = tempfile.gettempdir()
-                temp_file_path = os.path.join(temp_dir, f"temp_face_{uuid.uuid4().hex}.jpg")
-                
-                # Tải ảnh về
-                response = requests.get(image_path_or_url, stream=True)
-                if response.status_code == 200:
-                    with open(temp_file_path, 'wb') as f:
-                        for chunk in response.iter_content(1024):
-                            f.write(chunk)
-                    is_temp = True
-                    image_path_or_url = temp_file_path
-                else:
-                    logging.error(f"Could not download image from {image_path_or_url}")
-                    return self._get_fallback_analysis()
-            
-            try:
-                # Chuẩn hóa ảnh: Xoay đúng hướng EXIF và thu nhỏ về 800px để tọa độ chuẩn xác
-                from PIL import Image, ImageOps
-                with Image.open(image_path_or_url) as img:
-                    # Xoay ảnh dựa trên metadata EXIF (tránh lỗi ảnh dọc bị hiểu thành ảnh ngang)
-                    img = ImageOps.exif_transpose(img)
-                    
-                    # Thu nhỏ ảnh về chiều rộng 800px (giữ nguyên tỷ lệ)
-                    target_width = 800
-                    w_percent = (target_width / float(img.size[0]))
-                    target_height = int((float(img.size[1]) * float(w_percent)))
-                    img = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
-                    
-                    # Lưu đè lại file tạm với ảnh đã chuẩn hóa
-                    img.save(image_path_or_url, format="JPEG", quality=90)
-                    
-                    analysis_width, analysis_height = target_width, target_height
-                    logging.info(f"Normalized image size for analysis: {analysis_width}x{analysis_height}")
-
-                # Step 1: Get Age and Gender using Detect API (v3)
-                detect_data = {
-                    'api_key': self.api_key,
-                    'api_secret': self.api_secret,
-                    'return_attributes': 'age,gender'
-                }
-                
-                base_info = {'age': 25, 'gender': 'Female', 'face_rectangle': None}
-                
-                with open(image_path_or_url, 'rb') as image_file:
-                    files = {'image_file': image_file}
-                    response_detect = requests.post(self.detect_url, data=detect_data, files=files, timeout=15)
-                
-                if response_detect and response_detect.status_code == 200:
-                    detect_result = response_detect.json()
-                    if detect_result.get('faces'):
-                        face_data = detect_result['faces'][0]
-                        attrs = face_data.get('attributes', {})
-                        base_info['age'] = attrs.get('age', {}).get('value', 25)
-                        base_info['gender'] = attrs.get('gender', {}).get('value', 'Female')
-                        base_info['face_rectangle'] = face_data.get('face_rectangle')
-                        logging.info(f"Detect API info: Age {base_info['age']}, Gender {base_info['gender']}")
-    
-                # Step 2: Get detailed skin analysis using Skin Analyze API (v1)
-                self._handle_rate_limiting()
-                result = self._try_skin_analyze_api(image_path_or_url)
-                
-                if result:
-                    result['analysis_width'] = analysis_width
-                    result['analysis_height'] = analysis_height
-            finally:
-                # Dọn dẹp file tạm
-                if is_temp and temp_file_path and os.path.exists(temp_file_path):
-                    try:
-                        os.remove(temp_file_path)
-                    except:
-                        pass
+            with timed('load_image'):
+                image_bytes = load_image_bytes(image)
+            if image_bytes is None:
+                return self._get_fallback_analysis()
             
-            if result and result.get('success'):
-                # Merge the accurate age/gender into the detailed skin result
-                result['age'] = base_info['age']
-                result['gender'] = base_info['gender']
-                if base_info.get('face_rectangle'):
-                    result['face_rectangle'] = base_info['face_rectangle']
-                return result
+            # Chuẩn hóa ảnh trong bộ nhớ: xoay đúng hướng EXIF và thu nhỏ về 800px để tọa độ chuẩn xác
+            with timed('normalize'):
+                image_bytes, analysis_width, analysis_height = normalize_image(image_bytes)
+            logger.info("Normalized image size for analysis: %sx%s", analysis_width, analysis_height)
             
-            # If Skin Analyze fails, return fallback with the age we found
-            logging.warning("Skin Analyze API failed, returning partial results")
-            fallback = self._get_fallback_analysis()
-            fallback['age'] = base_info['age']
-            return fallback
+            return self.analyze_normalized(image_bytes, analysis_width, analysis_height)
                 
         except Exception as e:
-            logging.error(f"Error in hybrid skin analysis: {str(e)}")
+            logger.error("Error in hybrid skin analysis: %s", e)
             return self._get_fallback_analysis()
     
-    def _handle_rate_limiting(self):
-        """Handle rate limiting to prevent API errors"""
-        if self.last_request_time:
-            elapsed = time.time() - self.last_request_time
-            if elapsed < self.min_request_interval:
-                sleep_time = self.min_request_interval - elapsed
-                logging.info(f"Rate limiting: sleeping for {sleep_time:.2f} seconds")
-                time.sleep(sleep_time)
-        
-        self.last_request_time = time.time()
+    def analyze_normalized(self, image_bytes, width, height):
+        """Analyze an image already passed through normalize_image()"""
+        result = None
+        for backend in (self.backend, self.fallback_backend):
+            if backend is None or not backend.available():
+                continue
+            result = self._analyze_with_backend(backend, image_bytes, width, height)
+            if result.get('success'):
+                return result
+            logger.warning("Skin analyzer backend '%s' failed", backend.name)
+        
+        return result or self._get_fallback_analysis()
     
-    def _try_skin_analyze_api(self, image_path_or_url):
-        """Try the Face++ Skin Analyze API v1"""
-        try:
-            analyze_data = {
-                'api_key': self.api_key,
-                'api_secret': self.api_secret
-            }
-            
-            response = None
-            if image_path_or_url.startswith('http'):
-                analyze_data['image_url'] = image_path_or_url
-                response = requests.post(self.skin_analyze_url, data=analyze_data, timeout=10)
-            else:
-                with open(image_path_or_url, 'rb') as image_file:
-                    files = {'image_file': image_file}
-                    response = requests.post(self.skin_analyze_url, data=analyze_data, files=files, timeout=10)
-            
-            if response and response.status_code == 200:
-                result = response.json()
-                logging.info(f"Face++ Skin Analyze API successful")
-                return self._process_skin_analysis_result(result)
-            else:
-                error_msg = response.text if response else "No response"
-                logging.warning(f"Skin Analyze API failed: {response.status_code if response else 'No response'} - {error_msg}")
-                return None
-                
-        except Exception as e:
-            logging.warning(f"Skin Analyze API exception: {str(e)}")
-            return None
+    def _analyze_with_backend(self, backend, image_bytes, width, height):
+        """Run one backend, going through the result cache for backends worth caching"""
+        cache_key = None
+        if backend.cacheable:
+            # Ảnh đã gửi trước đó (hoặc request retry) trả về ngay từ cache, không tốn quota Face++
+            with timed('cache_lookup'):
+                cache_key = analysis_cache.make_key(image_bytes, namespace=backend.name)
+                cached_result = analysis_cache.get(cache_key)
+            if cached_result is not None:
+                return cached_result
+        
+        with timed(f'backend_{backend.name}'):
+            result = backend.analyze(image_bytes, width, height)
+        result['backend'] = backend.name
+        if cache_key and result.get('success'):
+            analysis_cache.set(cache_key, result)
+        return result
     
     def _process_skin_analysis_result(self, api_result):
         """Process Face++ Skin Analyze API v1 result into our format"""
@@ -185,10 +110,9 @@ class FaceAnalyzer:
         else:
             skin_type = 'normal'
         
-        # Deep debug: Print the entire result to console so we can see it
-        print("\n" + "="*50)
-        print("DEBUG: FACE++ API RESPONSE STRUCTURE")
-        print(f"Keys available: {list(result.keys())}")
+        # Chỉ dựng danh sách key khi DEBUG đang bật
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Face++ Skin Analyze result keys: %s", sorted(result))
         
         # Try to find age anywhere in the result
         skin_age = 25 # Default
@@ -207,11 +131,10 @@ class FaceAnalyzer:
             for key, value in result.items():
                 if 'age' in key.lower() and isinstance(value, dict) and 'value' in value:
                     skin_age = value['value']
-                    print(f"Found potential age in key '{key}': {skin_age}")
+                    logger.debug("Face++ Skin Analyze: age %s found in key '%s'", skin_age, key)
                     break
         
-        print(f"FINAL DETERMINED AGE: {skin_age}")
-        print("="*50 + "\n")
+        logger.debug("Face++ Skin Analyze: skin age %s", skin_age)
         
         # Identify skin concerns from the detailed analysis
         concerns = self._identify_concerns_from_analysis(result)
@@ -376,7 +299,7 @@ class FaceAnalyzer:
     def _try_detect_api_fallback(self, image_path_or_url):
         """Fallback to basic detect API when Skin Analyze API fails"""
         try:
-            logging.info("Using Face++ detect API as fallback")
+            logger.info("Using Face++ detect API as fallback")
             detect_data = {
                 'api_key': self.api_key,
                 'api_secret': self.api_secret,
@@ -386,22 +309,23 @@ class FaceAnalyzer:
             response = None
             if image_path_or_url.startswith('http'):
                 detect_data['image_url'] = image_path_or_url
-                response = requests.post(self.detect_url, data=detect_data)
+                response = get_session('facepp').post(self.detect_url, data=detect_data, timeout=15)
             else:
                 with open(image_path_or_url, 'rb') as image_file:
                     files = {'image_file': image_file}
-                    response = requests.post(self.detect_url, data=detect_data, files=files)
+                    response = get_session('facepp').post(self.detect_url, data=detect_data, files=files, timeout=15)
             
             if response and response.status_code == 200:
                 result = response.json()
-                logging.info(f"Face++ detect API fallback response: {result}")
+                # Toàn bộ response của Face++ chỉ ghi ra khi DEBUG
+                logger.debug("Face++ detect API fallback response: %s", result)
                 return self._process_analysis_result(result)
             else:
-                logging.error(f"Detect API fallback also failed: {response.status_code if response else 'No response'}")
+                logger.error("Detect API fallback also failed: %s", response.status_code if response else 'No response')
                 return self._get_fallback_analysis()
                 
         except Exception as e:
-            logging.error(f"Error in detect API fallback: {str(e)}")
+            logger.error("Error in detect API fallback: %s", e)
             return self._get_fallback_analysis()
     
     def _identify_concerns(self, skin_status):
@@ -422,55 +346,8 @@ class FaceAnalyzer:
         return concerns
     
     def _generate_routine(self, skin_type, concerns, age):
-        """Generate skincare routine based on analysis"""
-        routine = {
-            'morning': [],
-            'evening': [],
-            'weekly': []
-        }
-        
-        # Basic routine for all skin types
-        routine['morning'].extend([
-            'Sữa rửa mặt nhẹ nhàng',
-            'Toner cân bằng da',
-            'Serum vitamin C',
-            'Kem dưỡng ẩm',
-            'Kem chống nắng SPF 30+'
-        ])
-        
-        routine['evening'].extend([
-            'Tẩy trang (nếu có makeup)',
-            'Sữa rửa mặt',
-            'Toner',
-            'Serum phục hồi da',
-            'Kem dưỡng ẩm ban đêm'
-        ])
-        
-        # Specific recommendations based on skin type
-        if skin_type == 'oily':
-            routine['morning'][1] = 'Toner kiểm soát dầu'
-            routine['evening'].insert(3, 'BHA/Salicylic Acid (2-3 lần/tuần)')
-            
-        elif skin_type == 'dry':
-            routine['morning'].insert(3, 'Serum hyaluronic acid')
-            routine['evening'].insert(3, 'Dầu dưỡng da')
-            
-        elif skin_type == 'sensitive':
-            routine['morning'][2] = 'Serum niacinamide'
-            routine['evening'][3] = 'Serum làm dịu da'
-        
-        # Additional treatments based on concerns
-        if 'acne' in concerns:
-            routine['evening'].append('Sản phẩm chấm mụn đặc trị')
-            
-        if 'dark_spots' in concerns:
-            routine['evening'].insert(3, 'Serum làm sáng da')
-            
-        if age > 30:
-            routine['evening'].insert(3, 'Serum chống lão hóa/retinol')
-            routine['weekly'].append('Mặt nạ chống lão hóa')
-        
-        return routine
+        """Generate skincare routine based on analysis (shared, read-only; see routine_rules)"""
+        return get_routine(skin_type, concerns, age)
     
     def _get_fallback_analysis(self):
         """Return fallback analysis when API is unavailable"""
@@ -0,0 +1,121 @@
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from http_client import get_session, request_not_sent, retry_delay, RETRY_TOTAL, FACEPP_RETRY_STATUSES
+from metrics import timed
+
+
+class FacePPClient:
+    """asyncio client that sends one normalized image to Face++ Detect and Skin Analyze concurrently"""
+
+    def __init__(self, api_key, api_secret, detect_url, skin_analyze_url,
+                 rate_limiter=None, rate_limit_timeout=10, detect_timeout=15, skin_analyze_timeout=10,
+                 circuit_breaker=None, max_retries=RETRY_TOTAL):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.detect_url = detect_url
+        self.skin_analyze_url = skin_analyze_url
+        self.rate_limiter = rate_limiter
+        self.rate_limit_timeout = rate_limit_timeout
+        self.detect_timeout = detect_timeout
+        self.skin_analyze_timeout = skin_analyze_timeout
+        self.circuit_breaker = circuit_breaker
+        self.max_retries = max_retries
+
+    async def detect(self, image_bytes):
+        """Detect API v3 (age, gender, face rectangle); returns the JSON body or None"""
+        data = {
+            'api_key': self.api_key,
+            'api_secret': self.api_secret,
+            'return_attributes': 'age,gender'
+        }
+        return await self._post('detect', self.detect_url, data, image_bytes, self.detect_timeout)
+
+    async def skin_analyze(self, image_bytes):
+        """Skin Analyze API v1; returns the JSON body or None"""
+        data = {
+            'api_key': self.api_key,
+            'api_secret': self.api_secret
+        }
+        return await self._post('skinanalyze', self.skin_analyze_url, data, image_bytes, self.skin_analyze_timeout)
+
+    async def detect_and_analyze(self, image_bytes):
+        """Run both calls at the same time; returns (detect_json, skin_analyze_json)"""
+        return await asyncio.gather(self.detect(image_bytes), self.skin_analyze(image_bytes))
+
+    def detect_and_analyze_sync(self, image_bytes):
+        """Blocking wrapper for Flask views and background jobs"""
+        return run_sync(self.detect_and_analyze(image_bytes))
+
+    async def _post(self, endpoint, url, data, image_bytes, timeout):
+        """POST to Face++, retrying only when Face++ cannot have processed (or billed) the request:
+        the connection was never made, or it answered 502/503. Every attempt checks the circuit
+        breaker and takes its own rate-limit token, so retries count against the shared QPS."""
+        for attempt in range(self.max_retries + 1):
+            response, retryable, retry_after = await self._attempt(endpoint, url, data, image_bytes, timeout)
+            if response is not None or not retryable or attempt == self.max_retries:
+                return response
+            delay = retry_delay(attempt + 1, retry_after)
+            logging.info(f"Face++ {endpoint} API: retry {attempt + 1}/{self.max_retries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+        return None
+
+    async def _attempt(self, endpoint, url, data, image_bytes, timeout):
+        """One call; returns (JSON body or None, whether it may be retried, Retry-After header)"""
+        # Circuit đang mở thì trả về ngay, không chờ rate limiter hay timeout của Face++
+        if self.circuit_breaker is not None and not self.circuit_breaker.allow_request():
+            logging.warning(f"Face++ {endpoint} API skipped: circuit breaker is open")
+            return None, False, None
+
+        if self.rate_limiter is not None:
+            with timed('rate_limit_wait'):
+                acquired = await self.rate_limiter.acquire_async(endpoint, timeout=self.rate_limit_timeout)
+            if not acquired:
+                return None, False, None
+
+        files = {'image_file': ('image.jpg', image_bytes, 'image/jpeg')}
+        started = time.time()
+        try:
+            # requests là thư viện đồng bộ nên mỗi call chạy trên một thread riêng, dùng chung pool kết nối
+            session = get_session('facepp')
+            with timed(endpoint):
+                response = await asyncio.to_thread(session.post, url, data=data, files=files, timeout=timeout)
+        except Exception as e:
+            logging.warning(f"Face++ {endpoint} API exception: {str(e)}")
+            self._record(False, started)
+            return None, request_not_sent(e), None
+
+        # Lỗi 4xx (ảnh không hợp lệ, không có khuôn mặt...) là lỗi của request, không phải Face++ đang sự cố
+        self._record(response.status_code < 500, started)
+
+        if response.status_code != 200:
+            logging.warning(f"Face++ {endpoint} API failed: {response.status_code} - {response.text}")
+            return (None, response.status_code in FACEPP_RETRY_STATUSES,
+                    response.headers.get('Retry-After'))
+
+        try:
+            body = response.json()
+        except ValueError:
+            # Body không phải JSON (proxy trả trang HTML...): coi là lần gọi thất bại để vẫn dùng backend dự phòng
+            logging.warning(f"Face++ {endpoint} API returned a non-JSON body: {response.text[:200]}")
+            return None, False, None
+
+        logging.info(f"Face++ {endpoint} API successful")
+        return body, False, None
+
+    def _record(self, success, started):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.record(success, time.time() - started)
+
+
+def run_sync(coro):
+    """Run a coroutine to completion from synchronous code"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    # Đã có event loop đang chạy trên thread này: chạy coroutine trên thread khác
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
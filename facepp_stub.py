@@ -0,0 +1,233 @@
+"""
+Local stand-in for the Face++ Detect v3 and Skin Analyze v1 endpoints.
+
+    # Replay recorded (or built-in) responses with latency, jitter and injected errors
+    python facepp_stub.py serve --recordings facepp_recordings.jsonl \
+        --detect-latency 300 --skin-latency 900 --jitter 150 --error-rate 0.02
+
+    # Forward to the real API and append every response to a JSONL file
+    python facepp_stub.py record --output facepp_recordings.jsonl
+
+Point the app (or bench_analysis.py) at it with FACEPP_BASE_URL=http://127.0.0.1:8900.
+Recording lines look like {"endpoint": "detect", "status": 200, "elapsed_ms": 412.0, "body": {...}};
+replay cycles through the recordings of each endpoint in order.
+"""
+
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import itertools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ENDPOINTS = {
+    '/facepp/v3/detect': 'detect',
+    '/facepp/v1/skinanalyze': 'skinanalyze',
+}
+
+DEFAULT_UPSTREAM = 'https://api-us.faceplusplus.com'
+
+# Phản hồi mẫu khi không có file ghi: một khuôn mặt trong ảnh 800x600
+_FACE_RECTANGLE = {'top': 160, 'left': 270, 'width': 260, 'height': 290}
+
+BUILTIN_RESPONSES = {
+    'detect': {
+        'request_id': 'stub',
+        'time_used': 0,
+        'face_num': 1,
+        'faces': [{
+            'face_token': 'stub',
+            'face_rectangle': _FACE_RECTANGLE,
+            'attributes': {'age': {'value': 28}, 'gender': {'value': 'Female'}},
+        }],
+    },
+    'skinanalyze': {
+        'request_id': 'stub',
+        'time_used': 0,
+        'face_rectangle': _FACE_RECTANGLE,
+        'result': {
+            'skin_type': {'skin_type': 1, 'details': {
+                '0': {'value': 0, 'confidence': 0.1}, '1': {'value': 1, 'confidence': 0.7},
+                '2': {'value': 0, 'confidence': 0.1}, '3': {'value': 0, 'confidence': 0.1},
+            }},
+            'acne': {'value': 1, 'confidence': 0.92,
+                     'rectangle': [{'left': 320, 'top': 350, 'width': 12, 'height': 12}]},
+            'skin_spot': {'value': 0, 'confidence': 0.88},
+            'blackhead': {'value': 1, 'confidence': 0.71},
+            'dark_circle': {'value': 0, 'confidence': 0.83},
+            'forehead_wrinkle': {'value': 0, 'confidence': 0.95},
+            'eye_finelines': {'value': 0, 'confidence': 0.9},
+            'pores_left_cheek': {'value': 1, 'confidence': 0.66},
+            'pores_right_cheek': {'value': 0, 'confidence': 0.7},
+        },
+    },
+}
+
+
+def load_recordings(path):
+    """endpoint -> list of (status, body) recorded for it"""
+    recordings = {name: [] for name in ENDPOINTS.values()}
+    if not path:
+        return recordings
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record.get('endpoint') in recordings:
+                recordings[record['endpoint']].append((record.get('status', 200), record['body']))
+    return recordings
+
+
+class ReplayBehaviour:
+    """Responses, latency and error injection for serve mode"""
+
+    def __init__(self, recordings, latency_ms, jitter_ms, error_rate, error_status, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.cycles = {}
+        for endpoint, responses in recordings.items():
+            if not responses:
+                responses = [(200, BUILTIN_RESPONSES[endpoint])]
+            self.cycles[endpoint] = itertools.cycle(responses)
+
+    def respond(self, endpoint):
+        """Sleep for the simulated latency, then return (status, body)"""
+        with self.lock:
+            status, body = next(self.cycles[endpoint])
+            delay = self.latency_ms[endpoint] + self.random.uniform(-self.jitter_ms, self.jitter_ms)
+            fail = self.random.random() < self.error_rate
+        time.sleep(max(0.0, delay) / 1000.0)
+        if fail:
+            return self.error_status, {'error_message': 'INJECTED_ERROR', 'request_id': 'stub'}
+        return status, body
+
+
+class RecordingProxy:
+    """Forward requests to the real Face++ API and append each response to a JSONL file"""
+
+    def __init__(self, upstream, output):
+        self.upstream = upstream.rstrip('/')
+        self.output = open(output, 'a', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+
+    def forward(self, path, endpoint, body, content_type):
+        started = time.time()
+        response = self.session.post(self.upstream + path, data=body,
+                                     headers={'Content-Type': content_type}, timeout=30)
+        elapsed_ms = (time.time() - started) * 1000
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = {'error_message': response.text}
+        record = {'endpoint': endpoint, 'status': response.status_code,
+                  'elapsed_ms': round(elapsed_ms, 1), 'body': payload}
+        with self.lock:
+            self.output.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.output.flush()
+        return response.status_code, payload
+
+
+def make_handler(behaviour=None, proxy=None):
+    class FacePPStubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            path = self.path.split('?', 1)[0]
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            endpoint = ENDPOINTS.get(path)
+            if endpoint is None:
+                self._send(404, {'error_message': 'API_NOT_FOUND'})
+                return
+            try:
+                if proxy is not None:
+                    status, payload = proxy.forward(path, endpoint, body, self.headers.get('Content-Type', ''))
+                else:
+                    status, payload = behaviour.respond(endpoint)
+            except Exception as e:
+                logging.error(f"Stub {endpoint} failed: {e}")
+                status, payload = 502, {'error_message': str(e)}
+            self._send(status, payload)
+
+        def _send(self, status, payload):
+            data = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logging.debug(f"{self.address_string()} {format % args}")
+
+    return FacePPStubHandler
+
+
+def start_server(host='127.0.0.1', port=8900, behaviour=None, proxy=None):
+    """Start the stub on a background thread; returns the server (call .shutdown() to stop)"""
+    server = ThreadingHTTPServer((host, port), make_handler(behaviour, proxy))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Face++ stub server (replay or record)')
+    parser.add_argument('mode', choices=('serve', 'record'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--recordings', help='serve: JSONL recordings to replay (default: built-in responses)')
+    parser.add_argument('--detect-latency', type=float, default=300, help='serve: Detect latency in ms')
+    parser.add_argument('--skin-latency', type=float, default=900, help='serve: Skin Analyze latency in ms')
+    parser.add_argument('--jitter', type=float, default=0, help='serve: +/- uniform jitter in ms')
+    parser.add_argument('--error-rate', type=float, default=0, help='serve: fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=503, help='serve: status of injected failures')
+    parser.add_argument('--seed', type=int, help='serve: random seed for jitter and errors')
+    parser.add_argument('--upstream', default=DEFAULT_UPSTREAM, help='record: real Face++ base URL')
+    parser.add_argument('--output', default='facepp_recordings.jsonl', help='record: JSONL file to append to')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(argv)
+
+    behaviour = proxy = None
+    if args.mode == 'record':
+        proxy = RecordingProxy(args.upstream, args.output)
+        logging.info(f"Recording {args.upstream} responses to {args.output}")
+    else:
+        recordings = load_recordings(args.recordings)
+        behaviour = ReplayBehaviour(
+            recordings,
+            latency_ms={'detect': args.detect_latency, 'skinanalyze': args.skin_latency},
+            jitter_ms=args.jitter,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            seed=args.seed,
+        )
+        counts = {name: len(items) for name, items in recordings.items()}
+        logging.info(f"Replaying recordings {counts} (empty endpoints use built-in responses)")
+
+    server = start_server(args.host, args.port, behaviour, proxy)
+    logging.info(f"Face++ stub listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+import os
+import random
+import logging
+import threading
+import certifi
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Mỗi thread phân tích có thể giữ 1-2 kết nối cùng lúc (Detect và Skin Analyze chạy song song)
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', max(10, 2 * int(os.environ.get('ANALYSIS_WORKERS', 4)))))
+RETRY_TOTAL = int(os.environ.get('HTTP_RETRY_TOTAL', 3))
+RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.5))
+
+
+class JitterRetry(Retry):
+    """Exponential backoff with full jitter so retrying workers don't hit the API in lockstep"""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+
+# Face++ trả về các mã này trước khi xử lý request; 504 thì Face++ có thể đã xử lý (và tính phí) rồi
+FACEPP_RETRY_STATUSES = (502, 503)
+
+
+def _facepp_retry():
+    # POST không retry ở đây: FacePPClient._post tự retry, lấy token rate limit và hỏi circuit breaker mỗi lần
+    return JitterRetry(
+        total=RETRY_TOTAL,
+        connect=0,
+        read=0,
+        status=RETRY_TOTAL,
+        status_forcelist=FACEPP_RETRY_STATUSES,
+        allowed_methods=frozenset(['GET']),
+        backoff_factor=RETRY_BACKOFF,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+def request_not_sent(error):
+    """Whether a requests exception means the request never reached the server, so a POST is safe to retry"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if isinstance(error, requests.exceptions.ConnectionError) and error.args else None
+    return (isinstance(reason, urllib3.exceptions.MaxRetryError)
+            and isinstance(reason.reason, urllib3.exceptions.NewConnectionError))
+
+
+def retry_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number `attempt` (1-based): Retry-After if the server sent one,
+    otherwise exponential backoff with full jitter, like JitterRetry"""
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), 30.0)
+    except ValueError:
+        pass
+    return random.uniform(0, RETRY_BACKOFF * (2 ** (attempt - 1)))
+
+
+def _download_retry():
+    # GET ảnh là idempotent nên retry được cả lỗi đọc và lỗi 5xx
+    return JitterRetry(
+        total=RETRY_TOTAL,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        backoff_factor=RETRY_BACKOFF,
+        raise_on_status=False,
+    )
+
+
+_RETRY_POLICIES = {
+    'facepp': _facepp_retry,
+    'download': _download_retry,
+}
+
+_sessions = {}
+_pool_managers = {}
+_pid = None
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # Không dùng lại socket của process cha sau khi gunicorn fork worker
+    global _pid
+    if _pid != os.getpid():
+        _sessions.clear()
+        _pool_managers.clear()
+        _pid = os.getpid()
+
+
+def get_session(name):
+    """Shared keep-alive requests.Session for one kind of outbound traffic ('facepp' or 'download')"""
+    with _lock:
+        _reset_after_fork()
+        session = _sessions.get(name)
+        if session is None:
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=POOL_SIZE,
+                max_retries=_RETRY_POLICIES[name](),
+            )
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[name] = session
+        return session
+
+
+def get_pool_manager(name):
+    """Shared urllib3 PoolManager for SDKs that talk to urllib3 directly (Cloudinary uploads)"""
+    with _lock:
+        _reset_after_fork()
+        manager = _pool_managers.get(name)
+        if manager is None:
+            manager = urllib3.PoolManager(
+                num_pools=4,
+                maxsize=POOL_SIZE,
+                cert_reqs='CERT_REQUIRED',
+                ca_certs=certifi.where(),
+            )
+            _pool_managers[name] = manager
+        return manager
+
+
+def install_cloudinary_pool():
+    """Make the Cloudinary SDK upload through our shared, sized connection pool"""
+    import cloudinary.uploader
+    if hasattr(cloudinary.uploader, '_http'):
+        cloudinary.uploader._http = get_pool_manager('cloudinary')
+    else:
+        logging.warning("Cloudinary SDK has no _http pool to replace; uploads use the SDK default")
+
+
+def _iter_pool_managers():
+    for session in list(_sessions.values()):
+        for adapter in set(session.adapters.values()):
+            if isinstance(adapter, HTTPAdapter):
+                yield adapter.poolmanager
+    yield from list(_pool_managers.values())
+
+
+def connection_stats():
+    """Per-host request/connection counts for this process; reused = requests - new connections"""
+    stats = {}
+    with _lock:
+        managers = list(_iter_pool_managers())
+    for manager in managers:
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            host = stats.setdefault(pool.host, {'requests': 0, 'new_connections': 0, 'reused': 0})
+            host['requests'] += pool.num_requests
+            host['new_connections'] += pool.num_connections
+    for host in stats.values():
+        host['reused'] = max(0, host['requests'] - host['new_connections'])
+    return stats
@@ -0,0 +1,109 @@
+import io
+import logging
+from PIL import Image
+from http_client import get_session
+
+TARGET_WIDTH = 800
+JPEG_QUALITY = 90
+# Skin Analyze từ chối ảnh có cạnh nhỏ hơn 200px
+MIN_CROP_SIZE = 200
+
+# Orientation EXIF -> phép xoay/lật tương ứng (giống ImageOps.exif_transpose)
+_EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def normalize_image(image_bytes, target_width=TARGET_WIDTH, quality=JPEG_QUALITY):
+    """Upright, 800px-wide JPEG of an image, entirely in memory.
+
+    Returns (jpeg_bytes, width, height). JPEGs are downscaled while decoding
+    (draft mode); the image is resampled once in its stored orientation and
+    the EXIF rotation is then applied losslessly to the small result.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        orientation = img.getexif().get(0x0112, 1)
+        # Ảnh xoay 90/270 độ: chiều rộng hiển thị là chiều cao lưu trong file
+        rotated = orientation in (5, 6, 7, 8)
+
+        stored_width, stored_height = img.size
+        upright_width, upright_height = (stored_height, stored_width) if rotated else (stored_width, stored_height)
+        target_height = int(upright_height * (target_width / float(upright_width)))
+        stored_target = (target_height, target_width) if rotated else (target_width, target_height)
+
+        if img.format == 'JPEG':
+            img.draft('RGB', stored_target)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        img = img.resize(stored_target, Image.Resampling.LANCZOS)
+        if orientation in _EXIF_TRANSPOSE:
+            img = img.transpose(_EXIF_TRANSPOSE[orientation])
+
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=quality)
+
+    return buffer.getvalue(), target_width, target_height
+
+
+def face_crop_box(face_rectangle, width, height, margin, min_size=MIN_CROP_SIZE):
+    """(left, top, right, bottom) of a Face++ face_rectangle grown by margin, clamped to the image.
+
+    margin is a fraction of the face size added on every side; the box is then
+    widened to at least min_size pixels where the image allows it.
+    """
+    box = []
+    for start, length, limit in (
+        (face_rectangle['left'], face_rectangle['width'], width),
+        (face_rectangle['top'], face_rectangle['height'], height),
+    ):
+        low = start - length * margin
+        high = start + length * (1 + margin)
+        if high - low < min_size:
+            center = (low + high) / 2
+            low, high = center - min_size / 2, center + min_size / 2
+        # Dịch hộp vào trong ảnh trước khi cắt bớt để giữ kích thước tối thiểu nếu được
+        if low < 0:
+            low, high = 0, high - low
+        if high > limit:
+            low, high = low - (high - limit), limit
+        box.append((max(0, int(low)), min(limit, int(round(high)))))
+    (left, right), (top, bottom) = box
+    return left, top, right, bottom
+
+
+def crop_image(image_bytes, box, quality=JPEG_QUALITY):
+    """JPEG of the (left, top, right, bottom) region of an image"""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        cropped = img.crop(box)
+        if cropped.mode != 'RGB':
+            cropped = cropped.convert('RGB')
+        buffer = io.BytesIO()
+        cropped.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def load_image_bytes(image):
+    """Bytes of an upload, a local file or an image URL (None if the download fails)"""
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+
+    if image.startswith('http'):
+        # Tối ưu hóa kích thước ảnh nếu là link Cloudinary để tránh tải ảnh gốc quá lớn
+        if 'res.cloudinary.com' in image and '/upload/' in image and '/upload/w_' not in image:
+            image = image.replace('/upload/', '/upload/w_800,c_limit,q_auto/')
+
+        response = get_session('download').get(image, timeout=15)
+        if response.status_code != 200:
+            logging.error(f"Could not download image from {image}")
+            return None
+        return response.content
+
+    with open(image, 'rb') as image_file:
+        return image_file.read()
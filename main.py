@@ -2,5 +2,11 @@ from app import create_app
 
 app = create_app()
 
+# Dựng ma trận gợi ý sản phẩm trên thread nền ngay khi worker khởi động, request không phải chờ
+from extensions import db
+from recommender import product_recommender
+with app.app_context():
+    product_recommender.start(db.engine)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=False)
\ No newline at end of file
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import logging
+import sqlite3
+import contextvars
+from contextlib import contextmanager
+
+import shared_state
+
+# Giới hạn trên (giây) của các bucket histogram
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0)
+
+_current_timer = contextvars.ContextVar('stage_timer', default=None)
+
+
+class StageTimer:
+    """Per-stage durations of one skin analysis (stages that repeat are summed)"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = {}
+
+    def add(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def as_dict(self):
+        """Timings in milliseconds, for storing with the analysis"""
+        return {stage: round(seconds * 1000, 1) for stage, seconds in self.timings.items()}
+
+
+@contextmanager
+def stage_timer():
+    """Make a new StageTimer current for this context; timed() calls below record into it"""
+    timer = StageTimer()
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+
+
+@contextmanager
+def timed(stage):
+    """Time a block as `stage` of the current analysis (no-op outside stage_timer())"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        # asyncio.to_thread và asyncio.gather sao chép context, nên cùng một timer được dùng chung
+        timer.add(stage, time.perf_counter() - started)
+
+
+class HistogramStore:
+    """Prometheus-style histograms labelled by stage, kept in a SQLite file shared by all worker processes"""
+
+    def __init__(self, name, help_text, buckets=STAGE_BUCKETS, filename='metrics.sqlite3'):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.filename = filename
+
+    def observe(self, timings):
+        """Record {stage: seconds} in one transaction"""
+        if not timings:
+            return
+        try:
+            with shared_state.immediate_transaction(self._conn()) as conn:
+                for stage, seconds in timings.items():
+                    row = conn.execute(
+                        'SELECT counts, total, count FROM histograms WHERE metric = ? AND stage = ?',
+                        (self.name, stage)
+                    ).fetchone()
+                    counts, total, count = (json.loads(row[0]), row[1], row[2]) if row else ([0] * (len(self.buckets) + 1), 0.0, 0)
+                    counts[self._bucket_index(seconds)] += 1
+                    conn.execute(
+                        'INSERT OR REPLACE INTO histograms (metric, stage, counts, total, count) VALUES (?, ?, ?, ?, ?)',
+                        (self.name, stage, json.dumps(counts), total + seconds, count + 1)
+                    )
+        except sqlite3.Error as e:
+            logging.warning(f"Metrics: could not record {self.name} ({e})")
+
+    def render(self):
+        """Prometheus text exposition of every stage"""
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        try:
+            rows = self._conn().execute(
+                'SELECT stage, counts, total, count FROM histograms WHERE metric = ? ORDER BY stage',
+                (self.name,)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logging.warning(f"Metrics: could not read {self.name} ({e})")
+            rows = []
+        for stage, counts, total, count in rows:
+            cumulative = 0
+            for upper, bucket_count in zip(self.buckets + (float('inf'),), json.loads(counts)):
+                cumulative += bucket_count
+                le = '+Inf' if upper == float('inf') else repr(upper)
+                lines.append(f'{self.name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{self.name}_count{{stage="{stage}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def _bucket_index(self, seconds):
+        for index, upper in enumerate(self.buckets):
+            if seconds <= upper:
+                return index
+        return len(self.buckets)
+
+    def _conn(self):
+        return shared_state.local_connection(self.filename, (
+            'CREATE TABLE IF NOT EXISTS histograms ('
+            ' metric TEXT NOT NULL,'
+            ' stage TEXT NOT NULL,'
+            ' counts TEXT NOT NULL,'
+            ' total REAL NOT NULL,'
+            ' count INTEGER NOT NULL,'
+            ' PRIMARY KEY (metric, stage))',
+        ))
+
+
+skin_analysis_stages = HistogramStore(
+    'beautyai_skin_analysis_stage_seconds',
+    'Time spent in each stage of a skin analysis (upload, download, normalize, rate limit, Face++ calls, DB)',
+)
+
+# Để trống thì /metrics không cần xác thực
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+
+def render_all():
+    return skin_analysis_stages.render()
@@ -0,0 +1,215 @@
+"""
+Versioned schema migrations.
+
+    python migrations.py            # apply pending migrations
+    python migrations.py status     # list migrations and whether they are applied
+
+On PostgreSQL, run this script once per deploy before starting gunicorn
+(render.yaml does): create_app() does not migrate there by default, because
+indexes are built with CREATE INDEX CONCURRENTLY, which must not run while
+other workers are booting. On SQLite/MySQL create_app() runs upgrade() at
+start-up. AUTO_MIGRATE=true/false overrides either default. This script
+builds its app with create_app(startup_tasks=False), so it works on a schema
+from any earlier version: nothing that needs the new columns runs before
+upgrade().
+
+db.create_all() (in create_app) creates missing tables together with the
+indexes declared on the models, and every upgrade() starts with
+ensure_columns(), which adds new columns to existing tables. Anything else an
+existing database needs (indexes on existing tables, data fixes) is a
+numbered migration below. Applied versions
+are recorded in the schema_migrations table. Migrations must be idempotent: a
+migration that fails half way is run again on the next upgrade().
+"""
+
+import sys
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import inspect, text, MetaData, Table, Column, Integer, String, DateTime
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+from extensions import db
+from db_schema import ensure_columns
+
+_metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+# Khóa advisory của PostgreSQL để chỉ một worker gunicorn chạy migration tại một thời điểm
+_PG_LOCK_KEY = 7352410118
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """Register fn(engine) as migration `version`"""
+    def decorator(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+# --- Helpers -------------------------------------------------------------------------
+
+def _model_index(name):
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name == name:
+                return index
+    raise KeyError(f"No index named {name} is declared on the models")
+
+
+def create_indexes(engine, names):
+    """Create indexes declared on the models (by name) that the database does not have yet.
+
+    On PostgreSQL they are built with CREATE INDEX CONCURRENTLY, so writes to
+    the table are not blocked while the index is built; an INVALID index left
+    by an interrupted build is dropped and built again.
+    """
+    inspector = inspect(engine)
+    for name in names:
+        index = _model_index(name)
+        existing = {i['name'] for i in inspector.get_indexes(index.table.name)}
+
+        if engine.dialect.name == 'postgresql':
+            _create_index_concurrently(engine, index)
+        elif name not in existing:
+            logging.info(f"Creating index {name} on {index.table.name}")
+            with engine.begin() as conn:
+                conn.execute(CreateIndex(index, if_not_exists=engine.dialect.name != 'mysql'))
+
+
+def _create_index_concurrently(engine, index):
+    # CONCURRENTLY không chạy được trong transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        valid = conn.execute(text(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+        ), {'name': index.name}).scalar()
+        if valid:
+            return
+        if valid is False:
+            logging.warning(f"Index {index.name} is INVALID (interrupted build); rebuilding it")
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}"))
+
+        logging.info(f"Creating index {index.name} on {index.table.name} (concurrently)")
+        ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+        conn.execute(text(ddl.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1)))
+
+
+# --- Migrations ----------------------------------------------------------------------
+
+@migration(1, 'hot query indexes')
+def _hot_query_indexes(engine):
+    create_indexes(engine, (
+        'ix_product_active_date_added',
+        'ix_product_category_id',
+        'ix_product_skin_type',
+        'ix_review_product_date',
+        'ix_review_user_date',
+        'ix_blog_post_published_date',
+        'ix_blog_comment_post_date',
+        'ix_chat_message_user_date',
+        'ix_skin_analysis_user_date',
+        'ix_order_user_date',
+        'ix_order_item_order_id',
+    ))
+
+
+@migration(2, 'normalized blog post tags')
+def _blog_post_tags(engine):
+    # Bảng tag/post_tag do create_all tạo; điền từ chuỗi tags của các bài đã có
+    from blog_tags import backfill_tags
+    backfill_tags(engine)
+
+
+# --- Runner --------------------------------------------------------------------------
+
+@contextmanager
+def _migration_lock(engine):
+    """Yield True if this process may migrate; on PostgreSQL only the holder of the advisory lock may.
+
+    The lock is only tried, never waited for: a process blocked in
+    pg_advisory_lock keeps a snapshot open, and CREATE INDEX CONCURRENTLY in
+    the process holding the lock would wait for that snapshot forever.
+    """
+    if engine.dialect.name != 'postgresql':
+        yield True
+        return
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        acquired = conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {'key': _PG_LOCK_KEY}).scalar()
+        if not acquired:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': _PG_LOCK_KEY})
+
+
+def applied_versions(engine):
+    _metadata.create_all(engine)
+    with engine.connect() as conn:
+        return {row.version for row in conn.execute(schema_migrations.select())}
+
+
+def upgrade(engine=None):
+    """Bring the database schema up to date; returns the versions applied by this call,
+    or None if another process is migrating (PostgreSQL) and this one skipped"""
+    engine = engine or db.engine
+    applied = []
+    with _migration_lock(engine) as acquired:
+        if not acquired:
+            logging.info("Another process is running migrations; skipping")
+            return None
+        ensure_columns()
+        done = applied_versions(engine)
+        for version, name, fn in MIGRATIONS:
+            if version in done:
+                continue
+            logging.info(f"Applying migration {version}: {name}")
+            fn(engine)
+            try:
+                with engine.begin() as conn:
+                    conn.execute(schema_migrations.insert().values(
+                        version=version, name=name, applied_at=datetime.utcnow()
+                    ))
+            except IntegrityError:
+                # Worker khác (SQLite/MySQL không có khóa) đã ghi nhận cùng migration
+                pass
+            applied.append(version)
+    return applied
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else 'upgrade'
+    if command not in ('upgrade', 'status'):
+        print("Usage: python migrations.py [upgrade|status]")
+        return 2
+
+    # Không chạy các việc lúc khởi động của create_app() (upgrade, index tìm kiếm, dọn job phân tích):
+    # chúng cần schema mới, trong khi ở đây schema có thể vẫn là của phiên bản trước
+    from app import create_app
+    app = create_app(startup_tasks=False)
+    with app.app_context():
+        if command == 'upgrade':
+            applied = upgrade()
+            if applied is None:
+                print("❌ Another process holds the migration lock; run again once it has finished")
+                return 1
+            print(f"✅ Applied migrations: {applied}" if applied else "✅ Database schema is up to date")
+        else:
+            done = applied_versions(db.engine)
+            for version, name, _ in MIGRATIONS:
+                print(f"{'✅' if version in done else '⏳'} {version:>3} {name}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,16 @@
 import logging
-logging.basicConfig(level=logging.DEBUG)
-logging.debug("Starting models.py")
+logger = logging.getLogger(__name__)
 from sqlalchemy.orm import clear_mappers
 clear_mappers()
-logging.debug("Cleared mappers")
+logger.debug("Cleared mappers")
 from extensions import db
 from flask_login import UserMixin
+from sqlalchemy import null
+from search_index import product_search, blog_search
+from change_log import product_changes, blog_post_changes
+from blog_tags import sync_tags, normalize_tags
+import json
+import zlib
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
@@ -42,6 +47,12 @@ class Category(db.Model):
 
 class Product(db.Model):
     __tablename__ = 'product'
+    __table_args__ = (
+        # Danh sách sản phẩm: lọc is_active, sắp xếp/cursor theo (date_added, id)
+        db.Index('ix_product_active_date_added', 'is_active', 'date_added', 'id'),
+        db.Index('ix_product_category_id', 'category_id'),
+        db.Index('ix_product_skin_type', 'skin_type'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text)
@@ -55,29 +66,169 @@ class Product(db.Model):
     date_added = db.Column(db.DateTime, default=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
     
+    # Tổng hợp đánh giá, cập nhật trong add_review (backfill: backfill_ratings.py)
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_1 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_2 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_3 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_4 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_5 = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
     # Relationships
     reviews = db.relationship('Review', backref='product', lazy=True)
     order_items = db.relationship('OrderItem', backref='product', lazy=True)
     
     @property
     def average_rating(self):
-        if self.reviews:
-            return sum(review.rating for review in self.reviews) / len(self.reviews)
+        if self.rating_count:
+            return self.rating_sum / self.rating_count
         return 0
+    
+    @property
+    def rating_histogram(self):
+        """{stars: number of reviews}, 5 stars first"""
+        return {stars: getattr(self, f'rating_{stars}') or 0 for stars in range(5, 0, -1)}
+    
+    @classmethod
+    def add_rating(cls, product_id, rating):
+        """Count one new `rating`-star review with a single atomic UPDATE (commit with the review)"""
+        table = cls.__table__
+        star_column = table.c[f'rating_{rating}']
+        db.session.execute(table.update().where(table.c.id == product_id).values({
+            table.c.rating_count: table.c.rating_count + 1,
+            table.c.rating_sum: table.c.rating_sum + rating,
+            star_column: star_column + 1,
+        }))
+        # UPDATE Core không qua mapper event: báo cho recommender điểm đánh giá của sản phẩm đã đổi
+        product_changes.mark(db.session, product_id)
+
+# Thêm/sửa/xóa sản phẩm cập nhật luôn index tìm kiếm trong cùng transaction
+product_search.watch(Product)
+# Gợi ý sản phẩm (recommender.py) chỉ nạp lại những sản phẩm đã đổi sau khi commit
+product_changes.watch(Product, columns=('name', 'brand', 'description', 'ingredients', 'skin_type',
+                                        'category_id', 'is_active'))
+
+class ProductNeighbor(db.Model):
+    """Precomputed most similar products of a product (TF-IDF cosine), written by similar_products.py"""
+    __tablename__ = 'product_neighbor'
+    __table_args__ = (
+        # Tìm các sản phẩm đang có một sản phẩm trong danh sách tương tự (cập nhật tăng dần)
+        db.Index('ix_product_neighbor_neighbor_id', 'neighbor_id'),
+    )
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), primary_key=True)
+    rank = db.Column(db.SmallInteger, primary_key=True)  # 0 = giống nhất
+    neighbor_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+
+# Các trường nhỏ của kết quả phân tích được lưu trong SkinAnalysis.summary
+SUMMARY_VERSION = 1
+SUMMARY_FIELDS = ('success', 'age', 'gender', 'confidence', 'backend', 'error', 'message',
+                  'analysis_width', 'analysis_height', 'face_rectangle', 'timings')
+
+
+def summarize_analysis_result(analysis_result):
+    """Compact, versioned summary of an analyze_skin() result (everything but the raw Face++ payload)"""
+    summary = {'v': SUMMARY_VERSION}
+    for field in SUMMARY_FIELDS:
+        if analysis_result.get(field) is not None:
+            summary[field] = analysis_result[field]
+    return summary
+
 
 class SkinAnalysis(db.Model):
     __tablename__ = 'skin_analysis'
+    __table_args__ = (
+        db.Index('ix_skin_analysis_user_date', 'user_id', 'date_analyzed'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     image_url = db.Column(db.String(500))
-    analysis_result = db.Column(db.JSON)  # Store Face++ API response
+    # Legacy: full analyze_skin() result of rows created before `summary`; emptied by backfill_analysis_summary.py
+    analysis_result = db.deferred(db.Column(db.JSON))
+    summary = db.Column(db.JSON)  # summarize_analysis_result(), see SUMMARY_VERSION
     skin_type = db.Column(db.String(50))
     skin_concerns = db.Column(db.JSON)  # Array of concerns like acne, wrinkles, etc.
     recommended_routine = db.Column(db.JSON)  # Recommended skincare routine
+    status = db.Column(db.String(20), default='completed')  # pending, processing, completed, failed
     date_analyzed = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Raw Face++ skin_analysis, only loaded when the results page draws it
+    payload = db.relationship('SkinAnalysisPayload', uselist=False, lazy='select',
+                              cascade='all, delete-orphan')
+
+    PENDING_STATUSES = ('pending', 'processing')
+
+    @property
+    def is_pending(self):
+        return self.status in self.PENDING_STATUSES
+
+    @property
+    def result_summary(self):
+        """Summary of the stored result; rows not yet backfilled are summarized on the fly"""
+        if self.summary is not None:
+            return self.summary
+        if self.analysis_result:
+            return summarize_analysis_result(self.analysis_result)
+        return {}
+
+    @property
+    def raw_skin_analysis(self):
+        """Raw Face++ skin_analysis payload (loads the payload row)"""
+        if self.payload is not None:
+            return self.payload.load()
+        if self.summary is None and self.analysis_result:
+            return self.analysis_result.get('skin_analysis')
+        return None
+
+    @property
+    def full_result(self):
+        """The analyze_skin() result rebuilt from the stored columns, for the results page scripts"""
+        result = dict(self.result_summary)
+        result.pop('v', None)
+        result['skin_type'] = self.skin_type
+        result['concerns'] = self.skin_concerns or []
+        result['recommended_routine'] = self.recommended_routine or {}
+        raw = self.raw_skin_analysis
+        if raw is not None:
+            result['skin_analysis'] = raw
+        return result
+
+    def apply_result(self, analysis_result, status='completed'):
+        """Store an analyze_skin() result on this row"""
+        self.summary = summarize_analysis_result(analysis_result)
+        self.skin_type = analysis_result.get('skin_type', 'normal')
+        self.skin_concerns = analysis_result.get('concerns', [])
+        self.recommended_routine = analysis_result.get('recommended_routine', {})
+        self.analysis_result = null()  # SQL NULL, không phải JSON 'null'
+        raw = analysis_result.get('skin_analysis')
+        if raw is None:
+            self.payload = None
+        elif self.payload is None:
+            self.payload = SkinAnalysisPayload(data=SkinAnalysisPayload.compress(raw))
+        else:
+            self.payload.data = SkinAnalysisPayload.compress(raw)
+        self.status = status
+
+class SkinAnalysisPayload(db.Model):
+    """zlib-compressed JSON of the raw Face++ skin_analysis, one row per SkinAnalysis"""
+    __tablename__ = 'skin_analysis_payload'
+    analysis_id = db.Column(db.Integer, db.ForeignKey('skin_analysis.id'), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    @staticmethod
+    def compress(raw):
+        return zlib.compress(json.dumps(raw, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    def load(self):
+        return json.loads(zlib.decompress(self.data).decode('utf-8'))
+
 class Order(db.Model):
     __tablename__ = 'order'
+    __table_args__ = (
+        db.Index('ix_order_user_date', 'user_id', 'date_created'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     total_amount = db.Column(db.Float, nullable=False)
@@ -94,6 +245,9 @@ class Order(db.Model):
 
 class OrderItem(db.Model):
     __tablename__ = 'order_item'
+    __table_args__ = (
+        db.Index('ix_order_item_order_id', 'order_id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
@@ -102,6 +256,10 @@ class OrderItem(db.Model):
 
 class Review(db.Model):
     __tablename__ = 'review'
+    __table_args__ = (
+        db.Index('ix_review_product_date', 'product_id', 'date_created'),
+        db.Index('ix_review_user_date', 'user_id', 'date_created'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
@@ -113,6 +271,9 @@ class Review(db.Model):
 
 class BlogPost(db.Model):
     __tablename__ = 'blog_post'
+    __table_args__ = (
+        db.Index('ix_blog_post_published_date', 'is_published', 'date_created', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
@@ -127,9 +288,36 @@ class BlogPost(db.Model):
     
     # Relationships
     comments = db.relationship('BlogComment', backref='post', lazy=True, cascade='all, delete-orphan')
+    # Bảng post_tag được đồng bộ từ chuỗi tags khi flush (blog_tags.sync_tags)
+    tag_list = db.relationship('Tag', secondary='post_tag', lazy=True, backref=db.backref('posts', lazy='dynamic'))
+
+    @property
+    def tag_names(self):
+        return normalize_tags(self.tags)
+
+# Tạo/sửa bài viết cập nhật index tìm kiếm; bài chưa xuất bản được lọc khi truy vấn
+blog_search.watch(BlogPost)
+sync_tags(BlogPost)
+blog_post_changes.watch(BlogPost, columns=('tags', 'is_published'))
+
+class Tag(db.Model):
+    __tablename__ = 'tag'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)  # Đã chuẩn hóa: chữ thường, bỏ khoảng trắng thừa
+
+post_tag = db.Table(
+    'post_tag',
+    db.Column('post_id', db.Integer, db.ForeignKey('blog_post.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True),
+    # Các bài của một tag (trang tag); khóa chính (post_id, tag_id) phục vụ chiều ngược lại
+    db.Index('ix_post_tag_tag_post', 'tag_id', 'post_id'),
+)
 
 class BlogComment(db.Model):
     __tablename__ = 'blog_comment'
+    __table_args__ = (
+        db.Index('ix_blog_comment_post_date', 'post_id', 'date_created'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     post_id = db.Column(db.Integer, db.ForeignKey('blog_post.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -141,6 +329,9 @@ class BlogComment(db.Model):
 
 class ChatMessage(db.Model):
     __tablename__ = 'chat_message'
+    __table_args__ = (
+        db.Index('ix_chat_message_user_date', 'user_id', 'date_created'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     message = db.Column(db.Text, nullable=False)
@@ -0,0 +1,137 @@
+import os
+import math
+import time
+import logging
+import threading
+from datetime import datetime
+from flask import current_app
+from itsdangerous import URLSafeSerializer, BadSignature
+from sqlalchemy import and_, or_
+
+# Tổng số dòng chỉ dùng để hiển thị "Trang x / y", nên được cache thay vì COUNT(*) mỗi lần xem trang
+COUNT_CACHE_SECONDS = int(os.environ.get('PAGINATION_COUNT_CACHE_SECONDS', 60))
+
+_count_cache = {}
+_count_lock = threading.Lock()
+
+
+def cached_count(query, key, ttl=None):
+    """COUNT(*) of query, cached per process for ttl seconds under key (e.g. the listing and its filters)"""
+    ttl = COUNT_CACHE_SECONDS if ttl is None else ttl
+    now = time.monotonic()
+    with _count_lock:
+        entry = _count_cache.get(key)
+        if entry and entry[1] > now:
+            return entry[0]
+    total = query.order_by(None).count()
+    with _count_lock:
+        _count_cache[key] = (total, now + ttl)
+    return total
+
+
+def _serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='keyset-cursor')
+
+
+def _dump_value(value):
+    return {'dt': value.isoformat()} if isinstance(value, datetime) else value
+
+
+def _load_value(value):
+    return datetime.fromisoformat(value['dt']) if isinstance(value, dict) else value
+
+
+def encode_cursor(values, direction, page):
+    """Opaque, signed token for the page after (or before) the row with these sort key values"""
+    return _serializer().dumps({'k': [_dump_value(v) for v in values], 'd': direction, 'p': page})
+
+
+def decode_cursor(token):
+    """(values, direction, page) of a cursor token, or None if it is missing or was tampered with"""
+    if not token:
+        return None
+    try:
+        data = _serializer().loads(token)
+        return [_load_value(v) for v in data['k']], data['d'], int(data['p'])
+    except (BadSignature, KeyError, TypeError, ValueError) as e:
+        logging.warning(f"Ignoring invalid pagination cursor: {e}")
+        return None
+
+
+class KeysetPagination:
+    """One page of a keyset (cursor) paginated query.
+
+    Rows are ordered by columns, all descending, and the last column must be
+    unique (the primary key) so the order is total. A page is fetched with
+    WHERE (columns) < (cursor values) ORDER BY columns DESC LIMIT per_page + 1,
+    so it costs the same on page 500 as on page 1 given an index on the
+    columns. Templates tell it apart from Flask-SQLAlchemy's Pagination by
+    is_keyset and link to next_cursor / prev_cursor instead of page numbers.
+    """
+
+    is_keyset = True
+
+    def __init__(self, query, columns, cursor=None, per_page=20, total=None):
+        self.columns = tuple(columns)
+        self.per_page = per_page
+        self.total = total
+
+        decoded = decode_cursor(cursor)
+        values, direction, self.page = decoded if decoded else (None, 'next', 1)
+
+        if values is None:
+            rows = query.order_by(*[c.desc() for c in self.columns]).limit(per_page + 1).all()
+            self.has_prev = False
+            self.has_next = len(rows) > per_page
+            rows = rows[:per_page]
+        elif direction == 'prev':
+            # Đi lùi: lấy các dòng đứng trước cursor theo thứ tự ngược rồi đảo lại
+            rows = query.filter(self._after(values, reverse=True)).order_by(
+                *[c.asc() for c in self.columns]
+            ).limit(per_page + 1).all()
+            self.has_prev = len(rows) > per_page
+            self.has_next = True
+            rows = list(reversed(rows[:per_page]))
+            if not self.has_prev:
+                self.page = 1
+        else:
+            rows = query.filter(self._after(values)).order_by(
+                *[c.desc() for c in self.columns]
+            ).limit(per_page + 1).all()
+            self.has_prev = True
+            self.has_next = len(rows) > per_page
+            rows = rows[:per_page]
+
+        self.items = rows
+
+    def _after(self, values, reverse=False):
+        """(c1, c2, ...) < (v1, v2, ...) written out so it works on every database"""
+        clauses = []
+        for index, (column, value) in enumerate(zip(self.columns, values)):
+            equal = [c == v for c, v in zip(self.columns[:index], values[:index])]
+            clauses.append(and_(*equal, column > value if reverse else column < value))
+        # Điều kiện thừa trên cột đầu cho phép index nhảy thẳng tới cursor thay vì duyệt từ đầu
+        first, value = self.columns[0], values[0]
+        return and_(first >= value if reverse else first <= value, or_(*clauses))
+
+    def _key(self, row):
+        return [getattr(row, column.key) for column in self.columns]
+
+    @property
+    def next_cursor(self):
+        if not (self.has_next and self.items):
+            return None
+        return encode_cursor(self._key(self.items[-1]), 'next', self.page + 1)
+
+    @property
+    def prev_cursor(self):
+        if not (self.has_prev and self.items):
+            return None
+        return encode_cursor(self._key(self.items[0]), 'prev', max(self.page - 1, 1))
+
+    @property
+    def pages(self):
+        """Approximate page count from the (cached) total"""
+        if not self.total:
+            return self.page
+        return max(math.ceil(self.total / self.per_page), self.page)
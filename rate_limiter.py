@@ -0,0 +1,112 @@
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+
+import shared_state
+
+
+class TokenBucketLimiter:
+    """Token-bucket rate limiter whose buckets live in a SQLite file shared by all worker processes"""
+
+    def __init__(self, buckets, filename='rate_limiter.sqlite3'):
+        # buckets: name -> (rate in tokens per second, burst capacity)
+        self.buckets = dict(buckets)
+        self.filename = filename
+
+    def try_acquire(self, bucket, tokens=1):
+        """Take tokens without blocking; return True if they were available"""
+        return self._take(bucket, tokens) == 0
+
+    def acquire(self, bucket, tokens=1, timeout=None):
+        """Block until tokens are available; return False if timeout (seconds) expires first"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            retry_after = self._take(bucket, tokens)
+            if retry_after == 0:
+                return True
+            if deadline is not None and time.time() + retry_after > deadline:
+                logging.warning(f"Rate limiter: gave up waiting for '{bucket}' bucket")
+                return False
+            logging.info(f"Rate limiting '{bucket}': waiting {retry_after:.2f} seconds")
+            time.sleep(retry_after)
+
+    async def acquire_async(self, bucket, tokens=1, timeout=None):
+        """Awaitable acquire() that yields to the event loop instead of sleeping the thread"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            # BEGIN IMMEDIATE có thể chờ khóa file tới busy timeout: chạy trên thread để không chặn event loop
+            retry_after = await asyncio.to_thread(self._take, bucket, tokens)
+            if retry_after == 0:
+                return True
+            if deadline is not None and time.time() + retry_after > deadline:
+                logging.warning(f"Rate limiter: gave up waiting for '{bucket}' bucket")
+                return False
+            logging.info(f"Rate limiting '{bucket}': waiting {retry_after:.2f} seconds")
+            await asyncio.sleep(retry_after)
+
+    def retry_after(self, bucket, tokens=1):
+        """Seconds until tokens would be available, without taking any"""
+        rate, burst = self.buckets[bucket]
+        now = time.time()
+        try:
+            row = self._conn().execute(
+                'SELECT tokens, updated_at FROM buckets WHERE name = ?', (bucket,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Rate limiter: state unavailable ({e})")
+            return 0.0
+        available = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+        return 0.0 if available >= tokens else (tokens - available) / rate
+
+    def _take(self, bucket, tokens):
+        """Atomically refill and take tokens; return 0 on success, otherwise seconds to wait"""
+        rate, burst = self.buckets[bucket]
+        if tokens > burst:
+            raise ValueError(f"Cannot take {tokens} tokens from '{bucket}' (burst {burst})")
+
+        try:
+            with shared_state.immediate_transaction(self._conn()) as conn:
+                now = time.time()
+                row = conn.execute(
+                    'SELECT tokens, updated_at FROM buckets WHERE name = ?', (bucket,)
+                ).fetchone()
+                available = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+
+                if available >= tokens:
+                    available -= tokens
+                    retry_after = 0
+                else:
+                    retry_after = (tokens - available) / rate
+
+                conn.execute(
+                    'INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)',
+                    (bucket, available, now)
+                )
+                return retry_after
+        except sqlite3.Error as e:
+            # Không chặn request khi file trạng thái lỗi
+            logging.warning(f"Rate limiter: state unavailable, allowing request ({e})")
+            return 0
+
+    def _conn(self):
+        return shared_state.local_connection(self.filename, (
+            'CREATE TABLE IF NOT EXISTS buckets ('
+            ' name TEXT PRIMARY KEY,'
+            ' tokens REAL NOT NULL,'
+            ' updated_at REAL NOT NULL)',
+        ))
+
+
+# Mặc định giữ nhịp cũ: 1 request mỗi 2 giây cho mỗi endpoint, trên toàn bộ các worker
+facepp_limiter = TokenBucketLimiter({
+    'detect': (
+        float(os.environ.get('FACEPP_DETECT_RATE', 0.5)),
+        float(os.environ.get('FACEPP_DETECT_BURST', 1)),
+    ),
+    'skinanalyze': (
+        float(os.environ.get('FACEPP_SKINANALYZE_RATE', 0.5)),
+        float(os.environ.get('FACEPP_SKINANALYZE_BURST', 1)),
+    ),
+})
@@ -0,0 +1,375 @@
+"""
+Product recommendations for a skin analysis.
+
+Every product is a row of a product x feature matrix built once per worker
+from its skin type, its ingredients (matched against a list of active
+ingredients), the kind of product its category is and its average rating.
+An analysis becomes a vector over the same features from its skin type, the
+severity of each detected concern and the age bucket, and one matrix-vector
+product scores the whole catalog. The matrix is refreshed row by row from
+product_changes when products are added, edited or deleted, and rebuilt in
+full every RECOMMENDER_REBUILD_SECONDS (or when the change log no longer goes
+back far enough). Full builds run on a background thread, started with the
+server (main.py), and requests keep scoring against the previous matrix until
+the new one is swapped in; only a worker that has no matrix yet waits for its
+first build, at most FIRST_BUILD_TIMEOUT seconds.
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from functools import lru_cache
+
+import numpy as np
+
+from change_log import product_changes
+from routine_rules import age_bucket
+from search_index import fold_text
+
+SKIN_TYPES = ('oily', 'dry', 'combination', 'sensitive', 'normal')
+
+# Sản phẩm 'all' hợp với mọi loại da nhưng xếp sau sản phẩm dành riêng cho loại da đó
+ALL_SKIN_TYPES_WEIGHT = 0.6
+ALL_SKIN_TYPES_CODE = -1
+
+# Hoạt chất -> các cụm từ nhận diện trong thành phần (đã bỏ dấu, chữ thường)
+ACTIVE_INGREDIENTS = (
+    ('salicylic_acid', ('salicylic', 'bha', 'beta hydroxy')),
+    ('benzoyl_peroxide', ('benzoyl peroxide',)),
+    ('aha', ('glycolic', 'lactic acid', 'mandelic', 'aha')),
+    ('azelaic_acid', ('azelaic',)),
+    ('niacinamide', ('niacinamide', 'vitamin b3')),
+    ('zinc', ('zinc pca', 'zinc gluconate', 'zinc oxide')),
+    ('tea_tree', ('tea tree', 'melaleuca')),
+    ('clay', ('kaolin', 'bentonite', 'clay', 'charcoal')),
+    ('vitamin_c', ('vitamin c', 'ascorbic', 'ascorbyl')),
+    ('brightening', ('arbutin', 'tranexamic', 'glutathione', 'kojic', 'licorice')),
+    ('retinoid', ('retinol', 'retinal', 'retinyl', 'adapalene', 'bakuchiol')),
+    ('peptide', ('peptide', 'collagen')),
+    ('caffeine', ('caffeine', 'vitamin k')),
+    ('hyaluronic_acid', ('hyaluronic', 'sodium hyaluronate')),
+    ('ceramide', ('ceramide', 'squalane', 'shea')),
+    ('glycerin', ('glycerin', 'urea', 'panthenol')),
+    ('soothing', ('centella', 'cica', 'madecassoside', 'aloe', 'allantoin', 'thermal', 'green tea', 'oat')),
+    ('sunscreen_filter', ('titanium dioxide', 'zinc oxide', 'avobenzone', 'octinoxate', 'uvinul', 'tinosorb',
+                          'mexoryl', 'anthelios')),
+)
+
+# Loại sản phẩm suy ra từ tên danh mục
+CATEGORY_KINDS = (
+    ('cleanser', ('sua rua mat', 'cleanser', 'rua mat')),
+    ('makeup_remover', ('tay trang', 'micellar')),
+    ('toner', ('toner', 'nuoc hoa hong')),
+    ('serum', ('serum', 'essence', 'ampoule', 'tinh chat')),
+    ('moisturizer', ('kem duong', 'duong am', 'moisturizer', 'lotion')),
+    ('sunscreen', ('chong nang', 'sunscreen', 'spf')),
+    ('mask', ('mat na', 'mask')),
+)
+
+FEATURES = (
+    tuple(f'skin:{skin_type}' for skin_type in SKIN_TYPES)
+    + tuple(f'ingredient:{name}' for name, _ in ACTIVE_INGREDIENTS)
+    + tuple(f'kind:{name}' for name, _ in CATEGORY_KINDS)
+    + ('rating',)
+)
+FEATURE_INDEX = {name: index for index, name in enumerate(FEATURES)}
+
+# Trọng số của vector phân tích: loại da, vấn đề da (nhân với mức độ), nhóm tuổi
+SKIN_TYPE_WEIGHT = 2.0
+RATING_WEIGHT = 0.5
+
+SKIN_TYPE_PREFERENCES = {
+    'oily': {'ingredient:niacinamide': 0.6, 'ingredient:salicylic_acid': 0.5, 'ingredient:zinc': 0.4,
+             'ingredient:clay': 0.3, 'ingredient:ceramide': -0.3},
+    'dry': {'ingredient:hyaluronic_acid': 0.7, 'ingredient:ceramide': 0.7, 'ingredient:glycerin': 0.5,
+            'ingredient:clay': -0.5, 'ingredient:salicylic_acid': -0.3},
+    'combination': {'ingredient:niacinamide': 0.5, 'ingredient:hyaluronic_acid': 0.4},
+    'sensitive': {'ingredient:soothing': 0.8, 'ingredient:ceramide': 0.5, 'ingredient:glycerin': 0.3,
+                  'ingredient:retinoid': -0.6, 'ingredient:aha': -0.5, 'ingredient:benzoyl_peroxide': -0.5},
+    'normal': {'ingredient:hyaluronic_acid': 0.3, 'ingredient:vitamin_c': 0.3},
+}
+
+CONCERN_PREFERENCES = {
+    'acne': {'ingredient:salicylic_acid': 1.0, 'ingredient:benzoyl_peroxide': 0.9, 'ingredient:azelaic_acid': 0.7,
+             'ingredient:niacinamide': 0.6, 'ingredient:tea_tree': 0.6, 'ingredient:zinc': 0.5,
+             'kind:cleanser': 0.3},
+    'blackheads': {'ingredient:salicylic_acid': 1.0, 'ingredient:aha': 0.6, 'ingredient:clay': 0.6,
+                   'kind:mask': 0.3, 'kind:cleanser': 0.2},
+    'large_pores': {'ingredient:niacinamide': 0.8, 'ingredient:salicylic_acid': 0.6, 'ingredient:clay': 0.4},
+    'dark_spots': {'ingredient:vitamin_c': 1.0, 'ingredient:brightening': 0.9, 'ingredient:niacinamide': 0.6,
+                   'ingredient:azelaic_acid': 0.5, 'ingredient:sunscreen_filter': 0.5, 'kind:sunscreen': 0.5,
+                   'kind:serum': 0.3},
+    'wrinkles': {'ingredient:retinoid': 1.0, 'ingredient:peptide': 0.8, 'ingredient:vitamin_c': 0.4,
+                 'ingredient:hyaluronic_acid': 0.3, 'kind:serum': 0.3, 'kind:sunscreen': 0.3},
+    'dark_circles': {'ingredient:caffeine': 1.0, 'ingredient:peptide': 0.6, 'ingredient:retinoid': 0.3},
+}
+
+AGE_PREFERENCES = {
+    'under_30': {'kind:sunscreen': 0.3},
+    'over_30': {'ingredient:retinoid': 0.5, 'ingredient:peptide': 0.5, 'ingredient:vitamin_c': 0.2,
+                'kind:sunscreen': 0.4},
+}
+
+# Khóa trong kết quả Face++ Skin Analyze của từng vấn đề da (xem FaceAnalyzer._identify_concerns_from_analysis)
+CONCERN_RESULT_KEYS = {
+    'acne': ('acne',),
+    'blackheads': ('blackhead',),
+    'dark_circles': ('dark_circle',),
+    'dark_spots': ('skin_spot',),
+    'wrinkles': ('forehead_wrinkle', 'eye_finelines'),
+    'large_pores': ('pores_left_cheek', 'pores_right_cheek', 'pores_forehead', 'pores_jaw'),
+}
+
+REBUILD_SECONDS = int(os.environ.get('RECOMMENDER_REBUILD_SECONDS', 3600))
+# Request đến trước khi worker có ma trận đầu tiên chờ tối đa chừng này giây rồi trả về danh sách rỗng
+FIRST_BUILD_TIMEOUT = 10
+
+
+def _phrase_matcher(groups, prefix):
+    """One regex for every phrase of every group; each match maps back to the feature of its group"""
+    feature_of = {}
+    for name, phrases in groups:
+        for phrase in phrases:
+            feature_of.setdefault(phrase, []).append(FEATURE_INDEX[f'{prefix}:{name}'])
+    alternatives = '|'.join(re.escape(phrase) for phrase in sorted(feature_of, key=len, reverse=True))
+    return re.compile(rf'(?<!\w)(?:{alternatives})(?!\w)'), feature_of
+
+
+_INGREDIENT_MATCHER = _phrase_matcher(ACTIVE_INGREDIENTS, 'ingredient')
+_CATEGORY_KIND_MATCHER = _phrase_matcher(CATEGORY_KINDS, 'kind')
+
+
+def _matched_features(matcher, text):
+    pattern, feature_of = matcher
+    return {feature for phrase in pattern.findall(text) for feature in feature_of[phrase]}
+
+
+@lru_cache(maxsize=1024)
+def _category_kind(category_name):
+    # Danh mục đầu tiên khớp trong CATEGORY_KINDS
+    features = _matched_features(_CATEGORY_KIND_MATCHER, fold_text(category_name))
+    return min(features) if features else None
+
+
+def product_features(skin_type, ingredients, category_name, average_rating):
+    """Feature row (float32) of one product"""
+    row = np.zeros(len(FEATURES), dtype=np.float32)
+    if skin_type in SKIN_TYPES:
+        row[FEATURE_INDEX[f'skin:{skin_type}']] = 1.0
+    else:
+        row[:len(SKIN_TYPES)] = ALL_SKIN_TYPES_WEIGHT
+
+    for feature in _matched_features(_INGREDIENT_MATCHER, fold_text(ingredients)):
+        row[feature] = 1.0
+
+    kind = _category_kind(category_name or '')
+    if kind is not None:
+        row[kind] = 1.0
+
+    row[FEATURE_INDEX['rating']] = (average_rating or 0) / 5.0
+    return row
+
+
+def concern_severities(skin_analysis):
+    """Severity 0-1 of each concern from a raw Face++ Skin Analyze result (empty if there is none)"""
+    severities = {}
+    for concern, keys in CONCERN_RESULT_KEYS.items():
+        values = [skin_analysis.get(key) for key in keys] if isinstance(skin_analysis, dict) else []
+        scores = [v.get('confidence', 1.0) for v in values if isinstance(v, dict) and v.get('value', 0) > 0]
+        if scores:
+            severities[concern] = float(max(scores))
+    return severities
+
+
+def analysis_vector(skin_type, concerns, age, severities=None):
+    """Feature weights of a skin analysis; concerns without a severity count as fully present"""
+    vector = np.zeros(len(FEATURES), dtype=np.float32)
+
+    def add(preferences, scale=1.0):
+        for feature, weight in preferences.items():
+            vector[FEATURE_INDEX[feature]] += weight * scale
+
+    if skin_type in SKIN_TYPES:
+        vector[FEATURE_INDEX[f'skin:{skin_type}']] = SKIN_TYPE_WEIGHT
+        add(SKIN_TYPE_PREFERENCES[skin_type])
+    for concern in concerns or ():
+        if concern in CONCERN_PREFERENCES:
+            add(CONCERN_PREFERENCES[concern], (severities or {}).get(concern, 1.0))
+    add(AGE_PREFERENCES[age_bucket(age if isinstance(age, (int, float)) else 25)])
+    vector[FEATURE_INDEX['rating']] = RATING_WEIGHT
+    return vector
+
+
+class ProductRecommender:
+    """Scores the whole catalog against an analysis with one matrix-vector product"""
+
+    def __init__(self, change_log=product_changes, rebuild_seconds=REBUILD_SECONDS):
+        self.change_log = change_log
+        self.rebuild_seconds = rebuild_seconds
+        self._lock = threading.Lock()
+        # (ids, ma trận, sản phẩm đang bán, loại da, id -> dòng) được thay cả khối để luồng đọc không cần khóa
+        self._state = None
+        self._seq = 0
+        self._built_at = 0.0
+        self._build_lock = threading.Lock()
+        self._build_thread = None
+        self._first_build = threading.Event()
+
+    # --- Building ---------------------------------------------------------------------
+
+    @staticmethod
+    def _rows_query(session, ids=None):
+        from models import Product, Category
+        query = session.query(
+            Product.id, Product.skin_type, Product.ingredients, Category.name,
+            Product.rating_sum, Product.rating_count, Product.is_active,
+        ).outerjoin(Category, Category.id == Product.category_id)
+        if ids is not None:
+            query = query.filter(Product.id.in_(ids))
+        return query
+
+    @staticmethod
+    def _encode(rows):
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        matrix = np.zeros((len(rows), len(FEATURES)), dtype=np.float32)
+        active = np.zeros(len(rows), dtype=bool)
+        skin_types = np.full(len(rows), ALL_SKIN_TYPES_CODE, dtype=np.int8)
+        for index, (_, skin_type, ingredients, category_name, rating_sum, rating_count, is_active) in enumerate(rows):
+            rating = rating_sum / rating_count if rating_count else 0
+            matrix[index] = product_features(skin_type, ingredients, category_name, rating)
+            active[index] = bool(is_active)
+            if skin_type in SKIN_TYPES:
+                skin_types[index] = SKIN_TYPES.index(skin_type)
+        return ids, matrix, active, skin_types
+
+    def _build_state(self, rows):
+        ids, matrix, active, skin_types = self._encode(rows)
+        row_of = {int(product_id): index for index, product_id in enumerate(ids)}
+        # Lưu chuyển vị (feature x sản phẩm) để vector @ matrix đọc bộ nhớ liên tục, nhanh gấp đôi
+        return ids, np.ascontiguousarray(matrix.T), active, skin_types, row_of
+
+    def load(self, rows):
+        """Replace the matrix with these (id, skin_type, ingredients, category name, rating_sum, rating_count, is_active) rows"""
+        self._state = self._build_state(rows)
+        self._built_at = time.monotonic()
+
+    def rebuild(self, session):
+        """Build the full matrix without holding the lock, then swap it in"""
+        seq = self.change_log.latest()
+        started = time.perf_counter()
+        rows = self._rows_query(session).all()
+        state = self._build_state(rows)
+        with self._lock:
+            # Thay cùng lúc với _seq: refresh() sau đó áp lại các thay đổi kể từ lúc bắt đầu build
+            self._state, self._seq, self._built_at = state, seq, time.monotonic()
+        logging.info(f"Recommender: built {len(rows)}x{len(FEATURES)} product matrix "
+                     f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def start(self, engine):
+        """Build the matrix on a background thread (called once per worker at start-up)"""
+        self._rebuild_in_background(engine)
+
+    def _rebuild_in_background(self, engine):
+        # Mỗi lúc chỉ một thread build; thread của process cha không còn sau khi gunicorn fork
+        with self._build_lock:
+            if self._build_thread is not None and self._build_thread.is_alive():
+                return
+            self._build_thread = threading.Thread(target=self._run_rebuild, args=(engine,),
+                                                  name='recommender-rebuild', daemon=True)
+            self._build_thread.start()
+
+    def _run_rebuild(self, engine):
+        from sqlalchemy.orm import Session
+        try:
+            with Session(engine) as session:
+                self.rebuild(session)
+        except Exception as e:
+            logging.warning(f"Recommender: rebuild failed ({e}); keeping the current matrix")
+        finally:
+            self._first_build.set()
+
+    def refresh(self, session, changed_ids):
+        """Reload the rows of these products (new ones are appended, deleted ones deactivated)"""
+        ids, matrix, active, skin_types, row_of = self._state
+        rows = self._rows_query(session, changed_ids).all()
+        new_ids, new_matrix, new_active, new_skin_types = self._encode(rows)
+
+        matrix, active, skin_types, row_of = matrix.copy(), active.copy(), skin_types.copy(), dict(row_of)
+        appended = []
+        for index, product_id in enumerate(new_ids.tolist()):
+            row = row_of.get(product_id)
+            if row is None:
+                appended.append(index)
+                continue
+            matrix[:, row], active[row], skin_types[row] = new_matrix[index], new_active[index], new_skin_types[index]
+        for product_id in set(changed_ids) - set(new_ids.tolist()):
+            if product_id in row_of:
+                active[row_of[product_id]] = False
+
+        if appended:
+            for offset, index in enumerate(appended):
+                row_of[int(new_ids[index])] = len(ids) + offset
+            ids = np.concatenate([ids, new_ids[appended]])
+            matrix = np.hstack([matrix, new_matrix[appended].T])
+            active = np.concatenate([active, new_active[appended]])
+            skin_types = np.concatenate([skin_types, new_skin_types[appended]])
+
+        self._state = (ids, matrix, active, skin_types, row_of)
+
+    def ensure_fresh(self, session):
+        """Apply logged product changes; full rebuilds are started in the background, never run here"""
+        if self._state is None:
+            self._rebuild_in_background(session.get_bind())
+            self._first_build.wait(FIRST_BUILD_TIMEOUT)
+            return
+        with self._lock:
+            if time.monotonic() - self._built_at > self.rebuild_seconds:
+                self._rebuild_in_background(session.get_bind())
+            seq, changed = self.change_log.since(self._seq)
+            if changed is None:
+                # Change log đã bị cắt bớt: chỉ bản build đầy đủ mới bắt kịp, trong lúc chờ dùng ma trận hiện tại
+                self._rebuild_in_background(session.get_bind())
+            elif changed:
+                self.refresh(session, changed)
+                self._seq = seq
+
+    # --- Scoring ----------------------------------------------------------------------
+
+    def top_k(self, vector, k=6, skin_type=None, exclude=()):
+        """Ids of the k best active products for an analysis vector, best first.
+
+        Products made for another skin type are left out, as before; 'all'
+        products are kept.
+        """
+        if self._state is None:
+            return []
+        ids, matrix, active, skin_types, row_of = self._state
+        scores = vector @ matrix
+        eligible = active.copy()
+        if skin_type in SKIN_TYPES:
+            eligible &= (skin_types == SKIN_TYPES.index(skin_type)) | (skin_types == ALL_SKIN_TYPES_CODE)
+        for product_id in exclude:
+            row = row_of.get(product_id)
+            if row is not None:
+                eligible[row] = False
+
+        # Chỉ chọn top-k trong các sản phẩm hợp lệ: argpartition rất chậm khi mảng có nhiều giá trị -inf trùng nhau
+        candidates = np.flatnonzero(eligible)
+        count = min(k, len(candidates))
+        if count <= 0:
+            return []
+        candidate_scores = scores[candidates]
+        best = np.argpartition(candidate_scores, -count)[-count:]
+        best = best[np.argsort(-candidate_scores[best], kind='stable')]
+        return ids[candidates[best]].tolist()
+
+    def recommend(self, session, skin_type, concerns, age, severities=None, k=6, exclude=()):
+        """Ids of the k products that best fit this analysis"""
+        self.ensure_fresh(session)
+        vector = analysis_vector(skin_type, concerns, age, severities)
+        return self.top_k(vector, k=k, skin_type=skin_type, exclude=exclude)
+
+
+product_recommender = ProductRecommender()
@@ -1,14 +1,23 @@
 import os
+import time
 import uuid
 from datetime import datetime
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, current_app
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash
+from sqlalchemy.orm import load_only, joinedload, selectinload, raiseload
 from extensions import db  # Nhập db từ extensions
 from forms import LoginForm, RegisterForm, SkinAnalysisForm, ProductForm, ReviewForm, BlogPostForm, CheckoutForm, ChatForm
 import cloudinary.uploader
-from face_analysis import face_analyzer
+from analysis_jobs import submit_analysis, is_stale, fail_stale_analyses
+from metrics import stage_timer, timed, skin_analysis_stages
+from search_index import product_search, blog_search, query_terms, highlight_snippet
+from pagination import KeysetPagination, cached_count
+from recommender import product_recommender, concern_severities
+from blog_tags import tag_index, normalize_tags
+from view_counter import view_counter
+from cart_pricing import price_cart
 
 # Create blueprints
 main_bp = Blueprint('main', __name__)
@@ -54,29 +63,28 @@ def index():
 @main_bp.route('/skin-analysis', methods=['GET', 'POST'])
 @login_required
 def skin_analysis():
-    from models import SkinAnalysis, Product  # Nhập mô hình trong hàm
+    from models import SkinAnalysis  # Nhập mô hình trong hàm
     form = SkinAnalysisForm()
     
     if form.validate_on_submit():
-        # Save uploaded image
-        image_file = form.skin_image.data
-        image_path = save_uploaded_file(image_file)
-        
-        if image_path:
-            # Perform skin analysis
-            analysis_result = face_analyzer.analyze_skin(image_path)
+        with stage_timer() as timer:
+            image_file = form.skin_image.data
+            with timed('request_read'):
+                image_bytes = image_file.read() if image_file and allowed_file(image_file.filename) else None
             
-            # Save analysis to database
-            skin_analysis = SkinAnalysis(
-                user_id=current_user.id,
-                image_url=image_path,
-                analysis_result=analysis_result,
-                skin_type=analysis_result.get('skin_type', 'normal'),
-                skin_concerns=analysis_result.get('concerns', []),
-                recommended_routine=analysis_result.get('recommended_routine', {})
-            )
-            db.session.add(skin_analysis)
-            db.session.commit()
+            if image_bytes:
+                # Tạo bản ghi ở trạng thái chờ, việc upload và gọi Face++ chạy ở worker nền
+                skin_analysis = SkinAnalysis(
+                    user_id=current_user.id,
+                    status='pending'
+                )
+                db.session.add(skin_analysis)
+                with timed('request_db_commit'):
+                    db.session.commit()
+        skin_analysis_stages.observe(timer.timings)
+        
+        if image_bytes:
+            submit_analysis(current_app._get_current_object(), skin_analysis.id, image_bytes)
             
             # Redirect to results page
             return redirect(url_for('main.analysis_results', analysis_id=skin_analysis.id))
@@ -90,24 +98,97 @@ def skin_analysis():
 def analysis_results(analysis_id):
     from models import SkinAnalysis, Product  # Nhập mô hình trong hàm
     analysis = SkinAnalysis.query.filter_by(id=analysis_id, user_id=current_user.id).first_or_404()
+    if is_stale(analysis):
+        fail_stale_analyses(analysis.id)
+        db.session.refresh(analysis)
     
-    # Get recommended products based on skin type
-    recommended_products = Product.query.filter(
-        (Product.skin_type == analysis.skin_type) | (Product.skin_type == 'all')
-    ).filter_by(is_active=True).limit(6).all()
+    if analysis.is_pending:
+        return render_template('skin_analysis.html', analysis=analysis, show_pending=True)
+    
+    # Chấm điểm toàn bộ sản phẩm theo loại da, mức độ từng vấn đề da và tuổi (recommender.py)
+    recommended_ids = product_recommender.recommend(
+        db.session, analysis.skin_type, analysis.skin_concerns, analysis.result_summary.get('age'),
+        severities=concern_severities(analysis.raw_skin_analysis), k=6
+    )
+    products_by_id = {p.id: p for p in Product.query.filter(Product.id.in_(recommended_ids)).all()} if recommended_ids else {}
+    recommended_products = [products_by_id[i] for i in recommended_ids if i in products_by_id]
     
     return render_template('skin_analysis.html', 
                          analysis=analysis, 
                          recommended_products=recommended_products,
                          show_results=True)
 
+@main_bp.route('/analysis-status/<int:analysis_id>')
+@login_required
+def analysis_status(analysis_id):
+    """JSON status of an analysis job; pass ?wait=N to long-poll for up to N seconds"""
+    from models import SkinAnalysis  # Nhập mô hình trong hàm
+    wait = min(max(request.args.get('wait', 0, type=float), 0), 25)
+    deadline = time.time() + wait
+    
+    while True:
+        analysis = SkinAnalysis.query.filter_by(id=analysis_id, user_id=current_user.id).options(
+            load_only(SkinAnalysis.id, SkinAnalysis.status, SkinAnalysis.date_analyzed)
+        ).first_or_404()
+        if is_stale(analysis):
+            # Job đã mất (worker bị restart...): trả về trạng thái cuối thay vì để trình duyệt chờ mãi
+            fail_stale_analyses(analysis.id)
+            continue
+        if not analysis.is_pending or time.time() >= deadline:
+            break
+        # Kết thúc transaction hiện tại để lần đọc sau thấy dữ liệu worker vừa ghi
+        db.session.rollback()
+        time.sleep(0.5)
+    
+    return jsonify({
+        'id': analysis.id,
+        'status': analysis.status or 'completed',
+        'ready': not analysis.is_pending,
+        'result_url': url_for('main.analysis_results', analysis_id=analysis.id)
+    })
+
+@main_bp.route('/metrics')
+def metrics():
+    """Skin analysis stage histograms in Prometheus text format"""
+    from metrics import METRICS_TOKEN, render_all
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return 'Unauthorized\n', 401, {'Content-Type': 'text/plain'}
+    return render_all(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@main_bp.route('/admin/http-stats')
+@login_required
+def http_stats():
+    """Per-host outbound connection reuse for this worker process"""
+    from http_client import connection_stats
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Không có quyền truy cập'}), 403
+    return jsonify({'pid': os.getpid(), 'hosts': connection_stats()})
+
+@main_bp.route('/admin/circuit-breakers')
+@login_required
+def circuit_breakers():
+    """State of the Face++ circuit breaker (shared by all workers)"""
+    from circuit_breaker import facepp_breaker
+    if not current_user.is_admin:
+        return jsonify({'success': False, 'message': 'Không có quyền truy cập'}), 403
+    return jsonify({'breakers': [facepp_breaker.snapshot()]})
+
 @main_bp.route('/profile')
 @login_required
 def profile():
-    from models import SkinAnalysis, Order, Review  # Nhập mô hình trong hàm
-    user_analyses = SkinAnalysis.query.filter_by(user_id=current_user.id).order_by(SkinAnalysis.date_analyzed.desc()).all()
-    user_orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.date_created.desc()).all()
-    user_reviews = Review.query.filter_by(user_id=current_user.id).order_by(Review.date_created.desc()).all()
+    from models import SkinAnalysis, Order, OrderItem, Review  # Nhập mô hình trong hàm
+    # Trang lịch sử chỉ cần vài cột nhỏ, không tải routine và kết quả Face++
+    user_analyses = SkinAnalysis.query.filter_by(user_id=current_user.id).options(
+        load_only(SkinAnalysis.id, SkinAnalysis.date_analyzed, SkinAnalysis.skin_type,
+                  SkinAnalysis.skin_concerns, SkinAnalysis.status)
+    ).order_by(SkinAnalysis.date_analyzed.desc()).all()
+    # Sản phẩm của từng đơn hàng / đánh giá được tải cùng lúc, không truy vấn riêng cho mỗi dòng
+    user_orders = Order.query.filter_by(user_id=current_user.id).options(
+        selectinload(Order.order_items).joinedload(OrderItem.product)
+    ).order_by(Order.date_created.desc()).all()
+    user_reviews = Review.query.filter_by(user_id=current_user.id).options(
+        joinedload(Review.product)
+    ).order_by(Review.date_created.desc()).all()
     
     return render_template('profile.html',
                          analyses=user_analyses,
@@ -183,11 +264,14 @@ def index():
     from flask_login import current_user
     
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     category_id = request.args.get('category')
     skin_type = request.args.get('skin_type')
     search = request.args.get('search')
     
-    query = Product.query.filter_by(is_active=True)
+    # Thẻ sản phẩm chỉ dùng cột của Product (điểm đánh giá đã lưu sẵn), không tải quan hệ nào
+    query = Product.query.filter_by(is_active=True).options(raiseload('*'))
+    order_by = [Product.date_added.desc()]
     
     if category_id:
         query = query.filter_by(category_id=category_id)
@@ -196,17 +280,29 @@ def index():
         query = query.filter((Product.skin_type == skin_type) | (Product.skin_type == 'all'))
     
     if search:
-        search_terms = search.split()
-        for term in search_terms:
-            query = query.filter(
-                Product.name.ilike(f"%{term}%") | 
-                Product.description.ilike(f"%{term}%") |
-                Product.brand.ilike(f"%{term}%")
-            )
+        # Tìm qua index toàn văn (không dấu, xếp theo độ liên quan); CSDL không hỗ trợ thì dùng LIKE
+        matches = product_search.match(db.session, search)
+        if matches is not None:
+            query = query.join(matches, matches.c.doc_id == Product.id)
+            order_by.insert(0, matches.c.rank)
+        else:
+            search_terms = search.split()
+            for term in search_terms:
+                query = query.filter(
+                    Product.name.ilike(f"%{term}%") | 
+                    Product.description.ilike(f"%{term}%") |
+                    Product.brand.ilike(f"%{term}%")
+                )
     
-    products = query.order_by(Product.date_added.desc()).paginate(
-        page=page, per_page=12, error_out=False
-    )
+    # Danh sách theo ngày dùng cursor (trang sâu không chậm dần); tìm kiếm xếp theo độ liên quan
+    # và link cũ có ?page= vẫn dùng OFFSET
+    if not search and 'page' not in request.args:
+        total = cached_count(query, ('products', category_id, skin_type))
+        products = KeysetPagination(query, (Product.date_added, Product.id), cursor, per_page=12, total=total)
+    else:
+        products = query.order_by(*order_by, Product.id.desc()).paginate(
+            page=page, per_page=12, error_out=False
+        )
     
     categories = Category.query.all()
     form = None
@@ -224,16 +320,24 @@ def index():
 
 @products_bp.route('/<int:product_id>')
 def detail(product_id):
-    from models import Product, Review  # Nhập mô hình trong hàm
-    product = Product.query.get_or_404(product_id)
-    reviews = Review.query.filter_by(product_id=product_id).order_by(Review.date_created.desc()).all()
-    
-    # Get related products
-    related_products = Product.query.filter(
-        Product.category_id == product.category_id,
-        Product.id != product.id,
+    from models import Product, Review, ProductNeighbor  # Nhập mô hình trong hàm
+    product = Product.query.options(joinedload(Product.category)).filter_by(id=product_id).first_or_404()
+    reviews = Review.query.filter_by(product_id=product_id).options(
+        joinedload(Review.user)
+    ).order_by(Review.date_created.desc()).all()
+    
+    # Get related products: precomputed by similar_products.py, one lookup on the neighbors primary key
+    related_products = Product.query.join(ProductNeighbor, ProductNeighbor.neighbor_id == Product.id).filter(
+        ProductNeighbor.product_id == product.id,
         Product.is_active == True
-    ).limit(4).all()
+    ).order_by(ProductNeighbor.rank).limit(4).all()
+    if not related_products:
+        # Sản phẩm mới chưa được tính hàng xóm: lấy sản phẩm cùng danh mục
+        related_products = Product.query.filter(
+            Product.category_id == product.category_id,
+            Product.id != product.id,
+            Product.is_active == True
+        ).limit(4).all()
     
     review_form = ReviewForm()
     
@@ -268,7 +372,10 @@ def add_to_cart(product_id):
 @products_bp.route('/update-cart', methods=['POST'])
 def update_cart():
     product_id = request.json.get('product_id')
-    change = request.json.get('change')
+    try:
+        change = int(request.json.get('change'))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Số lượng không hợp lệ'})
     
     if 'cart' not in session:
         return jsonify({'success': False, 'message': 'Giỏ hàng không tồn tại'})
@@ -280,7 +387,8 @@ def update_cart():
             del session['cart'][product_key]
         
         session.modified = True
-        return jsonify({'success': True})
+        # Trả về tổng mới để trang giỏ hàng cập nhật mà không tải lại
+        return jsonify({'success': True, **price_cart(session['cart']).to_dict()})
     
     return jsonify({'success': False, 'message': 'Sản phẩm không có trong giỏ hàng'})
 
@@ -293,7 +401,7 @@ def remove_from_cart():
         if product_key in session['cart']:
             del session['cart'][product_key]
             session.modified = True
-            return jsonify({'success': True})
+            return jsonify({'success': True, **price_cart(session['cart']).to_dict()})
             
     return jsonify({'success': False, 'message': 'Sản phẩm không có trong giỏ hàng'})
 
@@ -318,6 +426,8 @@ def add_review(product_id):
                 content=form.content.data
             )
             db.session.add(review)
+            # Cập nhật tổng hợp đánh giá trong cùng transaction với review
+            Product.add_rating(product.id, review.rating)
             db.session.commit()
             flash('Cảm ơn bạn đã đánh giá sản phẩm!', 'success')
     
@@ -363,29 +473,17 @@ def create_product():
 
 @main_bp.route('/cart')
 def cart():
-    from models import Product  # Nhập mô hình trong hàm
-    cart_items = []
-    total = 0
-    
-    if 'cart' in session:
-        for product_id, quantity in session['cart'].items():
-            product = Product.query.get(int(product_id))
-            if product:
-                item_total = product.price * quantity
-                cart_items.append({
-                    'product': product,
-                    'quantity': quantity,
-                    'total': item_total
-                })
-                total += item_total
-    
-    return render_template('cart.html', cart_items=cart_items, total=total)
+    # Một truy vấn IN cho mọi sản phẩm trong giỏ
+    pricing = price_cart(session.get('cart'))
+    return render_template('cart.html', cart_items=pricing.lines, total=pricing.total)
 
 @main_bp.route('/checkout', methods=['GET', 'POST'])
 @login_required
 def checkout():
-    from models import Product, Order, OrderItem  # Nhập mô hình trong hàm
-    if 'cart' not in session or not session['cart']:
+    from models import Order, OrderItem  # Nhập mô hình trong hàm
+    # Giá và tổng được tính một lần, dùng cho cả hiển thị lẫn tạo đơn hàng
+    pricing = price_cart(session.get('cart'))
+    if not pricing:
         flash('Giỏ hàng của bạn đang trống.', 'warning')
         return redirect(url_for('main.cart'))
     
@@ -398,17 +496,10 @@ def checkout():
         form.address.data = current_user.address
     
     if form.validate_on_submit():
-        # Calculate total
-        total = 0
-        for product_id, quantity in session['cart'].items():
-            product = Product.query.get(int(product_id))
-            if product:
-                total += product.price * quantity
-        
         # Create order
         order = Order(
             user_id=current_user.id,
-            total_amount=total,
+            total_amount=pricing.total,
             shipping_address=form.address.data,
             phone_number=form.phone.data,
             payment_method=form.payment_method.data
@@ -417,16 +508,14 @@ def checkout():
         db.session.flush()  # Get order ID
         
         # Create order items
-        for product_id, quantity in session['cart'].items():
-            product = Product.query.get(int(product_id))
-            if product:
-                order_item = OrderItem(
-                    order_id=order.id,
-                    product_id=product.id,
-                    quantity=quantity,
-                    price=product.price
-                )
-                db.session.add(order_item)
+        for line in pricing.lines:
+            order_item = OrderItem(
+                order_id=order.id,
+                product_id=line.product.id,
+                quantity=line.quantity,
+                price=line.product.price
+            )
+            db.session.add(order_item)
         
         db.session.commit()
         
@@ -436,15 +525,7 @@ def checkout():
         flash('Đặt hàng thành công! Chúng tôi sẽ liên hệ với bạn sớm nhất.', 'success')
         return redirect(url_for('main.profile'))
     
-    # Calculate cart total for display
-    cart_total = 0
-    if 'cart' in session:
-        for product_id, quantity in session['cart'].items():
-            product = Product.query.get(int(product_id))
-            if product:
-                cart_total += product.price * quantity
-    
-    return render_template('checkout.html', form=form, total=cart_total)
+    return render_template('checkout.html', form=form, total=pricing.total)
 
 # Chat routes
 @chat_bp.route('/')
@@ -452,7 +533,9 @@ def checkout():
 def index():
     from models import ChatMessage  # Nhập mô hình trong hàm
     # Get user's chat history
-    messages = ChatMessage.query.filter_by(user_id=current_user.id).order_by(ChatMessage.date_created.asc()).all()
+    messages = ChatMessage.query.filter_by(user_id=current_user.id).options(
+        raiseload('*')
+    ).order_by(ChatMessage.date_created.asc()).all()
     form = ChatForm()
     return render_template('chat.html', messages=messages, form=form)
 
@@ -548,6 +631,16 @@ Tôi là chuyên gia tư vấn làm đẹp của Beauty App. Tôi có thể giú
 Hãy cho tôi biết bạn quan tâm đến vấn đề gì nhé!"""
 
 # Blog routes
+def _comment_counts(posts):
+    """Số bình luận của các bài trên trang: một truy vấn GROUP BY thay vì tải bình luận của từng bài"""
+    from models import BlogComment
+    post_ids = [post.id for post in posts]
+    if not post_ids:
+        return {}
+    return dict(db.session.query(BlogComment.post_id, db.func.count(BlogComment.id)).filter(
+        BlogComment.post_id.in_(post_ids)
+    ).group_by(BlogComment.post_id).all())
+
 @blog_bp.route('/')
 def index():
     from models import BlogPost
@@ -555,49 +648,101 @@ def index():
     from flask_login import current_user
     
     page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
     search_query = request.args.get('search')
     
-    query = BlogPost.query.filter_by(is_published=True)
+    query = BlogPost.query.filter_by(is_published=True).options(joinedload(BlogPost.author))
+    order_by = [BlogPost.date_created.desc()]
     
     if search_query:
-        search_terms = search_query.split()
-        for term in search_terms:
-            query = query.filter(
-                BlogPost.title.ilike(f"%{term}%") | 
-                BlogPost.content.ilike(f"%{term}%") |
-                BlogPost.excerpt.ilike(f"%{term}%")
-            )
+        # Index toàn văn: khớp ở tiêu đề xếp trên khớp ở nội dung; CSDL không hỗ trợ thì dùng LIKE
+        matches = blog_search.match(db.session, search_query)
+        if matches is not None:
+            query = query.join(matches, matches.c.doc_id == BlogPost.id)
+            order_by.insert(0, matches.c.rank)
+        else:
+            search_terms = search_query.split()
+            for term in search_terms:
+                query = query.filter(
+                    BlogPost.title.ilike(f"%{term}%") | 
+                    BlogPost.content.ilike(f"%{term}%") |
+                    BlogPost.excerpt.ilike(f"%{term}%")
+                )
             
-    posts = query.order_by(BlogPost.date_created.desc()).paginate(
-        page=page, per_page=6, error_out=False
-    )
+    if not search_query and 'page' not in request.args:
+        total = cached_count(query, ('blog',))
+        posts = KeysetPagination(query, (BlogPost.date_created, BlogPost.id), cursor, per_page=6, total=total)
+    else:
+        posts = query.order_by(*order_by, BlogPost.id.desc()).paginate(
+            page=page, per_page=6, error_out=False
+        )
+    
+    comment_counts = _comment_counts(posts.items)
+    
+    # Đoạn trích có đánh dấu từ khóa, chỉ tính cho các bài trên trang hiện tại
+    snippets = {}
+    if search_query:
+        terms = query_terms(search_query)
+        snippets = {post.id: highlight_snippet([post.excerpt, post.content], terms) for post in posts.items}
     
     form = BlogPostForm() if current_user.is_authenticated else None
     
-    return render_template('blog.html', posts=posts, search_query=search_query, form=form)
+    return render_template('blog.html', posts=posts, search_query=search_query, snippets=snippets,
+                         comment_counts=comment_counts, form=form)
+
+@blog_bp.route('/tag/<tag_name>')
+def tag(tag_name):
+    from models import BlogPost, Tag, post_tag
+    names = normalize_tags(tag_name)
+    if not names:
+        return redirect(url_for('blog.index'))
+    tag = Tag.query.filter_by(name=names[0]).first_or_404()
+    
+    # Bài của tag qua post_tag (index theo tag_id) thay vì LIKE trên chuỗi tags của mọi bài
+    query = BlogPost.query.join(post_tag, post_tag.c.post_id == BlogPost.id).filter(
+        post_tag.c.tag_id == tag.id,
+        BlogPost.is_published == True
+    ).options(joinedload(BlogPost.author))
+    total = cached_count(query, ('blog-tag', tag.id))
+    posts = KeysetPagination(query, (BlogPost.date_created, BlogPost.id), request.args.get('cursor'),
+                             per_page=6, total=total)
+    
+    form = BlogPostForm() if current_user.is_authenticated else None
+    
+    return render_template('blog.html', posts=posts, search_query=None, snippets={},
+                         comment_counts=_comment_counts(posts.items), form=form, current_tag=tag.name)
 
 @blog_bp.route('/<int:post_id>')
 def post_detail(post_id):
     from models import BlogPost, BlogComment  # Nhập mô hình trong hàm
-    post = BlogPost.query.get_or_404(post_id)
+    post = BlogPost.query.options(joinedload(BlogPost.author)).filter_by(id=post_id).first_or_404()
     
-    # Increment views
-    post.views += 1
-    db.session.commit()
+    # Increment views: buffered and written in batches, so reading a post stays a read-only request
+    view_counter.add(post.id, db.engine)
     
     # Get comments
-    comments = BlogComment.query.filter_by(post_id=post_id).order_by(BlogComment.date_created.desc()).all()
-    
-    # Get related posts
-    related_posts = BlogPost.query.filter(
-        BlogPost.id != post.id,
-        BlogPost.is_published == True
-    ).limit(3).all()
+    comments = BlogComment.query.filter_by(post_id=post_id).options(
+        joinedload(BlogComment.user)
+    ).order_by(BlogComment.date_created.desc()).all()
+    
+    # Get related posts: ranked by shared tags from the in-memory tag index, then loaded by id
+    tag_index.ensure_fresh(db.session)
+    related_ids = tag_index.related(post.tag_names, exclude=post.id, k=3)
+    if related_ids:
+        related_posts = sorted(BlogPost.query.filter(BlogPost.id.in_(related_ids)).all(),
+                               key=lambda related: related_ids.index(related.id))
+    else:
+        related_posts = BlogPost.query.filter(
+            BlogPost.id != post.id,
+            BlogPost.is_published == True
+        ).order_by(BlogPost.date_created.desc()).limit(3).all()
     
     return render_template('blog_post.html', 
                          post=post, 
                          comments=comments,
-                         related_posts=related_posts)
+                         related_posts=related_posts,
+                         popular_tags=tag_index.popular(8),
+                         views=post.views + view_counter.pending(post.id))
 
 @blog_bp.route('/<int:post_id>/comment', methods=['POST'])
 @login_required
@@ -0,0 +1,130 @@
+"""
+Skincare routine rules.
+
+The routine used to be rebuilt with list insert/append branches on every
+analysis. The same rules are now declared once in ROUTINE_RULES and compiled
+at import into a table keyed by (skin type, concern bitmask, age bucket);
+get_routine() is a single dict lookup that returns a shared, read-only routine.
+"""
+
+from itertools import product
+
+BASE_ROUTINE = {
+    'morning': (
+        'Sữa rửa mặt nhẹ nhàng',
+        'Toner cân bằng da',
+        'Serum vitamin C',
+        'Kem dưỡng ẩm',
+        'Kem chống nắng SPF 30+',
+    ),
+    'evening': (
+        'Tẩy trang (nếu có makeup)',
+        'Sữa rửa mặt',
+        'Toner',
+        'Serum phục hồi da',
+        'Kem dưỡng ẩm ban đêm',
+    ),
+    'weekly': (),
+}
+
+# Chỉ những vấn đề da này làm thay đổi routine; các vấn đề khác không ảnh hưởng key
+CONCERN_BITS = {
+    'acne': 1,
+    'dark_spots': 2,
+}
+
+# Loại da có rule riêng; loại da khác (normal, combination, ...) dùng routine cơ bản
+SKIN_TYPES = ('oily', 'dry', 'sensitive')
+
+AGE_BUCKETS = ('under_30', 'over_30')
+
+# (điều kiện, thao tác, buổi, vị trí, bước). Rule được áp dụng theo đúng thứ tự này:
+# 'replace' thay bước ở vị trí, 'insert' chèn vào trước vị trí, 'append' thêm vào cuối.
+ROUTINE_RULES = (
+    (('skin_type', 'oily'), 'replace', 'morning', 1, 'Toner kiểm soát dầu'),
+    (('skin_type', 'oily'), 'insert', 'evening', 3, 'BHA/Salicylic Acid (2-3 lần/tuần)'),
+    (('skin_type', 'dry'), 'insert', 'morning', 3, 'Serum hyaluronic acid'),
+    (('skin_type', 'dry'), 'insert', 'evening', 3, 'Dầu dưỡng da'),
+    (('skin_type', 'sensitive'), 'replace', 'morning', 2, 'Serum niacinamide'),
+    (('skin_type', 'sensitive'), 'replace', 'evening', 3, 'Serum làm dịu da'),
+    (('concern', 'acne'), 'append', 'evening', None, 'Sản phẩm chấm mụn đặc trị'),
+    (('concern', 'dark_spots'), 'insert', 'evening', 3, 'Serum làm sáng da'),
+    (('age', 'over_30'), 'insert', 'evening', 3, 'Serum chống lão hóa/retinol'),
+    (('age', 'over_30'), 'append', 'weekly', None, 'Mặt nạ chống lão hóa'),
+)
+
+
+class FrozenRoutine(dict):
+    """Read-only routine shared by every analysis with the same key.
+
+    Still a dict of tuples, so json.dumps, the SQLAlchemy JSON column and the
+    templates treat it exactly like the old dict of lists.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Routine is shared between analyses; copy it with dict() before changing it')
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def concern_mask(concerns):
+    """Bitmask of the concerns that affect the routine"""
+    mask = 0
+    for concern in concerns:
+        mask |= CONCERN_BITS.get(concern, 0)
+    return mask
+
+
+def age_bucket(age):
+    return 'over_30' if age > 30 else 'under_30'
+
+
+def _matches(condition, skin_type, mask, bucket):
+    kind, value = condition
+    if kind == 'skin_type':
+        return skin_type == value
+    if kind == 'concern':
+        return bool(mask & CONCERN_BITS[value])
+    return bucket == value
+
+
+def _build_routine(skin_type, mask, bucket):
+    routine = {period: list(steps) for period, steps in BASE_ROUTINE.items()}
+    for condition, action, period, position, step in ROUTINE_RULES:
+        if not _matches(condition, skin_type, mask, bucket):
+            continue
+        if action == 'replace':
+            routine[period][position] = step
+        elif action == 'insert':
+            routine[period].insert(position, step)
+        else:
+            routine[period].append(step)
+    return FrozenRoutine((period, tuple(steps)) for period, steps in routine.items())
+
+
+def _compile_table():
+    all_masks = range(1 << len(CONCERN_BITS))
+    return {
+        (skin_type, mask, bucket): _build_routine(skin_type, mask, bucket)
+        for skin_type, mask, bucket in product((None,) + SKIN_TYPES, all_masks, AGE_BUCKETS)
+    }
+
+
+ROUTINE_TABLE = _compile_table()
+
+
+def get_routine(skin_type, concerns, age):
+    """Shared read-only routine for this skin type, concern list and age"""
+    if skin_type not in SKIN_TYPES:
+        skin_type = None
+    return ROUTINE_TABLE[(skin_type, concern_mask(concerns), age_bucket(age))]
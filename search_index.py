@@ -0,0 +1,276 @@
+import re
+import logging
+import unicodedata
+from markupsafe import Markup, escape
+from sqlalchemy import event, inspect, text, Integer, Float
+
+# FTS5 unicode61 không bỏ dấu được chữ đ, nên mọi văn bản được chuẩn hóa trước khi đưa vào index
+_NON_WORD = re.compile(r'[\W_]+', re.UNICODE)
+_TAG = re.compile(r'<[^>]+>')
+
+
+def fold_text(value):
+    """Lowercase, accent-free Vietnamese text ('Đẹp Dưỡng-ẩm' -> 'dep duong am')"""
+    if not value:
+        return ''
+    if value.isascii():
+        # Tên thành phần, thương hiệu tiếng Anh: không có dấu để bỏ
+        return _NON_WORD.sub(' ', value.lower()).strip()
+    value = value.replace('đ', 'd').replace('Đ', 'D')
+    value = unicodedata.normalize('NFD', value)
+    value = ''.join(ch for ch in value if not unicodedata.combining(ch))
+    return _NON_WORD.sub(' ', value.lower()).strip()
+
+
+def query_terms(query):
+    """Folded search terms of a user query"""
+    return fold_text(query).split()
+
+
+def _fold_char(ch):
+    if ch in 'đĐ':
+        return 'd'
+    base = ''.join(c for c in unicodedata.normalize('NFD', ch) if not unicodedata.combining(c))
+    return base.lower()[:1]
+
+
+def highlight_snippet(texts, terms, width=180):
+    """HTML snippet around the first search term found in texts, with every matched word in <mark>.
+
+    texts are tried in order (e.g. excerpt, then content); matching ignores
+    accents like the index does but the snippet keeps the original text.
+    Returns None if none of the texts is non-empty.
+    """
+    fallback = None
+    for value in texts:
+        plain = ' '.join(_TAG.sub(' ', value or '').split())
+        if not plain:
+            continue
+
+        # Chuẩn hóa từng ký tự để vị trí trong chuỗi không dấu khớp với chuỗi gốc
+        folded, positions = [], []
+        for index, ch in enumerate(plain):
+            folded_ch = _fold_char(ch)
+            if folded_ch:
+                folded.append(folded_ch if folded_ch.isalnum() else ' ')
+                positions.append(index)
+        folded = ''.join(folded)
+
+        spans = []
+        for term in terms:
+            for match in re.finditer(r'(?<!\w)' + re.escape(term) + r'\w*', folded):
+                spans.append((positions[match.start()], positions[match.end() - 1] + 1))
+        if not spans:
+            if fallback is None:
+                fallback = plain
+            continue
+        return Markup(_render_snippet(plain, sorted(spans), width))
+
+    if fallback is None:
+        return None
+    return Markup(_render_snippet(fallback, [], width))
+
+
+def _render_snippet(plain, spans, width):
+    start = 0
+    if spans and spans[0][0] > width // 3:
+        start = plain.rfind(' ', 0, spans[0][0] - width // 3) + 1
+    end = len(plain) if len(plain) - start <= width else plain.rfind(' ', start, start + width)
+    if end <= start:
+        end = min(len(plain), start + width)
+
+    parts = ['…'] if start > 0 else []
+    cursor = start
+    for span_start, span_end in spans:
+        if span_start < cursor or span_start >= end:
+            continue
+        parts.append(str(escape(plain[cursor:span_start])))
+        parts.append(f'<mark>{escape(plain[span_start:min(span_end, end)])}</mark>')
+        cursor = min(span_end, end)
+    parts.append(str(escape(plain[cursor:end])))
+    if end < len(plain):
+        parts.append('…')
+    return ''.join(parts)
+
+
+class FullTextIndex:
+    """Weighted full-text index over some text columns of a model, kept in a side table.
+
+    SQLite uses an FTS5 virtual table ranked with bm25(); PostgreSQL uses a
+    tsvector column with a GIN index ranked with ts_rank(). Other databases
+    (MySQL) have no index and callers keep their LIKE search. Text is folded
+    with fold_text() so searches ignore Vietnamese diacritics, and every term
+    is matched as a prefix. Rows are kept in sync by mapper events, so any
+    insert, update or delete of the model updates the index in the same
+    transaction.
+    """
+
+    # Trọng số tối đa 4 cột (PostgreSQL chỉ có 4 mức A-D)
+    PG_WEIGHTS = ('A', 'B', 'C', 'D')
+
+    def __init__(self, table, fields):
+        # fields: ((tên cột, trọng số bm25), ...) theo thứ tự quan trọng giảm dần
+        self.table = table
+        self.fields = tuple(fields)
+        self.columns = [name for name, _ in self.fields]
+        self._fts5 = None
+
+    # --- Schema -----------------------------------------------------------------
+
+    def supported(self, conn):
+        dialect = conn.dialect.name
+        if dialect == 'postgresql':
+            return True
+        if dialect == 'sqlite':
+            if self._fts5 is None:
+                self._fts5 = bool(conn.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar())
+                if not self._fts5:
+                    logging.warning("SQLite was built without FTS5; full-text search falls back to LIKE")
+            return self._fts5
+        return False
+
+    def ensure(self, engine, model):
+        """Create the index if needed and fill it when it is empty but the model table is not"""
+        with engine.begin() as conn:
+            if not self.supported(conn):
+                return False
+            if conn.dialect.name == 'sqlite':
+                conn.execute(text(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} USING fts5("
+                    f"{', '.join(self.columns)}, tokenize='unicode61 remove_diacritics 2')"
+                ))
+            else:
+                conn.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                    f" doc_id INTEGER PRIMARY KEY REFERENCES {model.__tablename__}(id) ON DELETE CASCADE,"
+                    f" document tsvector NOT NULL)"
+                ))
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS idx_{self.table}_document ON {self.table} USING GIN (document)"
+                ))
+
+            indexed = conn.execute(text(f"SELECT COUNT(*) FROM {self.table}")).scalar()
+            total = conn.execute(text(f"SELECT COUNT(*) FROM {model.__tablename__}")).scalar()
+            if indexed == 0 and total:
+                logging.info(f"Building full-text index {self.table} for {total} rows")
+                self.rebuild(conn, model)
+        return True
+
+    def rebuild(self, conn, model, batch_size=1000):
+        """Re-index every row of the model"""
+        conn.execute(text(f"DELETE FROM {self.table}"))
+        table = model.__table__
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                table.select().with_only_columns(table.c.id, *[table.c[name] for name in self.columns])
+                .where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            conn.execute(text(self._insert_sql(conn)), [self._params(row[0], row[1:]) for row in rows])
+            last_id = rows[-1][0]
+
+    # --- Incremental maintenance ---------------------------------------------------
+
+    def watch(self, model):
+        """Keep the index in sync with inserts, updates and deletes of model rows"""
+        event.listen(model, 'after_insert', self._after_save)
+        event.listen(model, 'after_update', self._after_update)
+        event.listen(model, 'after_delete', self._after_delete)
+
+    def _after_save(self, mapper, conn, target):
+        if not self.supported(conn):
+            return
+        values = [getattr(target, name) for name in self.columns]
+        if conn.dialect.name == 'sqlite':
+            # FTS5 không có UPSERT
+            conn.execute(text(f"DELETE FROM {self.table} WHERE rowid = :doc_id"), {'doc_id': target.id})
+        conn.execute(text(self._insert_sql(conn)), self._params(target.id, values))
+
+    def _after_update(self, mapper, conn, target):
+        # Cập nhật tồn kho, trạng thái... không cần index lại
+        state = inspect(target)
+        if any(state.attrs[name].history.has_changes() for name in self.columns):
+            self._after_save(mapper, conn, target)
+
+    def _after_delete(self, mapper, conn, target):
+        if not self.supported(conn):
+            return
+        id_column = 'rowid' if conn.dialect.name == 'sqlite' else 'doc_id'
+        conn.execute(text(f"DELETE FROM {self.table} WHERE {id_column} = :doc_id"), {'doc_id': target.id})
+
+    def _params(self, doc_id, values):
+        params = {'doc_id': doc_id}
+        for name, value in zip(self.columns, values):
+            params[name] = fold_text(value)
+        return params
+
+    def _insert_sql(self, conn):
+        if conn.dialect.name == 'sqlite':
+            placeholders = ', '.join(f':{name}' for name in self.columns)
+            return f"INSERT INTO {self.table} (rowid, {', '.join(self.columns)}) VALUES (:doc_id, {placeholders})"
+        document = ' || '.join(
+            f"setweight(to_tsvector('simple', :{name}), '{weight}')"
+            for name, weight in zip(self.columns, self.PG_WEIGHTS)
+        )
+        return (f"INSERT INTO {self.table} (doc_id, document) VALUES (:doc_id, {document}) "
+                f"ON CONFLICT (doc_id) DO UPDATE SET document = EXCLUDED.document")
+
+    # --- Queries ---------------------------------------------------------------------
+
+    def match(self, session, query):
+        """Subquery of (doc_id, rank) for rows matching every term (lower rank = better), or None.
+
+        None means the index cannot serve this query (unsupported database or
+        no usable terms) and the caller should use its LIKE search instead.
+        """
+        terms = query_terms(query)
+        conn = session.connection()
+        if not terms or not self.supported(conn):
+            return None
+
+        if conn.dialect.name == 'sqlite':
+            weights = ', '.join(str(weight) for _, weight in self.fields)
+            statement = text(
+                f"SELECT rowid AS doc_id, bm25({self.table}, {weights}) AS rank "
+                f"FROM {self.table} WHERE {self.table} MATCH :match"
+            ).bindparams(match=' '.join(f'"{term}"*' for term in terms))
+        else:
+            # ts_rank càng lớn càng liên quan: đổi dấu để cả hai dialect cùng sắp xếp tăng dần
+            statement = text(
+                f"SELECT doc_id, -ts_rank(document, to_tsquery('simple', :match)) AS rank "
+                f"FROM {self.table} WHERE document @@ to_tsquery('simple', :match)"
+            ).bindparams(match=' & '.join(f'{term}:*' for term in terms))
+
+        return statement.columns(doc_id=Integer, rank=Float).subquery()
+
+
+product_search = FullTextIndex('product_search', (
+    ('name', 10.0),
+    ('brand', 4.0),
+    ('description', 1.0),
+))
+
+# Tiêu đề quan trọng hơn tóm tắt, tóm tắt quan trọng hơn nội dung
+blog_search = FullTextIndex('blog_search', (
+    ('title', 10.0),
+    ('excerpt', 3.0),
+    ('content', 1.0),
+))
+
+
+if __name__ == '__main__':
+    # Build lại toàn bộ index (ví dụ sau khi import sản phẩm bằng SQL, không qua ORM)
+    from app import create_app
+    from extensions import db
+    from models import Product, BlogPost
+
+    app = create_app()
+    with app.app_context(), db.engine.begin() as conn:
+        if product_search.supported(conn):
+            product_search.rebuild(conn, Product)
+            blog_search.rebuild(conn, BlogPost)
+            print("✅ Rebuilt product and blog search indexes")
+        else:
+            print("❌ This database has no full-text index support; search uses LIKE")
@@ -0,0 +1,50 @@
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Thư mục chứa các file trạng thái dùng chung giữa các gunicorn worker
+STATE_DIR = os.environ.get('BEAUTYAI_STATE_DIR', os.path.join(tempfile.gettempdir(), 'beautyai'))
+
+_local = threading.local()
+
+
+def state_path(filename):
+    """Return the absolute path of a shared state file, creating the directory if needed"""
+    os.makedirs(STATE_DIR, exist_ok=True)
+    return os.path.join(STATE_DIR, filename)
+
+
+def connect(filename, timeout=5.0):
+    """Open a SQLite connection on a shared state file that every worker process can use"""
+    conn = sqlite3.connect(state_path(filename), timeout=timeout, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def local_connection(filename, schema=()):
+    """Return this thread's connection on a shared state file (sqlite3 connections are not thread-safe)"""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(filename)
+    if conn is None:
+        conn = connect(filename)
+        for statement in schema:
+            conn.execute(statement)
+        connections[filename] = conn
+    return conn
+
+
+@contextmanager
+def immediate_transaction(conn):
+    """Run a read-modify-write on a shared state file while holding its write lock"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
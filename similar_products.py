@@ -0,0 +1,282 @@
+"""
+Precompute the most similar products of every product for the product page.
+
+    python similar_products.py              # update products changed since the last run
+    python similar_products.py --full       # recompute every product (e.g. nightly)
+
+Products are TF-IDF vectors over their name, brand, description and
+ingredients; the neighbors of a product are the active products with the
+highest cosine similarity. They are stored in product_neighbor, which
+products.detail reads with one indexed lookup.
+
+Run it from cron. Without --full it reads product_changes (the products
+added, edited or deleted through the app since its last run) and recomputes
+only the lists that can change: those of the changed products, of the
+products that listed one of them, and of the products a changed product is
+now more similar to than their current last neighbor. The IDF weights drift
+as the catalog grows, so a --full run now and then keeps scores comparable.
+"""
+
+import sys
+import math
+import time
+import logging
+import argparse
+from collections import Counter
+
+import numpy as np
+from sqlalchemy import delete
+
+from change_log import product_changes
+from search_index import fold_text
+
+NEIGHBORS = 12
+# Từ xuất hiện trong quá nửa sản phẩm không giúp phân biệt; từ chỉ có ở một sản phẩm không tạo ra cặp nào
+MAX_DOCUMENT_FREQUENCY = 0.5
+MIN_DOCUMENT_FREQUENCY = 2
+# Số ô tối đa của một khối điểm tương tự (dòng x sản phẩm), giới hạn bộ nhớ khi tính
+BLOCK_CELLS = 8_000_000
+BLOCK_POSTINGS = 4_000_000
+# Các từ có mặt trong từ 2% sản phẩm trở lên (tối đa 256 từ) được tính bằng nhân ma trận dày
+DENSE_TERMS = 256
+DENSE_MIN_FREQUENCY = 0.02
+
+READER = 'similar_products'
+
+
+def product_terms(name, brand, description, ingredients):
+    """Terms of one product; name words count twice, brand and each ingredient are single terms"""
+    name_words = fold_text(name).split()
+    terms = name_words + name_words + fold_text(description).split()
+    if brand and fold_text(brand):
+        terms.append('brand:' + fold_text(brand).replace(' ', '_'))
+    for ingredient in (ingredients or '').split(','):
+        folded = fold_text(ingredient)
+        if folded:
+            terms.append('ingredient:' + folded.replace(' ', '_'))
+    return [term for term in terms if len(term) > 1 and not term.isdigit()]
+
+
+class TfidfIndex:
+    """L2-normalized TF-IDF vectors of a set of products.
+
+    Rows are kept in CSR form. Cosine similarity of a block of rows against
+    every product adds up the postings (products containing a term) of rare
+    terms and multiplies a dense term x product matrix for the most frequent
+    terms, whose postings would cost O(df^2) to walk.
+    """
+
+    def __init__(self, product_ids, documents):
+        self.product_ids = np.asarray(product_ids, dtype=np.int64)
+        self.row_of = {int(product_id): row for row, product_id in enumerate(self.product_ids)}
+        count = len(documents)
+
+        document_frequency = Counter()
+        for terms in documents:
+            document_frequency.update(set(terms))
+        max_frequency = max(MIN_DOCUMENT_FREQUENCY, MAX_DOCUMENT_FREQUENCY * count)
+        vocabulary = {}
+        for term, frequency in document_frequency.items():
+            if MIN_DOCUMENT_FREQUENCY <= frequency <= max_frequency:
+                vocabulary[term] = len(vocabulary)
+        idf = np.zeros(len(vocabulary), dtype=np.float32)
+        for term, index in vocabulary.items():
+            idf[index] = math.log((1 + count) / (1 + document_frequency[term])) + 1
+
+        indptr = np.zeros(count + 1, dtype=np.int64)
+        indices, data = [], []
+        for row, terms in enumerate(documents):
+            counts = Counter(vocabulary[term] for term in terms if term in vocabulary)
+            term_ids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            weights = (1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))) * idf[term_ids]
+            norm = np.linalg.norm(weights)
+            indices.append(term_ids)
+            data.append(weights / norm if norm else weights)
+            indptr[row + 1] = indptr[row] + len(counts)
+        self.indptr = indptr
+        self.indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        self.data = np.concatenate(data).astype(np.float32) if data else np.zeros(0, dtype=np.float32)
+
+        self.vocabulary_size = len(vocabulary)
+        entry_rows = np.repeat(np.arange(count, dtype=np.int64), np.diff(indptr))
+
+        # Từ phổ biến: duyệt posting tốn df^2, nhân ma trận dày (BLAS) rẻ hơn nhiều
+        term_frequency = np.bincount(self.indices, minlength=len(vocabulary))
+        frequent = np.argsort(-term_frequency, kind='stable')[:DENSE_TERMS]
+        frequent = frequent[term_frequency[frequent] >= max(DENSE_MIN_FREQUENCY * count, MIN_DOCUMENT_FREQUENCY)]
+        self.dense_column = np.full(len(vocabulary), -1, dtype=np.int64)
+        self.dense_column[frequent] = np.arange(len(frequent))
+        is_dense = self.dense_column[self.indices] >= 0
+        self.dense = np.zeros((len(frequent), count), dtype=np.float32)
+        self.dense[self.dense_column[self.indices[is_dense]], entry_rows[is_dense]] = self.data[is_dense]
+
+        # Từ còn lại: chuyển sang dạng cột, với mỗi từ là các sản phẩm chứa nó
+        sparse_entries = np.flatnonzero(~is_dense)
+        order = sparse_entries[np.argsort(self.indices[sparse_entries], kind='stable')]
+        self.posting_rows = entry_rows[order]
+        self.posting_weights = self.data[order]
+        self.term_ptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.indices[sparse_entries], minlength=len(vocabulary)), out=self.term_ptr[1:])
+        # Số posting phải duyệt để tính độ tương tự của từng dòng
+        self.row_postings = np.bincount(
+            entry_rows, weights=np.diff(self.term_ptr)[self.indices], minlength=count
+        ).astype(np.int64)
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    def similarities(self, rows):
+        """Yield (block of rows, cosine similarity of each of them to every product) in bounded blocks"""
+        rows = np.fromiter(rows, dtype=np.int64)
+        # Mỗi khối là ma trận dày (số dòng x số sản phẩm): giới hạn cả số ô lẫn số posting phải cộng
+        size = max(1, BLOCK_CELLS // max(len(self), 1))
+        postings = np.cumsum(self.row_postings[rows])
+        start = 0
+        while start < len(rows):
+            base = postings[start - 1] if start else 0
+            end = min(start + size, max(start + 1, int(np.searchsorted(postings, base + BLOCK_POSTINGS, 'right'))))
+            block = rows[start:end]
+            yield block, self._block_scores(block)
+            start = end
+
+    def _block_scores(self, block):
+        lengths = self.indptr[block + 1] - self.indptr[block]
+        entry = np.repeat(self.indptr[block] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        local_row = np.repeat(np.arange(len(block)), lengths)
+        terms, weights = self.indices[entry], self.data[entry]
+
+        columns = self.dense_column[terms]
+        is_dense = columns >= 0
+        block_dense = np.zeros((len(block), len(self.dense)), dtype=np.float32)
+        block_dense[local_row[is_dense], columns[is_dense]] = weights[is_dense]
+        local_row, terms, weights = local_row[~is_dense], terms[~is_dense], weights[~is_dense]
+
+        # Mỗi (dòng, từ) được nhân với toàn bộ posting của từ đó rồi cộng dồn theo (dòng, sản phẩm)
+        posting_lengths = self.term_ptr[terms + 1] - self.term_ptr[terms]
+        positions = np.repeat(self.term_ptr[terms] - np.cumsum(posting_lengths) + posting_lengths, posting_lengths) \
+            + np.arange(posting_lengths.sum())
+        keys = np.repeat(local_row, posting_lengths) * len(self) + self.posting_rows[positions]
+        contributions = self.posting_weights[positions] * np.repeat(weights, posting_lengths)
+        scores = np.bincount(keys, weights=contributions, minlength=len(block) * len(self))
+        scores = scores.reshape(len(block), len(self)).astype(np.float32)
+        scores += block_dense @ self.dense
+        return scores
+
+    def neighbors(self, rows, count=NEIGHBORS):
+        """{product id: [(neighbor id, score), ...] best first} for the given rows"""
+        result = {}
+        count = min(count, len(self) - 1)
+        if count <= 0:
+            return {int(self.product_ids[row]): [] for row in rows}
+        for block, scores in self.similarities(rows):
+            scores[np.arange(len(block)), block] = 0
+            best = np.argpartition(scores, -count, axis=1)[:, -count:]
+            for index, row in enumerate(block.tolist()):
+                candidates = best[index]
+                row_scores = scores[index, candidates]
+                order = np.lexsort((self.product_ids[candidates], -row_scores))
+                result[int(self.product_ids[row])] = [
+                    (int(self.product_ids[candidates[i]]), round(float(row_scores[i]), 4))
+                    for i in order if row_scores[i] > 0
+                ]
+        return result
+
+
+def load_index(session):
+    from models import Product
+    rows = session.query(Product.id, Product.name, Product.brand, Product.description, Product.ingredients).filter(
+        Product.is_active == True
+    ).order_by(Product.id).all()
+    return TfidfIndex([row[0] for row in rows], [product_terms(*row[1:]) for row in rows])
+
+
+def save_neighbors(session, neighbors):
+    """Replace the stored neighbor lists of these products (an empty list clears it)"""
+    from models import ProductNeighbor
+    product_ids = list(neighbors)
+    for start in range(0, len(product_ids), 500):
+        chunk = product_ids[start:start + 500]
+        session.execute(delete(ProductNeighbor).where(ProductNeighbor.product_id.in_(chunk)))
+        values = [
+            {'product_id': product_id, 'rank': rank, 'neighbor_id': neighbor_id, 'score': score}
+            for product_id in chunk
+            for rank, (neighbor_id, score) in enumerate(neighbors[product_id])
+        ]
+        if values:
+            session.execute(ProductNeighbor.__table__.insert(), values)
+
+
+def rebuild_all(session):
+    """Recompute the neighbors of every product"""
+    from models import ProductNeighbor
+    index = load_index(session)
+    session.execute(delete(ProductNeighbor))
+    rows = range(len(index))
+    for start in range(0, len(index), 2000):
+        save_neighbors(session, index.neighbors(rows[start:start + 2000]))
+    session.commit()
+    return len(index)
+
+
+def update(session, changed_ids):
+    """Recompute only the neighbor lists that changed_ids can affect; returns how many were rewritten"""
+    from models import ProductNeighbor
+    changed_ids = set(changed_ids)
+    if not changed_ids:
+        return 0
+    index = load_index(session)
+
+    # Danh sách có chứa sản phẩm đã đổi (có thể tụt hạng hoặc bị xóa/ngừng bán)
+    affected = set(changed_ids)
+    affected.update(row[0] for row in session.query(ProductNeighbor.product_id).filter(
+        ProductNeighbor.neighbor_id.in_(changed_ids)
+    ).distinct())
+
+    # Sản phẩm mà một sản phẩm đã đổi nay giống hơn hàng xóm cuối cùng hiện tại
+    changed_rows = [index.row_of[product_id] for product_id in changed_ids if product_id in index.row_of]
+    last_scores = dict(session.query(ProductNeighbor.product_id, ProductNeighbor.score).filter(
+        ProductNeighbor.rank == NEIGHBORS - 1
+    ).all())
+    threshold = np.array([last_scores.get(int(product_id), 0.0) for product_id in index.product_ids], dtype=np.float32)
+    for _, scores in index.similarities(changed_rows):
+        affected.update(index.product_ids[(scores > threshold).any(axis=0)].tolist())
+
+    neighbors = index.neighbors(index.row_of[product_id] for product_id in affected if product_id in index.row_of)
+    # Sản phẩm đã xóa hoặc ngừng bán không còn danh sách
+    for product_id in affected:
+        neighbors.setdefault(product_id, [])
+    save_neighbors(session, neighbors)
+    session.commit()
+    return len(affected)
+
+
+def run(full=False):
+    from app import create_app
+    from extensions import db
+
+    app = create_app()
+    with app.app_context():
+        started = time.perf_counter()
+        position = product_changes.position(READER)
+        seq, changed = product_changes.since(position) if position is not None else (product_changes.latest(), None)
+        if full or changed is None:
+            count = rebuild_all(db.session)
+            action = f"Recomputed neighbors of all {count} products"
+        else:
+            count = update(db.session, changed)
+            action = f"{len(changed)} changed products, rewrote {count} neighbor lists"
+        product_changes.set_position(READER, seq)
+        return f"{action} in {time.perf_counter() - started:.1f}s"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Precompute similar products')
+    parser.add_argument('--full', action='store_true', help='Recompute every product')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    print(f"✅ {run(args.full)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,323 @@
+import io
+import logging
+import numpy as np
+from PIL import Image
+from facepp_client import run_sync
+from image_utils import face_crop_box, crop_image
+from metrics import timed
+
+
+def offset_coordinates(obj, dx, dy):
+    """Shift every rectangle ({left, top, ...}) and point ({x, y}) in a Face++ response by (dx, dy), in place"""
+    if isinstance(obj, list):
+        for value in obj:
+            offset_coordinates(value, dx, dy)
+        return
+    if not isinstance(obj, dict):
+        return
+    if isinstance(obj.get('left'), (int, float)) and isinstance(obj.get('top'), (int, float)):
+        obj['left'] += dx
+        obj['top'] += dy
+    elif set(obj) == {'x', 'y'} and all(isinstance(v, (int, float)) for v in obj.values()):
+        obj['x'] += dx
+        obj['y'] += dy
+    for value in obj.values():
+        if isinstance(value, (dict, list)):
+            offset_coordinates(value, dx, dy)
+
+
+class SkinAnalyzerBackend:
+    """Interface FaceAnalyzer dispatches through; results use the analyze_skin dict shape"""
+    name = 'base'
+    # Có nên lưu kết quả vào analysis cache hay không (chỉ đáng với backend tốn quota/thời gian)
+    cacheable = False
+
+    def __init__(self, analyzer):
+        self.analyzer = analyzer
+
+    def available(self):
+        return True
+
+    def analyze(self, image_bytes, width, height):
+        """Analyze a normalized JPEG of width x height; must return a result dict"""
+        raise NotImplementedError
+
+
+class FacePPBackend(SkinAnalyzerBackend):
+    """Face++ Detect v3 + Skin Analyze v1"""
+    name = 'facepp'
+    cacheable = True
+
+    def available(self):
+        if not self.analyzer.api_key or not self.analyzer.api_secret:
+            logging.error("Face++ API credentials not found")
+            return False
+        breaker = self.analyzer.circuit_breaker
+        if breaker is not None and not breaker.is_available():
+            # Face++ đang sự cố: chuyển ngay sang backend dự phòng thay vì chờ timeout
+            logging.info("Face++ circuit breaker is open, skipping Face++ backend")
+            return False
+        return True
+
+    def analyze(self, image_bytes, width, height):
+        if self.analyzer.face_crop:
+            detect_result, skin_result = run_sync(self._detect_then_analyze_face(image_bytes, width, height))
+        else:
+            # Detect API (v3) và Skin Analyze API (v1) chạy song song trên cùng một ảnh
+            detect_result, skin_result = self.analyzer.client.detect_and_analyze_sync(image_bytes)
+
+        base_info = {'age': 25, 'gender': 'Female', 'face_rectangle': None}
+        if detect_result and detect_result.get('faces'):
+            face_data = detect_result['faces'][0]
+            attrs = face_data.get('attributes', {})
+            base_info['age'] = attrs.get('age', {}).get('value', 25)
+            base_info['gender'] = attrs.get('gender', {}).get('value', 'Female')
+            base_info['face_rectangle'] = face_data.get('face_rectangle')
+            logging.info(f"Detect API info: Age {base_info['age']}, Gender {base_info['gender']}")
+
+        result = self.analyzer._process_skin_analysis_result(skin_result) if skin_result else None
+
+        if result and result.get('success'):
+            result['analysis_width'] = width
+            result['analysis_height'] = height
+            # Merge the accurate age/gender into the detailed skin result
+            result['age'] = base_info['age']
+            result['gender'] = base_info['gender']
+            if base_info.get('face_rectangle'):
+                result['face_rectangle'] = base_info['face_rectangle']
+            return result
+
+        # If Skin Analyze fails, return fallback with the age we found
+        logging.warning("Skin Analyze API failed, returning partial results")
+        fallback = self.analyzer._get_fallback_analysis()
+        fallback['age'] = base_info['age']
+        return fallback
+
+    async def _detect_then_analyze_face(self, image_bytes, width, height):
+        """Detect first, then send only the face plus a margin to Skin Analyze"""
+        client = self.analyzer.client
+        detect_result = await client.detect(image_bytes)
+        faces = (detect_result or {}).get('faces') or []
+        if not faces or not faces[0].get('face_rectangle'):
+            # Không có khuôn mặt để cắt: gửi nguyên ảnh như trước
+            return detect_result, await client.skin_analyze(image_bytes)
+
+        with timed('face_crop'):
+            box = face_crop_box(faces[0]['face_rectangle'], width, height, self.analyzer.face_crop_margin)
+            face_bytes = crop_image(image_bytes, box, self.analyzer.face_crop_quality)
+        logging.info(f"Skin Analyze on face crop {box}: {len(face_bytes)} bytes instead of {len(image_bytes)}")
+
+        skin_result = await client.skin_analyze(face_bytes)
+        if skin_result:
+            # Tọa độ Face++ trả về tính trên ảnh cắt: dời về ảnh analysis_width x analysis_height
+            offset_coordinates(skin_result, box[0], box[1])
+        return detect_result, skin_result
+
+
+class LocalSkinBackend(SkinAnalyzerBackend):
+    """CPU-only heuristic analyzer (Pillow + NumPy) used offline or when Face++ is unavailable.
+
+    The face is located as the bounding box of YCbCr skin-tone pixels and split
+    into forehead / eye / cheek / nose / chin regions. Per-region statistics
+    (redness outliers, dark-pixel density, specular highlights, Laplacian
+    texture, vertical gradient energy) are thresholded into Face++-style
+    {'value', 'confidence'} items so the rest of the pipeline is unchanged.
+    """
+    name = 'local'
+
+    # Ngưỡng cho các chỉ số (đã chuẩn hóa về [0, 1])
+    ACNE_DENSITY = 0.015
+    SPOT_DENSITY = 0.012
+    BLACKHEAD_DENSITY = 0.02
+    SHINE_TZONE = 0.04
+    SHINE_CHEEK = 0.02
+    DRY_SHINE = 0.004
+    PORE_TEXTURE = 0.0025
+    FINELINE_TEXTURE = 0.003
+    WRINKLE_GRADIENT_RATIO = 1.35
+    DARK_CIRCLE_RATIO = 0.88
+    SENSITIVE_REDNESS = 0.17
+
+    # Vùng trên khuôn mặt, tính theo tỷ lệ của face box: (left, top, right, bottom)
+    REGIONS = {
+        'forehead': (0.25, 0.05, 0.75, 0.25),
+        'left_eye': (0.15, 0.33, 0.42, 0.43),
+        'right_eye': (0.58, 0.33, 0.85, 0.43),
+        'left_eye_corner': (0.05, 0.30, 0.20, 0.42),
+        'right_eye_corner': (0.80, 0.30, 0.95, 0.42),
+        'left_cheek': (0.12, 0.48, 0.38, 0.72),
+        'right_cheek': (0.62, 0.48, 0.88, 0.72),
+        'nose': (0.40, 0.38, 0.60, 0.66),
+        'chin': (0.35, 0.82, 0.65, 0.97),
+    }
+
+    def analyze(self, image_bytes, width, height):
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            # Giải mã ở 1/2 kích thước là đủ cho thống kê vùng và nhanh hơn nhiều
+            img.draft('RGB', (width // 2, height // 2))
+            rgb = np.asarray(img.convert('RGB'), dtype=np.float32) / 255.0
+
+        scale_x = width / rgb.shape[1]
+        scale_y = height / rgb.shape[0]
+
+        face_box = self._find_face(rgb)
+        if face_box is None:
+            logging.warning("Local skin analyzer: no face-like skin region found")
+            return self.analyzer._get_fallback_analysis()
+
+        metrics, rects = self._region_metrics(rgb, face_box)
+        skin_analysis = self._to_skin_analysis(metrics, rects, scale_x, scale_y)
+
+        skin_type = self.analyzer._map_skin_type_number(skin_analysis['skin_type']['skin_type'])
+        if skin_type == 'normal' and skin_analysis['local_metrics']['sensitive']:
+            skin_type = 'sensitive'
+        concerns = self.analyzer._identify_concerns_from_analysis(skin_analysis)
+        # Không ước lượng được tuổi: dùng mặc định 25 cho liệu trình, không hiển thị tuổi
+        routine = self.analyzer._generate_routine(skin_type, concerns, 25)
+
+        x0, y0, x1, y1 = face_box
+        return {
+            'success': True,
+            'skin_type': skin_type,
+            'age': None,
+            'concerns': concerns,
+            'skin_analysis': skin_analysis,
+            'recommended_routine': routine,
+            'confidence': 0.5,
+            'face_rectangle': {
+                'left': int(x0 * scale_x),
+                'top': int(y0 * scale_y),
+                'width': int((x1 - x0) * scale_x),
+                'height': int((y1 - y0) * scale_y),
+            },
+            'analysis_width': width,
+            'analysis_height': height,
+        }
+
+    def _find_face(self, rgb):
+        """Bounding box (x0, y0, x1, y1) of the main skin-tone area, or None"""
+        r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        y = 0.299 * r + 0.587 * g + 0.114 * b
+        cr = (r - y) * 0.713 + 0.5
+        cb = (b - y) * 0.564 + 0.5
+        skin = (cr > 133 / 255) & (cr < 173 / 255) & (cb > 77 / 255) & (cb < 127 / 255)
+
+        if skin.mean() < 0.05:
+            return None
+
+        rows = skin.mean(axis=1)
+        row_idx = np.flatnonzero(rows > 0.3 * rows.max())
+        y0, y1 = row_idx[0], row_idx[-1] + 1
+        cols = skin[y0:y1].mean(axis=0)
+        col_idx = np.flatnonzero(cols > 0.3 * cols.max())
+        x0, x1 = col_idx[0], col_idx[-1] + 1
+
+        if (x1 - x0) < 16 or (y1 - y0) < 16:
+            return None
+        return int(x0), int(y0), int(x1), int(y1)
+
+    def _region_metrics(self, rgb, face_box):
+        x0, y0, x1, y1 = face_box
+        fw, fh = x1 - x0, y1 - y0
+
+        r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        luma = 0.299 * r + 0.587 * g + 0.114 * b
+        redness = (r - g) / (r + g + b + 1e-6)
+        maxc = rgb.max(axis=2)
+        saturation = (maxc - rgb.min(axis=2)) / (maxc + 1e-6)
+        specular = (luma > 0.85) & (saturation < 0.2)
+
+        # Laplacian và gradient tính một lần trên toàn ảnh, các vùng chỉ cắt ra
+        laplacian = np.zeros_like(luma)
+        laplacian[1:-1, 1:-1] = (4 * luma[1:-1, 1:-1] - luma[:-2, 1:-1] - luma[2:, 1:-1]
+                                 - luma[1:-1, :-2] - luma[1:-1, 2:])
+        grad_y = np.abs(np.diff(luma, axis=0, append=luma[-1:]))
+        grad_x = np.abs(np.diff(luma, axis=1, append=luma[:, -1:]))
+
+        face_red = redness[y0:y1, x0:x1]
+        red_cut = face_red.mean() + 2.0 * face_red.std()
+
+        metrics = {}
+        rects = {}
+        for name, (fl, ft, fr, fb) in self.REGIONS.items():
+            rx0, ry0 = x0 + int(fl * fw), y0 + int(ft * fh)
+            rx1, ry1 = x0 + max(int(fr * fw), int(fl * fw) + 1), y0 + max(int(fb * fh), int(ft * fh) + 1)
+            sl = (slice(ry0, ry1), slice(rx0, rx1))
+            region_luma = luma[sl]
+            dark_cut = region_luma.mean() - 2.5 * region_luma.std()
+            metrics[name] = {
+                'luma': float(region_luma.mean()),
+                'redness': float(redness[sl].mean()),
+                'red_density': float((redness[sl] > red_cut).mean()),
+                'dark_density': float((region_luma < dark_cut).mean()),
+                'shine': float(specular[sl].mean()),
+                'texture': float(laplacian[sl].var()),
+                'gradient_ratio': float(grad_y[sl].mean() / (grad_x[sl].mean() + 1e-6)),
+            }
+            rects[name] = (rx0, ry0, rx1, ry1)
+        return metrics, rects
+
+    def _to_skin_analysis(self, m, rects, scale_x, scale_y):
+        def region_item(score, threshold, *names):
+            detected = score > threshold
+            entry = {'value': 1 if detected else 0, 'confidence': round(min(1.0, score / (2 * threshold)), 3)}
+            if detected:
+                worst = max(names, key=lambda n: m[n]['red_density'] + m[n]['dark_density'])
+                rx0, ry0, rx1, ry1 = rects[worst]
+                entry['rectangle'] = {
+                    'left': int(rx0 * scale_x), 'top': int(ry0 * scale_y),
+                    'width': int((rx1 - rx0) * scale_x), 'height': int((ry1 - ry0) * scale_y),
+                }
+            return entry
+
+        cheeks = ('left_cheek', 'right_cheek')
+        acne_score = max(m[n]['red_density'] for n in cheeks + ('forehead', 'chin'))
+        spot_score = max(m[n]['dark_density'] for n in cheeks + ('forehead',))
+        tzone_shine = (m['forehead']['shine'] + m['nose']['shine']) / 2
+        cheek_shine = (m['left_cheek']['shine'] + m['right_cheek']['shine']) / 2
+        cheek_luma = (m['left_cheek']['luma'] + m['right_cheek']['luma']) / 2
+        eye_luma = (m['left_eye']['luma'] + m['right_eye']['luma']) / 2
+        fineline_score = max(m['left_eye_corner']['texture'], m['right_eye_corner']['texture'])
+        face_redness = np.mean([m[n]['redness'] for n in cheeks + ('forehead', 'nose', 'chin')])
+
+        # 0: dry, 1: oily, 2: normal, 3: combination (giống mã của Face++)
+        if tzone_shine > self.SHINE_TZONE and cheek_shine > self.SHINE_CHEEK:
+            skin_type_number = 1
+        elif tzone_shine > self.SHINE_TZONE:
+            skin_type_number = 3
+        elif tzone_shine < self.DRY_SHINE and max(m[n]['texture'] for n in cheeks) > self.PORE_TEXTURE:
+            skin_type_number = 0
+        else:
+            skin_type_number = 2
+
+        dark_circle_ratio = eye_luma / (cheek_luma + 1e-6)
+
+        return {
+            'skin_type': {'skin_type': skin_type_number},
+            'acne': region_item(acne_score, self.ACNE_DENSITY, *cheeks, 'forehead', 'chin'),
+            'skin_spot': region_item(spot_score, self.SPOT_DENSITY, *cheeks, 'forehead'),
+            'blackhead': region_item(m['nose']['dark_density'], self.BLACKHEAD_DENSITY, 'nose'),
+            'pores_left_cheek': region_item(m['left_cheek']['texture'], self.PORE_TEXTURE, 'left_cheek'),
+            'pores_right_cheek': region_item(m['right_cheek']['texture'], self.PORE_TEXTURE, 'right_cheek'),
+            'eye_finelines': region_item(fineline_score, self.FINELINE_TEXTURE, 'left_eye_corner', 'right_eye_corner'),
+            'forehead_wrinkle': region_item(m['forehead']['gradient_ratio'], self.WRINKLE_GRADIENT_RATIO, 'forehead'),
+            'dark_circle': region_item(1 / dark_circle_ratio, 1 / self.DARK_CIRCLE_RATIO, 'left_eye', 'right_eye'),
+            'local_metrics': {
+                'tzone_shine': round(tzone_shine, 4),
+                'cheek_shine': round(cheek_shine, 4),
+                'redness': round(float(face_redness), 4),
+                'sensitive': bool(face_redness > self.SENSITIVE_REDNESS),
+            },
+        }
+
+
+BACKENDS = {
+    FacePPBackend.name: FacePPBackend,
+    LocalSkinBackend.name: LocalSkinBackend,
+}
+
+
+def get_backend(name, analyzer):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown skin analyzer backend '{name}' (expected one of {', '.join(BACKENDS)})")
+    return BACKENDS[name](analyzer)
@@ -542,11 +542,13 @@ function addAnimationStyles() {
 }
 
 // Shopping cart functionality
-function updateCartCount() {
-    const cartBadge = document.querySelector('.badge');
+function updateCartCount(count) {
+    const cartBadge = document.querySelector('#cart-count');
     if (cartBadge) {
-        // This would be updated via AJAX in a real implementation
-        const count = parseInt(cartBadge.textContent) || 0;
+        // count comes from the JSON cart endpoints (item_count); without it keep the rendered value
+        if (count === undefined) {
+            count = parseInt(cartBadge.textContent) || 0;
+        }
         cartBadge.textContent = count;
         
         if (count > 0) {
@@ -19,6 +19,39 @@ function initializeSkinAnalysis() {
     if (document.querySelector('.analysis-result')) {
         animateResults();
     }
+    
+    // Poll background analysis job until results are ready
+    const pending = document.getElementById('analysisPending');
+    if (pending) {
+        pollAnalysisStatus(pending.dataset.statusUrl);
+    }
+}
+
+function pollAnalysisStatus(statusUrl, attempt = 0) {
+    // Sau maxAttempts vẫn tiếp tục hỏi nhưng thưa hơn: server đánh dấu failed các job quá hạn,
+    // nên lần hỏi sau đó sẽ nhận ready và chuyển tới trang kết quả (có thông báo lỗi)
+    const maxAttempts = 90;
+    const delay = attempt < maxAttempts ? 2000 : 10000;
+    
+    if (attempt === maxAttempts) {
+        const pending = document.getElementById('analysisPending');
+        if (pending) {
+            pending.querySelector('p').textContent = 'Phân tích đang mất nhiều thời gian hơn dự kiến. Trang sẽ tự động cập nhật khi có kết quả.';
+        }
+    }
+    
+    fetch(statusUrl, { headers: { 'Accept': 'application/json' } })
+        .then(response => response.json())
+        .then(data => {
+            if (data.ready) {
+                window.location.href = data.result_url;
+            } else {
+                setTimeout(() => pollAnalysisStatus(statusUrl, attempt + 1), delay);
+            }
+        })
+        .catch(() => {
+            setTimeout(() => pollAnalysisStatus(statusUrl, attempt + 1), Math.max(delay, 4000));
+        });
 }
 
 function setupFileUpload(fileInput) {
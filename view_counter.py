@@ -0,0 +1,94 @@
+"""
+Buffered blog post view counter.
+
+blog.post_detail used to run `post.views += 1` and commit on every view,
+turning a read into a write transaction that serializes readers of a popular
+post on its row lock (and on the whole database file with SQLite). Views are
+now added to a per-process buffer, and a background thread writes them every
+VIEW_FLUSH_SECONDS as one `UPDATE blog_post SET views = views + n` per post,
+all in one transaction. The increment is relative, so the workers flush
+independently without losing each other's counts.
+
+The buffer is flushed again at interpreter exit (gunicorn's graceful worker
+shutdown), so only a killed worker loses its last few seconds of views.
+"""
+
+import os
+import atexit
+import logging
+import threading
+
+from sqlalchemy import bindparam
+
+FLUSH_SECONDS = float(os.environ.get('VIEW_FLUSH_SECONDS', 10))
+# Ghi sớm hơn khi bộ đệm có quá nhiều bài khác nhau
+MAX_PENDING_POSTS = 1000
+
+
+class ViewCounter:
+    """Per-process buffer of view increments, flushed periodically in one batched transaction"""
+
+    def __init__(self, flush_seconds=FLUSH_SECONDS, max_pending=MAX_PENDING_POSTS):
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._engine = None
+        self._thread = None
+
+    def add(self, post_id, engine):
+        """Count one view of post_id; written to the database on the next flush"""
+        with self._lock:
+            self._pending[post_id] = self._pending.get(post_id, 0) + 1
+            if self._thread is None:
+                self._start(engine)
+            if len(self._pending) >= self.max_pending:
+                self._wake.set()
+
+    def pending(self, post_id):
+        """Views of post_id not written yet, to show an up to date count"""
+        return self._pending.get(post_id, 0)
+
+    def _start(self, engine):
+        self._engine = engine
+        self._thread = threading.Thread(target=self._run, name='view-counter', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write the buffered views; returns how many views were written"""
+        from models import BlogPost
+        with self._flush_lock:
+            with self._lock:
+                counts, self._pending = self._pending, {}
+            if not counts or self._engine is None:
+                return 0
+            table = BlogPost.__table__
+            # date_updated có onupdate: giữ nguyên giá trị, lượt xem không phải là sửa bài
+            statement = table.update().where(table.c.id == bindparam('post_id')).values(
+                views=table.c.views + bindparam('n'), date_updated=table.c.date_updated
+            )
+            try:
+                # Sắp theo id để các worker khóa các dòng theo cùng một thứ tự (tránh deadlock)
+                with self._engine.begin() as conn:
+                    conn.execute(statement, [{'post_id': post_id, 'n': n} for post_id, n in sorted(counts.items())])
+            except Exception as e:
+                # Trả lại bộ đệm để lần sau ghi tiếp
+                with self._lock:
+                    for post_id, n in counts.items():
+                        self._pending[post_id] = self._pending.get(post_id, 0) + n
+                logging.warning(f"View counter: could not write {sum(counts.values())} views ({e})")
+                return 0
+            return sum(counts.values())
+
+
+# Mỗi worker giữ một bộ đệm
+view_counter = ViewCounter()